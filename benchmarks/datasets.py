@@ -0,0 +1,92 @@
+import os
+from collections import namedtuple
+from io import BytesIO
+import numpy as np
+
+# Reproducible datasets for the benchmarks.  Every synthetic case is generated from a fixed seed, so the same case
+# name always yields the same arrays.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKBOOKS = ["test.xlsx", "test2.xlsx"]
+
+DEFAULT_PARAMS = (700, 200, 0, 24)
+SIZES = [48, 480, 4800, 48000, 480000, 1000000]
+QUICK_SIZES = [48, 4800]
+
+
+class Dataset(namedtuple("Dataset", ["name", "time", "data", "file_contents"])):
+    """A named (time, data) pair.  `file_contents` holds the spreadsheet bytes, or None if not yet generated."""
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return len(self.time)
+
+
+def cosine(num_points, noise=0.05, period=24.0, cycles=2, params=DEFAULT_PARAMS, seed=0):
+    """A noisy cosine curve spanning `cycles` periods of length `period`, sampled at `num_points` evenly spaced times.
+    `noise` is the standard deviation of the Gaussian noise, as a fraction of the amplitude.
+    """
+    h, b, v, _ = params
+    rng = np.random.RandomState(seed)
+    time = np.linspace(0, period * cycles, num_points, endpoint=False)
+    data = h * np.cos(2 * np.pi * (time + v) / period) + b
+    data += rng.normal(scale=noise * abs(h), size=num_points)
+    name = "cosine-n{0}-noise{1:g}-p{2:g}-c{3:d}".format(num_points, noise, period, cycles)
+    return Dataset(name, time, data, None)
+
+
+def synthetic_cases(sizes=SIZES):
+    """The standard synthetic cases: every size at the default shape, plus noise, period and cycle-count variants
+    at the median size."""
+    cases = [cosine(n) for n in sizes]
+    mid = sorted(sizes)[len(sizes) // 2]
+    for noise in (0.0, 0.25):
+        cases.append(cosine(mid, noise=noise))
+    for period, cycles in ((12.0, 4), (24.0, 14), (168.0, 1)):
+        cases.append(cosine(mid, period=period, cycles=cycles))
+    return cases
+
+
+def workbook_cases():
+    """The spreadsheets checked into the repo."""
+    from ski_stats.common import parse_spreadsheet
+    cases = []
+    for filename in WORKBOOKS:
+        with open(os.path.join(REPO_ROOT, filename), "rb") as f:
+            file_contents = f.read()
+        time, data = parse_spreadsheet(file_contents)
+        cases.append(Dataset(filename, time, data, file_contents))
+    return cases
+
+
+def with_spreadsheet(dataset):
+    """Returns the dataset with `file_contents` set to an equivalent .xlsx file."""
+    if dataset.file_contents is not None:
+        return dataset
+    import xlsxwriter
+    buf = BytesIO()
+    workbook = xlsxwriter.Workbook(buf, {"in_memory": True})
+    sheet = workbook.add_worksheet()
+    sheet.write_column(0, 0, dataset.time)
+    sheet.write_column(0, 1, dataset.data)
+    workbook.close()
+    return dataset._replace(file_contents=buf.getvalue())
+
+
+def as_file(dataset, file_format):
+    """The dataset's columns as the contents of a "csv", "csv.gz" or "npy" file."""
+    if file_format == "npy":
+        buf = BytesIO()
+        np.save(buf, np.column_stack([dataset.time, dataset.data]))
+        return buf.getvalue()
+    buf = BytesIO()
+    np.savetxt(buf, np.column_stack([dataset.time, dataset.data]), fmt="%.17g", delimiter=",",
+               header="time,data", comments="")
+    if file_format == "csv":
+        return buf.getvalue()
+    import gzip
+    compressed = BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+        f.write(buf.getvalue())
+    return compressed.getvalue()
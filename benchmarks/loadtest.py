@@ -0,0 +1,316 @@
+"""End-to-end load test against a locally launched gunicorn server.
+
+    python -m benchmarks.loadtest [--concurrency 8] [--duration 60] [--payloads traffic.jsonl] [--output report.json]
+
+Starts the app under `config/gunicorn.py` (or targets `--url`), replays a weighted mix of requests from a pool of
+client threads, samples the RSS of every worker process, and reports throughput, latency percentiles, error and
+timeout rates per scenario.
+
+A payloads file holds one scenario per line:
+    {"name": "fit", "weight": 2, "method": "POST", "path": "/submitAnalysis",
+     "form": {"analysis-id": "ski_slope_least_squares_3_oct", ...}, "files": {"spreadsheet": "test.xlsx"}}
+File paths are relative to the repository root.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from collections import namedtuple, defaultdict
+import requests
+from benchmarks.datasets import REPO_ROOT
+
+DEFAULT_PORT = 8123
+SERVER_START_TIMEOUT = 60
+
+
+class Scenario(namedtuple("Scenario", ["name", "weight", "method", "path", "form", "files"])):
+    """A request to replay.  `files` maps form field names to file paths."""
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, obj):
+        return cls(obj.get("name", obj["path"]), obj.get("weight", 1), obj.get("method", "GET"), obj["path"],
+                   obj.get("form", {}), obj.get("files", {}))
+
+
+Sample = namedtuple("Sample", ["scenario", "start", "latency", "status", "error"])
+
+
+def default_scenarios(base_url):
+    """The standard traffic mix: page loads, spreadsheet imports, form submissions and Desmos fits."""
+    # by name, as ids are assigned in the order the scripts sort in
+    fit_form = {"analysis-id": "ski_slope_least_squares_3_oct", "initial_params-h": "700", "initial_params-b": "200",
+                "initial_params-v": "0", "initial_params-p": "24", "max_nfev": "100000"}
+    for param in "hbvp":
+        fit_form["param_bounds-{0}-min".format(param)] = "-inf"
+        fit_form["param_bounds-{0}-max".format(param)] = "inf"
+
+    # the Desmos page posts back the numbers returned by /parseSpreadsheet
+    with open(os.path.join(REPO_ROOT, "test.xlsx"), "rb") as f:
+        parsed = requests.post(base_url + "/parseSpreadsheet", files={"spreadsheet": ("test.xlsx", f)}).json()
+    desmos_form = {"x[]": [repr(x) for x in parsed["x"]], "y[]": [repr(y) for y in parsed["y"]],
+                   "h": "700", "b": "200", "v": "0", "p": "24", "max_nfev": "100000"}
+
+    return [
+        Scenario("index", 4, "GET", "/", {}, {}),
+        Scenario("parseSpreadsheet", 2, "POST", "/parseSpreadsheet", {}, {"spreadsheet": "test.xlsx"}),
+        Scenario("submitAnalysis", 1, "POST", "/submitAnalysis", fit_form, {"spreadsheet": "test.xlsx"}),
+        Scenario("submitAnalysis-test2", 1, "POST", "/submitAnalysis", fit_form, {"spreadsheet": "test2.xlsx"}),
+        Scenario("desmosCalculateRegression", 2, "POST", "/desmosCalculateRegression", desmos_form, {}),
+    ]
+
+
+def load_scenarios(path):
+    with open(path) as f:
+        return [Scenario.from_json(json.loads(line)) for line in f if line.strip()]
+
+
+class Server(object):
+    """A gunicorn server running the app with the production config, on a local port."""
+    def __init__(self, port, workers=None, worker_class=None):
+        self.port = port
+        self.workers = workers
+        self.worker_class = worker_class
+        self.process = None
+        self.tmpdir = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.port)
+
+    def start(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="ski-stats-loadtest-")
+        env = dict(os.environ, prometheus_multiproc_dir=os.path.join(self.tmpdir, "prometheus"))
+        os.makedirs(env["prometheus_multiproc_dir"])
+        args = [os.path.join(os.path.dirname(sys.executable), "gunicorn"), "-c", "config/gunicorn.py",
+                "--bind", "127.0.0.1:{0}".format(self.port), "--pid", os.path.join(self.tmpdir, "gunicorn.pid"),
+                "--error-logfile", os.path.join(self.tmpdir, "error.log"), "--access-logfile", "/dev/null"]
+        if self.workers:
+            args += ["--workers", str(self.workers)]
+        if self.worker_class:
+            args += ["--worker-class", self.worker_class]
+        self.process = subprocess.Popen(args + ["ski_stats:app"], cwd=REPO_ROOT, env=env)
+
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while time.time() < deadline:
+            try:
+                requests.get(self.url + "/desmos", timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.5)
+        self.stop()
+        raise RuntimeError("Server did not start within {0}s".format(SERVER_START_TIMEOUT))
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait()
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def worker_pids(self):
+        return child_pids(self.process.pid) if self.process is not None else []
+
+
+def child_pids(parent_pid):
+    """The pids of a process's direct children, from /proc."""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(entry)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the command name is parenthesized and may contain spaces; ppid is the 2nd field after it
+        if int(stat.rsplit(")", 1)[1].split()[1]) == parent_pid:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_kb(pid):
+    try:
+        with open("/proc/{0}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+class RssSampler(threading.Thread):
+    """Samples the RSS of the server's workers every `interval` seconds."""
+    def __init__(self, server, interval):
+        super(RssSampler, self).__init__()
+        self.daemon = True
+        self.server = server
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        started = timeit.default_timer()
+        while not self.stopped.is_set():
+            rss = {}
+            for pid in self.server.worker_pids():
+                kb = rss_kb(pid)
+                if kb is not None:
+                    rss[str(pid)] = kb
+            self.samples.append({"t": round(timeit.default_timer() - started, 3), "rss_kb": rss})
+            self.stopped.wait(self.interval)
+
+
+def run_load(base_url, scenarios, concurrency, duration, timeout, seed):
+    """Replay the weighted scenarios from `concurrency` threads for `duration` seconds.  Returns the samples and the
+    elapsed time, including the wait for requests still in flight at the deadline."""
+    samples = []
+    lock = threading.Lock()
+    file_cache = {}
+    for scenario in scenarios:
+        for path in scenario.files.values():
+            if path not in file_cache:
+                with open(os.path.join(REPO_ROOT, path), "rb") as f:
+                    file_cache[path] = f.read()
+    weighted = [scenario for scenario in scenarios for _ in range(scenario.weight)]
+    started = timeit.default_timer()
+    deadline = started + duration
+
+    def client(client_seed):
+        rng = random.Random(client_seed)
+        session = requests.Session()
+        while timeit.default_timer() < deadline:
+            scenario = rng.choice(weighted)
+            files = {field: (os.path.basename(path), file_cache[path]) for field, path in scenario.files.items()}
+            start = timeit.default_timer()
+            status, error = None, None
+            try:
+                response = session.request(scenario.method, base_url + scenario.path, data=scenario.form,
+                                           files=files or None, timeout=timeout)
+                response.content
+                status = response.status_code
+            except requests.Timeout:
+                error = "timeout"
+            except requests.RequestException as err:
+                error = type(err).__name__
+            sample = Sample(scenario.name, start, timeit.default_timer() - start, status, error)
+            with lock:
+                samples.append(sample)
+
+    threads = [threading.Thread(target=client, args=(seed + i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, timeit.default_timer() - started
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+    """Throughput, latency percentiles and error/timeout rates, overall and by scenario."""
+    groups = defaultdict(list)
+    for sample in samples:
+        groups[sample.scenario].append(sample)
+        groups["ALL"].append(sample)
+
+    summary = {}
+    for name, group in groups.items():
+        latencies = sorted(sample.latency for sample in group)
+        timeouts = sum(1 for sample in group if sample.error == "timeout")
+        errors = sum(1 for sample in group if sample.error is not None or sample.status >= 400)
+        summary[name] = {
+            "requests": len(group),
+            "throughput": len(group) / elapsed,
+            "p50": percentile(latencies, .50),
+            "p95": percentile(latencies, .95),
+            "p99": percentile(latencies, .99),
+            "max": latencies[-1],
+            "error_rate": errors / float(len(group)),
+            "timeout_rate": timeouts / float(len(group)),
+        }
+    return summary
+
+
+def print_summary(summary, rss_samples, out=sys.stdout):
+    out.write("{0:<28} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8} {7:>8}\n".format(
+        "scenario", "reqs", "req/s", "p50", "p95", "p99", "err%", "tmo%"))
+    for name in sorted(summary, key=lambda name: (name == "ALL", name)):
+        stats = summary[name]
+        out.write("{0:<28} {1:8d} {2:8.2f} {3:8.3f} {4:8.3f} {5:8.3f} {6:8.2f} {7:8.2f}\n".format(
+            name, stats["requests"], stats["throughput"], stats["p50"], stats["p95"], stats["p99"],
+            100 * stats["error_rate"], 100 * stats["timeout_rate"]))
+    if rss_samples:
+        peak = defaultdict(int)
+        for sample in rss_samples:
+            for pid, kb in sample["rss_kb"].items():
+                peak[pid] = max(peak[pid], kb)
+        first, last = rss_samples[0]["rss_kb"], rss_samples[-1]["rss_kb"]
+        out.write("\nworker RSS (MiB): start / end / peak\n")
+        for pid in sorted(peak):
+            out.write("  {0:>8}  {1:8.1f} {2:8.1f} {3:8.1f}\n".format(
+                pid, first.get(pid, 0) / 1024., last.get(pid, 0) / 1024., peak[pid] / 1024.))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the webapp.")
+    parser.add_argument("--url", help="target an already-running server instead of launching one")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port for the launched server")
+    parser.add_argument("--workers", type=int, help="override the configured number of workers")
+    parser.add_argument("--worker-class", help="override the configured worker class")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to generate load")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request client timeout in seconds")
+    parser.add_argument("--payloads", help="JSONL file of scenarios to replay (default: built-in mix)")
+    parser.add_argument("--rss-interval", type=float, default=1.0, help="seconds between worker RSS samples")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report, including the RSS time series, to this JSON file")
+    args = parser.parse_args(argv)
+
+    server = None
+    sampler = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        server = Server(args.port, args.workers, args.worker_class)
+        server.start()
+        base_url = server.url
+    try:
+        scenarios = load_scenarios(args.payloads) if args.payloads else default_scenarios(base_url)
+        if server is not None:
+            sampler = RssSampler(server, args.rss_interval)
+            sampler.start()
+        samples, elapsed = run_load(base_url, scenarios, args.concurrency, args.duration, args.timeout, args.seed)
+    finally:
+        if sampler is not None:
+            sampler.stopped.set()
+            sampler.join()
+        if server is not None:
+            server.stop()
+
+    summary = summarize(samples, elapsed)
+    rss_samples = sampler.samples if sampler is not None else []
+    print_summary(summary, rss_samples)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"concurrency": args.concurrency, "elapsed": elapsed, "summary": summary,
+                       "rss": rss_samples}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""Micro-benchmarks for the analysis pipeline.
+
+    python -m benchmarks.run [--quick] [--output results.json] [--baseline benchmarks/baseline.json] [--save-baseline]
+
+Each stage is timed on its own against every dataset case, and the results are compared against the stored baseline.
+Exits non-zero if any stage/case got slower than the baseline by more than `--threshold`.  On Linux, the peak memory
+of one extra call is also reported (`peak_kb`), for information only.
+"""
+import argparse
+import ctypes
+import json
+import os
+import platform
+import re
+import sys
+import time
+import timeit
+from collections import namedtuple, OrderedDict
+from benchmarks import datasets
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_THRESHOLD = 1.25
+
+
+class Stage(namedtuple("Stage", ["setup", "run", "max_size"])):
+    """A benchmarked function.  `setup(dataset)` prepares the untimed arguments, `run(args)` is timed.  Cases larger
+    than `max_size` points are skipped."""
+    __slots__ = ()
+
+
+def _lsq():
+    from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+    return lsq
+
+
+def _setup_parse(dataset):
+    return datasets.with_spreadsheet(dataset).file_contents
+
+
+def _run_parse(file_contents):
+    from ski_stats.common import parse_spreadsheet
+    parse_spreadsheet(file_contents)
+
+
+def _parse_stage(file_format):
+    # the same columns as the parse_workbook stage, in another upload format
+    filename = "dataset." + file_format
+
+    def setup(dataset):
+        return datasets.as_file(dataset, file_format), filename
+
+    def run(args):
+        from ski_stats.common import parse_spreadsheet
+        parse_spreadsheet(args[0], filename=args[1])
+    return Stage(setup, run, None)
+
+
+def _run_least_squares(dataset):
+    lsq = _lsq()
+    lsq.least_squares(dataset.time, dataset.data, lsq.DEFAULT_INITIAL_PARAMS_GUESS, "linear", lsq.DEFAULT_BOUNDS,
+                      lsq.DEFAULT_MAX_NFEV)
+
+
+def _run_do_calculations(dataset):
+    _lsq().do_calculations(dataset.time, dataset.data)
+
+
+def _setup_workspace(dataset):
+    lsq = _lsq()
+    return lsq.MODEL.workspace(dataset.time, dataset.data), lsq.DEFAULT_INITIAL_PARAMS_GUESS
+
+
+def _run_residuals(args):
+    workspace, params = args
+    workspace.residuals(params)
+
+
+def _run_jacobian(args):
+    workspace, params = args
+    workspace.jacobian(params)
+
+
+def _run_periodogram(dataset):
+    from ski_stats import periodogram
+    periodogram.lomb_scargle(dataset.time, dataset.data)
+
+
+def _setup_pearson(dataset):
+    lsq = _lsq()
+    return lsq.cos_fit(lsq.DEFAULT_INITIAL_PARAMS_GUESS, dataset.time), dataset.data
+
+
+def _run_pearson(args):
+    from ski_stats.common import pearson
+    pearson(*args)
+
+
+def _setup_peak_auc(dataset):
+    # the calc passes each peak as tuples sliced from the sorted coordinates
+    return tuple(dataset.time), tuple(dataset.data)
+
+
+def _run_peak_auc(args):
+    from ski_stats.common import peak_auc
+    peak_auc(*args)
+
+
+def _setup_render(dataset):
+    return dataset, _lsq().do_calculations(dataset.time, dataset.data)
+
+
+def _run_serialize_results(results):
+    type(results).from_bytes(results.to_bytes())
+
+
+def _run_render(args):
+    lsq = _lsq()
+    dataset, results = args
+    lsq.generate_plot_image(dataset.time, dataset.data, results).close()
+    lsq._pyplot().close("all")
+
+
+# the crossing search in `do_calculations` is quadratic in the number of points, so it (and the render, which needs
+# its results) is capped well below the largest synthetic size
+STAGES = OrderedDict([
+    ("parse_workbook", Stage(_setup_parse, _run_parse, 48000)),
+    ("parse_csv", _parse_stage("csv")),
+    ("parse_csv_gz", _parse_stage("csv.gz")),
+    ("parse_npy", _parse_stage("npy")),
+    ("least_squares", Stage(lambda dataset: dataset, _run_least_squares, None)),
+    ("residuals", Stage(_setup_workspace, _run_residuals, None)),
+    ("jacobian", Stage(_setup_workspace, _run_jacobian, None)),
+    ("periodogram", Stage(lambda dataset: dataset, _run_periodogram, None)),
+    ("do_calculations", Stage(lambda dataset: dataset, _run_do_calculations, 48000)),
+    ("pearson", Stage(_setup_pearson, _run_pearson, None)),
+    ("peak_auc", Stage(_setup_peak_auc, _run_peak_auc, None)),
+    ("serialize_results", Stage(lambda dataset: _lsq().do_calculations(dataset.time, dataset.data),
+                                _run_serialize_results, 48000)),
+    ("generate_plot_image", Stage(_setup_render, _run_render, 48000)),
+])
+
+
+def time_call(func, args, repeat, budget):
+    """Call `func(args)` `repeat` times, or fewer if `budget` seconds run out (but at least once)."""
+    timings = []
+    started = timeit.default_timer()
+    while len(timings) < repeat:
+        start = timeit.default_timer()
+        func(args)
+        timings.append(timeit.default_timer() - start)
+        if timeit.default_timer() - started > budget:
+            break
+    timings.sort()
+    return {
+        "min": timings[0],
+        "median": timings[len(timings) // 2],
+        "mean": sum(timings) / len(timings),
+        "runs": len(timings),
+    }
+
+
+def peak_memory_kb(func, args):
+    """Peak resident memory of one `func(args)` call above the memory in use before it, in KB.  None if the platform
+    can't tell (needs Linux's resettable peak RSS)."""
+    try:
+        # return the heap's free memory to the OS, so that temporaries recycled from it count towards the peak
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        before = _proc_status_kb("VmRSS")
+        func(args)
+        return max(0, _proc_status_kb("VmHWM") - before)
+    except (IOError, OSError, AttributeError):
+        return None
+
+
+def _proc_status_kb(field):
+    with open("/proc/self/status") as f:
+        return int(re.search(field + r":\s+(\d+) kB", f.read()).group(1))
+
+
+def run(stage_names, cases, repeat, budget, log=sys.stderr):
+    """Returns an ordered dict of "<stage>/<case>" -> timing stats."""
+    results = OrderedDict()
+    for stage_name in stage_names:
+        stage = STAGES[stage_name]
+        for dataset in cases:
+            key = "{0}/{1}".format(stage_name, dataset.name)
+            if stage.max_size is not None and dataset.size > stage.max_size:
+                continue
+            try:
+                args = stage.setup(dataset)
+                stats = time_call(stage.run, args, repeat, budget)
+                peak_kb = peak_memory_kb(stage.run, args)
+                if peak_kb is not None:
+                    stats["peak_kb"] = peak_kb
+            except Exception as err:
+                stats = {"error": "[{0}] {1}".format(type(err).__name__, err)}
+            stats["size"] = dataset.size
+            results[key] = stats
+            log.write("{0:<60} {1}\n".format(key, _format_stats(stats)))
+    return results
+
+
+def compare(results, baseline):
+    """Returns a list of (key, current, baseline, ratio) for every case in both runs, comparing the min timings.  A case
+    that failed but has a baseline timing has a current of None and an infinite ratio."""
+    rows = []
+    for key, stats in results.items():
+        base = baseline.get(key)
+        if base is None or "min" not in base:
+            continue
+        if "min" not in stats:
+            rows.append((key, None, base["min"], float("inf")))
+            continue
+        ratio = stats["min"] / base["min"] if base["min"] else float("inf")
+        rows.append((key, stats["min"], base["min"], ratio))
+    return rows
+
+
+def _format_stats(stats):
+    if "error" in stats:
+        return stats["error"]
+    line = "min {0:10.6f}s  median {1:10.6f}s  ({2:d} runs)".format(stats["min"], stats["median"], stats["runs"])
+    if "peak_kb" in stats:
+        line += "  peak {0:8d} KB".format(stats["peak_kb"])
+    return line
+
+
+def _metadata(args):
+    import numpy
+    import scipy
+    import matplotlib
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "scipy": scipy.__version__,
+        "matplotlib": matplotlib.__version__,
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "quick": args.quick,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline stages.")
+    parser.add_argument("--quick", action="store_true", help="only the small sizes")
+    parser.add_argument("--stage", action="append", choices=list(STAGES), help="stage to run (repeatable)")
+    parser.add_argument("--case", help="only run cases whose name contains this substring")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage/case")
+    parser.add_argument("--budget", type=float, default=5.0, help="max seconds of timed runs per stage/case")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="overwrite the baseline with these results")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="slowdown ratio vs. baseline reported as a regression")
+    args = parser.parse_args(argv)
+
+    cases = datasets.synthetic_cases(datasets.QUICK_SIZES if args.quick else datasets.SIZES)
+    cases += datasets.workbook_cases()
+    if args.case:
+        cases = [dataset for dataset in cases if args.case in dataset.name]
+
+    results = run(args.stage or list(STAGES), cases, args.repeat, args.budget)
+    document = {"meta": _metadata(args), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(document, f, indent=2)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = 0
+    print "\n{0:<60} {1:>12} {2:>12} {3:>8}".format("stage/case", "min (s)", "baseline (s)", "ratio")
+    for key, current, base, ratio in compare(results, baseline):
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        current = "{0:12.6f}".format(current) if current is not None else "{0:>12}".format("error")
+        print "{0:<60} {1} {2:12.6f} {3:8.3f}{4}".format(key, current, base, ratio, flag)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""Compares the solver strategy `ski_stats.solver.choose` picks against SciPy's defaults.
+
+    python -m benchmarks.solver [--quick] [--repeat 5] [--output solver.json]
+
+Every dataset case is fitted from the scripts' default guess, unbounded (as the forms default to) and with the period
+bounded to 20-28, once with each strategy.  Reports the function and Jacobian evaluations, the best of `--repeat` fit
+times, and the final cost of each, and the totals across the cases.
+"""
+import argparse
+import json
+import sys
+from collections import OrderedDict
+import numpy as np
+from benchmarks import datasets
+from benchmarks.run import time_call
+
+PERIOD_BOUNDS = (20.0, 28.0)
+
+
+def bounds_cases(lsq):
+    lower, upper = [list(bound) for bound in lsq.DEFAULT_BOUNDS]
+    lower[3], upper[3] = PERIOD_BOUNDS
+    return [("unbounded", lsq.DEFAULT_BOUNDS), ("bounded", (lower, upper))]
+
+
+def fit(lsq, dataset, bounds, strategy, repeat, budget):
+    """Fit stats of one strategy: nfev, njev, cost, status and timings."""
+    def solve(_):
+        return lsq.solve(dataset.time, dataset.data, lsq.DEFAULT_INITIAL_PARAMS_GUESS, "linear", bounds,
+                          lsq.DEFAULT_MAX_NFEV, strategy=strategy)
+    result = solve(None)
+    stats = time_call(solve, None, repeat, budget)
+    stats.update(method=strategy.method, nfev=int(result.nfev), njev=int(result.njev or 0), cost=float(result.cost),
+                 status=int(result.status))
+    return stats
+
+
+def run(cases, repeat, budget, log=sys.stderr):
+    """Returns an ordered dict of "<bounds>/<case>" -> {"scipy": stats, "auto": stats}."""
+    from ski_stats import solver
+    from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+    results = OrderedDict()
+    for bounds_name, bounds in bounds_cases(lsq):
+        for dataset in cases:
+            key = "{0}/{1}".format(bounds_name, dataset.name)
+            chosen = solver.choose(bounds, lsq.DEFAULT_INITIAL_PARAMS_GUESS, dataset.size)
+            results[key] = {"scipy": fit(lsq, dataset, bounds, solver.SCIPY_DEFAULT, repeat, budget),
+                            "auto": fit(lsq, dataset, bounds, chosen, repeat, budget)}
+            log.write("{0:<60} {1}\n".format(key, _format_row(results[key])))
+    return results
+
+
+def _format_row(row):
+    scipy, auto = row["scipy"], row["auto"]
+    return "nfev {0:6d} -> {1:6d} ({2:>6}), {3:9.5f}s -> {4:9.5f}s ({5:6.1f}x), cost ratio {6:.6f}".format(
+        scipy["nfev"], auto["nfev"], auto["method"], scipy["min"], auto["min"], scipy["min"] / auto["min"],
+        auto["cost"] / scipy["cost"] if scipy["cost"] else float("nan"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the chosen solver strategy against SciPy's defaults.")
+    parser.add_argument("--quick", action="store_true", help="only the small sizes")
+    parser.add_argument("--case", help="only run cases whose name contains this substring")
+    parser.add_argument("--repeat", type=int, default=5, help="timed fits per strategy/case")
+    parser.add_argument("--budget", type=float, default=5.0, help="max seconds of timed fits per strategy/case")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args(argv)
+
+    cases = datasets.synthetic_cases(datasets.QUICK_SIZES if args.quick else datasets.SIZES)
+    cases += datasets.workbook_cases()
+    if args.case:
+        cases = [dataset for dataset in cases if args.case in dataset.name]
+
+    results = run(cases, args.repeat, args.budget)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    print "\n{0:<12} {1:>10} {2:>10} {3:>12} {4:>12} {5:>10}".format(
+        "bounds", "nfev", "nfev auto", "seconds", "seconds auto", "speedup")
+    for bounds_name in OrderedDict.fromkeys(key.partition("/")[0] for key in results):
+        rows = [row for key, row in results.items() if key.startswith(bounds_name + "/")]
+        totals = [sum(row[strategy][field] for row in rows) for strategy, field
+                  in (("scipy", "nfev"), ("auto", "nfev"), ("scipy", "min"), ("auto", "min"))]
+        print "{0:<12} {1:10d} {2:10d} {3:12.4f} {4:12.4f} {5:9.1f}x".format(
+            bounds_name, totals[0], totals[1], totals[2], totals[3], totals[2] / totals[3])
+        print "{0:<12} median speedup per case {1:.2f}x".format(
+            "", float(np.median([row["scipy"]["min"] / row["auto"]["min"] for row in rows])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
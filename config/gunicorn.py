@@ -16,6 +16,9 @@
 #       range.
 #
 
+import multiprocessing
+import os
+
 bind = '0.0.0.0:8000'
 backlog = 2048
 
@@ -69,6 +72,186 @@ worker_connections = 1000
 timeout = 240
 keepalive = 2
 
+#
+#   preload_app - Load the application code in the master process before
+#       forking the workers.  Modules imported by the master (including
+#       those imported by the `when_ready` hook below) are then shared
+#       with the workers through copy-on-write, rather than each worker
+#       importing its own copy.
+#
+#       Note that code changes are not picked up by a HUP reload while
+#       this is set; restart the service instead.
+#
+#       True or False
+#
+#   warm_up - Not a Gunicorn setting.  If True, each worker runs one
+#       synthetic curve fit and plot render in `post_fork`, before it
+#       accepts any traffic.
+#
+#       True or False
+#
+
+preload_app = True
+warm_up = True
+
+#
+#   compute_pool - Not a Gunicorn setting.  If True, HTTP requests are
+#       handled by threaded workers, and the CPU-bound curve fitting and
+#       plot rendering are dispatched to a pool of compute processes
+#       owned by each worker.  The pool size is exported to the app as
+#       SKI_STATS_COMPUTE_PROCESSES.  Large arrays (e.g. uploaded
+#       recordings) are handed to the pool through scratch files in
+#       SKI_STATS_COMPUTE_SCRATCH_DIR (default: under /dev/shm), which
+#       should be on a RAM-backed filesystem.  Requests give up on a
+#       compute task with 503 after `timeout` seconds (exported as
+#       SKI_STATS_COMPUTE_TIMEOUT), as threaded workers aren't killed
+#       for running long.
+#
+#       True or False
+#
+#   compute_processes - The total number of compute processes, split
+#       evenly across the workers.
+#
+#       A positive integer, generally the number of cores.
+#
+#   compute_blas_threads - Caps the BLAS/OpenMP threads of every process,
+#       so that the compute processes don't oversubscribe the cores.
+#       Must be exported before NumPy is first imported.
+#
+#       A positive integer.
+#
+#   compute_threads - Threads per worker (Gunicorn's `threads`) when
+#       compute_pool is on.  Only set then, as Gunicorn runs sync
+#       workers with more than one thread as threaded workers, which
+#       would render plots concurrently in one process (pyplot isn't
+#       thread-safe).
+#
+#       A positive integer.
+#
+
+compute_pool = False
+compute_processes = multiprocessing.cpu_count()
+compute_blas_threads = 1
+compute_threads = 8
+
+if compute_pool:
+    worker_class = 'gthread'
+    threads = compute_threads
+    os.environ.setdefault('SKI_STATS_COMPUTE_PROCESSES', str(max(1, compute_processes // workers)))
+    os.environ.setdefault('SKI_STATS_COMPUTE_TIMEOUT', str(timeout))
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                'NUMEXPR_NUM_THREADS'):
+        os.environ.setdefault(var, str(compute_blas_threads))
+
+#
+#   prometheus_multiproc_dir - Not a Gunicorn setting.  A directory where
+#       each worker writes its Prometheus samples, so that `/metrics`
+#       reports totals across all workers.  Wiped when the server starts.
+#       Exported to the environment here because it must be set before
+#       `prometheus_client` is first imported.
+#
+#       A path string, or None to keep per-worker metrics.
+#
+
+prometheus_multiproc_dir = '/run/gunicorn/prometheus'
+if prometheus_multiproc_dir:
+    prometheus_multiproc_dir = os.environ.setdefault('prometheus_multiproc_dir', prometheus_multiproc_dir)
+    if not os.path.isdir(prometheus_multiproc_dir):
+        os.makedirs(prometheus_multiproc_dir)
+
+#
+#   admission_dir - Not a Gunicorn setting.  A directory of lock files
+#       through which the workers share the admission budget for
+#       expensive requests (see `ski_stats.admission`).  Wiped when the
+#       server starts.
+#
+#       A path string, or None to disable admission control.
+#
+#   admission_slots - How many expensive requests may run at once across
+#       all workers.  With sync workers, the run and queue slots together
+#       must leave at least one worker free for cheap requests.
+#
+#       A positive integer.
+#
+#   admission_queue - How many more expensive requests may wait for a
+#       run slot, or for an identical request's response (see
+#       `ski_stats.coalesce`); requests beyond that get 503 with
+#       Retry-After.
+#
+#       A non-negative integer.
+#
+#   admission_client_slots - How many expensive requests (running or
+#       waiting) each client may have; requests beyond that get 429 with
+#       Retry-After.
+#
+#       A positive integer.
+#
+
+admission_dir = '/run/gunicorn/admission'
+if compute_pool:
+    admission_slots = compute_processes
+    admission_queue = workers * compute_threads // 2
+else:
+    admission_slots = max(1, (workers - 1) // 2)
+    admission_queue = max(0, workers - 1 - admission_slots)
+admission_client_slots = 1
+
+if admission_dir:
+    admission_dir = os.environ.setdefault('SKI_STATS_ADMISSION_DIR', admission_dir)
+    os.environ.setdefault('SKI_STATS_ADMISSION_SLOTS', str(admission_slots))
+    os.environ.setdefault('SKI_STATS_ADMISSION_QUEUE', str(admission_queue))
+    os.environ.setdefault('SKI_STATS_ADMISSION_CLIENT_SLOTS', str(admission_client_slots))
+    if not os.path.isdir(admission_dir):
+        os.makedirs(admission_dir)
+
+#
+#   coalesce_dir - Not a Gunicorn setting.  A directory of lock files
+#       and responses through which identical concurrent analysis
+#       requests share one computation across all workers (see
+#       `ski_stats.coalesce`).  Wiped when the server starts.
+#
+#       A path string.
+#
+
+coalesce_dir = os.environ.setdefault('SKI_STATS_COALESCE_DIR', '/run/gunicorn/coalesce')
+if not os.path.isdir(coalesce_dir):
+    os.makedirs(coalesce_dir)
+
+#
+#   dataset_dir - Not a Gunicorn setting.  A directory of parsed uploads,
+#       shared by all workers, that repeat fits refer to by token
+#       instead of sending the data again (see `ski_stats.datastore`).
+#       Kept across reloads (HUP), and otherwise left to expire on their
+#       own, but /run/gunicorn is the unit's RuntimeDirectory, which
+#       systemd removes when the service stops: a restart drops every
+#       dataset, and clients send their data again on the 404s.
+#
+#       A path string.
+#
+#   dataset_max_bytes - How much the stored datasets may take up
+#       together; the least recently used are removed beyond that.  The
+#       directory is in memory under /run, so keep this modest.
+#
+#       A positive integer.
+#
+
+dataset_dir = os.environ.setdefault('SKI_STATS_DATASET_DIR', '/run/gunicorn/datasets')
+dataset_max_bytes = 256 * 1024 * 1024
+os.environ.setdefault('SKI_STATS_DATASET_MAX_BYTES', str(dataset_max_bytes))
+if not os.path.isdir(dataset_dir):
+    os.makedirs(dataset_dir)
+
+#
+#   max_upload_bytes - Not a Gunicorn setting.  Requests with a larger
+#       body get 413 before any of it is read.  Uploads over 1MB are
+#       spooled to temporary files under $TMPDIR while they're parsed.
+#
+#       A positive integer, or 0 for no limit.
+#
+
+max_upload_bytes = 256 * 1024 * 1024
+os.environ.setdefault('SKI_STATS_MAX_UPLOAD_BYTES', str(max_upload_bytes))
+
 #
 #   spew - Install a trace function that spews every line of Python
 #       that is executed when running the server. This is the
@@ -181,8 +364,36 @@ proc_name = None
 #       A callable that takes a server instance as the sole argument.
 #
 
+def on_starting(server):
+    import glob
+    if prometheus_multiproc_dir:
+        # discard samples left over from a previous run
+        for path in glob.glob(os.path.join(prometheus_multiproc_dir, '*.db')):
+            os.remove(path)
+    if admission_dir:
+        # lock files left over from a previous run (no process holds them now)
+        for path in glob.glob(os.path.join(admission_dir, '*.lock')):
+            os.remove(path)
+    # lock files and responses of requests from a previous run
+    for path in glob.glob(os.path.join(coalesce_dir, '*')):
+        os.remove(path)
+
+def child_exit(server, worker):
+    from ski_stats.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
 def post_fork(server, worker):
     server.log.info("Worker spawned (pid: %s)", worker.pid)
+    if warm_up:
+        import time
+        from ski_stats.warmup import warm_up as run_warm_up
+        start = time.time()
+        run_warm_up()
+        server.log.info("Worker warmed up in %.3fs (pid: %s)", time.time() - start, worker.pid)
+    if compute_pool:
+        from ski_stats import compute
+        compute.start()
+        server.log.info("Started %d compute processes (pid: %s)", compute.pool_size(), worker.pid)
 
 def pre_fork(server, worker):
     pass
@@ -191,6 +402,12 @@ def pre_exec(server):
     server.log.info("Forked child, re-executing.")
 
 def when_ready(server):
+    if preload_app:
+        import time
+        from ski_stats.warmup import import_heavy_modules
+        start = time.time()
+        import_heavy_modules()
+        server.log.info("Preloaded heavy modules in %.3fs", time.time() - start)
     server.log.info("Server is ready. Spawning workers")
 
 def worker_int(worker):
@@ -208,6 +425,11 @@ def worker_int(worker):
             code.append("  %s" % (line.strip()))
             worker.log.debug("\n".join(code))
 
+def worker_exit(server, worker):
+    if compute_pool:
+        from ski_stats import compute
+        compute.shutdown()
+
 def worker_abort(worker):
     worker.log.info("worker received SIGABRT signal")
 
@@ -1,22 +1,62 @@
+import os
+import tempfile
 from flask import Flask
-import pkgutil
 import ski_stats.scripts
+from ski_stats.registry import AnalysisRegistry
 
 app = Flask(__name__)
 app.config["WTF_CSRF_ENABLED"] = False
 
-# load the analysis modules
-analyses = []
-for index, (importer, modname, ispkg) in enumerate(pkgutil.walk_packages(path=ski_stats.scripts.__path__, onerror=lambda x: None)):
-    if not ispkg:
-        print "[{0}] Found analysis module \"{1}\"".format(index, modname)
-        module = importer.find_module(modname).load_module(modname)
+# uploads (see `ski_stats.uploads`): those of larger requests are spooled to temporary files rather than held in memory,
+# and requests larger than the limit are refused before their body is read; a limit of 0 turns it off
+app.config["UPLOAD_SPOOL_BYTES"] = int(os.environ.get("SKI_STATS_UPLOAD_SPOOL_BYTES", 1024 ** 2))
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("SKI_STATS_MAX_UPLOAD_BYTES", 256 * 1024 ** 2)) or None
 
-        # load script if defines these two functions
-        if hasattr(module, "get_html_form") and hasattr(module.get_html_form, "__call__") \
-                and hasattr(module, "html_form_submitted") and hasattr(module.html_form_submitted, "__call__"):
-            analyses.append({"id": index, "name": modname, "module": module})
+# per-request profiling (see `ski_stats.profiling`); disabled unless a token or sample rate is set
+app.config["PROFILE_TOKEN"] = os.environ.get("SKI_STATS_PROFILE_TOKEN")
+app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("SKI_STATS_PROFILE_SAMPLE_RATE", 0))
+app.config["PROFILE_DIR"] = os.path.join(os.path.dirname(app.root_path), "logs", "profiles")
+
+# size of each worker's compute pool (see `ski_stats.compute`); 0 runs fits and renders inline
+app.config["COMPUTE_PROCESSES"] = int(os.environ.get("SKI_STATS_COMPUTE_PROCESSES", 0))
+# the longest a request waits on a compute task before giving up with 503
+app.config["COMPUTE_TIMEOUT"] = float(os.environ.get("SKI_STATS_COMPUTE_TIMEOUT", 240))
+
+# scratch files through which large arrays are handed to the compute pool (see `ski_stats.scratch`); shared memory, so
+# that they never reach a disk, where the host has it
+app.config["COMPUTE_SCRATCH_DIR"] = os.environ.get(
+    "SKI_STATS_COMPUTE_SCRATCH_DIR",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "ski-stats-scratch"))
+
+# admission control for expensive requests (see `ski_stats.admission`); disabled when there are 0 slots
+app.config["ADMISSION_SLOTS"] = int(os.environ.get("SKI_STATS_ADMISSION_SLOTS", 0))
+app.config["ADMISSION_QUEUE"] = int(os.environ.get("SKI_STATS_ADMISSION_QUEUE", 0))
+app.config["ADMISSION_CLIENT_SLOTS"] = int(os.environ.get("SKI_STATS_ADMISSION_CLIENT_SLOTS", 1))
+app.config["ADMISSION_MAX_WAIT"] = float(os.environ.get("SKI_STATS_ADMISSION_MAX_WAIT", 10))
+app.config["ADMISSION_HEAVY_SECONDS"] = float(os.environ.get("SKI_STATS_ADMISSION_HEAVY_SECONDS", 1))
+app.config["ADMISSION_DIR"] = os.environ.get("SKI_STATS_ADMISSION_DIR",
+                                             os.path.join(tempfile.gettempdir(), "ski-stats-admission"))
+
+# coalescing of identical concurrent analysis requests (see `ski_stats.coalesce`); disabled when the wait is 0
+app.config["COALESCE_MAX_WAIT"] = float(os.environ.get("SKI_STATS_COALESCE_MAX_WAIT", 120))
+app.config["COALESCE_DIR"] = os.environ.get("SKI_STATS_COALESCE_DIR",
+                                            os.path.join(tempfile.gettempdir(), "ski-stats-coalesce"))
+
+# parsed uploads kept for repeat fits (see `ski_stats.datastore`); disabled when the TTL is 0
+app.config["DATASET_TTL"] = float(os.environ.get("SKI_STATS_DATASET_TTL", 3600))
+app.config["DATASET_MAX_BYTES"] = int(os.environ.get("SKI_STATS_DATASET_MAX_BYTES", 256 * 1024 ** 2))
+app.config["DATASET_DIR"] = os.environ.get("SKI_STATS_DATASET_DIR",
+                                           os.path.join(tempfile.gettempdir(), "ski-stats-datasets"))
+
+# progress snapshots and cancellation flags of followed fits (see `ski_stats.progress`), shared by all workers
+app.config["FIT_JOBS_DIR"] = os.environ.get("SKI_STATS_FIT_JOBS_DIR",
+                                            os.path.join(tempfile.gettempdir(), "ski-stats-fits"))
+
+from ski_stats.uploads import SpoolingRequest
+app.request_class = SpoolingRequest
+
+# index the analysis modules; each is imported on first use
+analyses = AnalysisRegistry(ski_stats.scripts)
 
 # load the HTTP routes
 import ski_stats.views
-
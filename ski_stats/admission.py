@@ -0,0 +1,169 @@
+import errno
+import fcntl
+import hashlib
+import math
+import os
+import random
+import time
+from contextlib import contextmanager
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+from ski_stats import app, metrics
+from ski_stats.common import ensure_dir
+
+# Admission control for expensive requests.  A request's cost is estimated from its point count and `max_nfev` before
+# any work is done; requests estimated above `ADMISSION_HEAVY_SECONDS` must hold one of `ADMISSION_SLOTS` run slots,
+# which are shared by every worker on the host as `flock`ed files in `ADMISSION_DIR` (the kernel releases a dead
+# worker's locks).  A heavy request that finds every slot taken waits in one of `ADMISSION_QUEUE` queue slots for up to
+# `ADMISSION_MAX_WAIT` seconds, and is rejected with 503 if the queue is full or the wait runs out.  Each client may
+# hold at most `ADMISSION_CLIENT_SLOTS` heavy requests (running or queued) and gets 429 beyond that, so that one client
+# cannot fill the queue.  Clients are hashed into `CLIENT_BUCKETS` buckets, so that the number of lock files stays fixed
+# however many clients there are; clients that share a bucket share its slots.  Light requests are never held up.
+# Disabled when `ADMISSION_SLOTS` is 0.
+
+# per-stage costs, measured with `benchmarks.run`; only used to rank requests, so they needn't be exact
+FIT_SECONDS_PER_POINT_EVAL = 2e-7
+POSTFIT_SECONDS_PER_POINT_SQUARED = 1.5e-9
+RENDER_SECONDS = 0.3
+# a fit rarely takes more evaluations than this, whatever `max_nfev` allows
+EXPECTED_NFEV = 200
+# typical size of an uploaded xlsx row, for estimating point counts before the upload is parsed
+XLSX_BYTES_PER_ROW = 22
+
+POLL_SECONDS = 0.05
+# enough that concurrent heavy clients rarely share a bucket
+CLIENT_BUCKETS = 1024
+MAX_RETRY_AFTER = 60
+
+
+class Rejected(object):
+    """Mixin for the rejection errors; `retry_after` is sent as the `Retry-After` header."""
+    def __init__(self, description, retry_after):
+        super(Rejected, self).__init__(description)
+        self.retry_after = retry_after
+
+
+class ClientBusy(Rejected, TooManyRequests):
+    pass
+
+
+class Overloaded(Rejected, ServiceUnavailable):
+    pass
+
+
+def estimate_seconds(points, max_nfev, post_fit=False, render=False):
+    """Rough cost of fitting (and optionally post-processing and plotting) `points` points."""
+    seconds = points * min(max_nfev, EXPECTED_NFEV) * FIT_SECONDS_PER_POINT_EVAL
+    if post_fit:
+        # the crossing search is quadratic in the number of points
+        seconds += points ** 2 * POSTFIT_SECONDS_PER_POINT_SQUARED
+    if render:
+        seconds += RENDER_SECONDS
+    return seconds
+
+
+def is_enabled():
+    return app.config["ADMISSION_SLOTS"] > 0
+
+
+@contextmanager
+def admit(client, seconds):
+    """Run the body once the request is admitted.  Raises `ClientBusy` or `Overloaded` if it isn't."""
+    if not is_enabled() or seconds < app.config["ADMISSION_HEAVY_SECONDS"]:
+        yield
+        return
+
+    retry_after = int(min(MAX_RETRY_AFTER, max(1, math.ceil(seconds))))
+    client_lock = _acquire_any(_client_paths(client))
+    if client_lock is None:
+        metrics.ADMISSION_REJECTED.labels(reason="client").inc()
+        raise ClientBusy("Too many expensive requests in progress for this client.", retry_after)
+    try:
+        slot = _acquire_slot(retry_after)
+        try:
+            metrics.HEAVY_IN_PROGRESS.inc()
+            yield
+        finally:
+            metrics.HEAVY_IN_PROGRESS.dec()
+            _release(slot)
+    finally:
+        _release(client_lock)
+
+
+@contextmanager
+def queued():
+    """Hold one of the queue slots while waiting on something other than a run slot, e.g. an identical request's
+    response (see `ski_stats.coalesce`), so that waiting requests can't take up more workers than the queue allows.
+    Yields False, without waiting, if the queue is full.  Always yields True when admission control is disabled."""
+    if not is_enabled():
+        yield True
+        return
+    queue_lock = _acquire_any(_paths("queue", app.config["ADMISSION_QUEUE"]))
+    if queue_lock is None:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        _release(queue_lock)
+
+
+def max_wait():
+    """The longest a request may wait in a queue slot; None when admission control is disabled."""
+    return app.config["ADMISSION_MAX_WAIT"] if is_enabled() else None
+
+
+def _acquire_slot(retry_after):
+    slot_paths = _paths("slot", app.config["ADMISSION_SLOTS"])
+    slot = _acquire_any(slot_paths)
+    if slot is not None:
+        metrics.ADMISSION_WAIT_SECONDS.observe(0)
+        return slot
+
+    queue_lock = _acquire_any(_paths("queue", app.config["ADMISSION_QUEUE"]))
+    if queue_lock is None:
+        metrics.ADMISSION_REJECTED.labels(reason="queue_full").inc()
+        raise Overloaded("The server is busy with other expensive requests.", retry_after)
+    try:
+        start = time.time()
+        deadline = start + app.config["ADMISSION_MAX_WAIT"]
+        while slot is None and time.time() < deadline:
+            # jitter the polls so that waiting workers don't wake in lockstep
+            time.sleep(POLL_SECONDS * random.uniform(0.5, 1.5))
+            slot = _acquire_any(slot_paths)
+    finally:
+        _release(queue_lock)
+    if slot is None:
+        metrics.ADMISSION_REJECTED.labels(reason="timeout").inc()
+        raise Overloaded("Timed out waiting for other expensive requests to finish.", retry_after)
+    metrics.ADMISSION_WAIT_SECONDS.observe(time.time() - start)
+    return slot
+
+
+def _paths(kind, count):
+    directory = ensure_dir(app.config["ADMISSION_DIR"])
+    return [os.path.join(directory, "{0}-{1}.lock".format(kind, i)) for i in range(count)]
+
+
+def _client_paths(client):
+    # hashed, so that any client identifier makes a safe filename, and only `CLIENT_BUCKETS` names are ever used
+    bucket = int(hashlib.sha1(client or "unknown").hexdigest()[:8], 16) % CLIENT_BUCKETS
+    return _paths("client-{0}".format(bucket), app.config["ADMISSION_CLIENT_SLOTS"])
+
+
+def _acquire_any(paths):
+    """Lock the first free file in `paths`; returns the open file, or None if all are locked."""
+    for path in paths:
+        f = open(path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+        except IOError as err:
+            f.close()
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+    return None
+
+
+def _release(f):
+    # closing the file drops the lock
+    f.close()
@@ -0,0 +1,260 @@
+import numpy as np
+from werkzeug.exceptions import BadRequest
+from ski_stats import compute, datastore, export, solver
+from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+
+# Decoding, validation and dispatch of batch fit requests (`/api/fit`).  Arrays are decoded into NumPy in one call per
+# array and validated with vectorized checks; the element-by-element path only runs to locate bad values for the
+# error message.
+
+PARAM_NAMES = ("h", "b", "v", "p")
+BINARY_DTYPES = {"float64": "<f8", "float32": "<f4"}
+MIN_POINTS = len(PARAM_NAMES)
+MAX_REPORTED_INDICES = 10
+# JSON booleans, and their query arg spellings
+AUTO_PERIOD_VALUES = {True: True, False: False, "true": True, "false": False, "1": True, "0": False}
+
+
+class Series(object):
+    """A (time, data) pair to be fitted."""
+    def __init__(self, time, data):
+        self.time = time
+        self.data = data
+
+
+def to_float_array(values, name):
+    """Convert a JSON list of numbers to a float64 array.  Raises BadRequest listing the offending indices."""
+    try:
+        if isinstance(values, list) and bool in set(map(type, values)):
+            # NumPy would take true and false for 1 and 0
+            raise TypeError()
+        array = np.array(values, dtype=float)
+    except (ValueError, TypeError):
+        bad = [i for i, value in enumerate(values) if not _is_number(value)]
+        raise BadRequest("\"{0}\" has non-numeric values at indices {1}".format(name, _format_indices(bad)))
+    if array.ndim != 1:
+        raise BadRequest("\"{0}\" must be a flat list of numbers.".format(name))
+    return array
+
+
+def validate_series(name, time, data):
+    """Vectorized checks of a decoded series."""
+    if time.size != data.size:
+        raise BadRequest("\"{0}\" has {1} x values but {2} y values.".format(name, time.size, data.size))
+    if time.size < MIN_POINTS:
+        raise BadRequest("\"{0}\" needs at least {1} points.".format(name, MIN_POINTS))
+    for axis, values in (("x", time), ("y", data)):
+        bad = np.flatnonzero(~np.isfinite(values))
+        if bad.size:
+            raise BadRequest("\"{0}.{1}\" has non-finite values at indices {2}".format(
+                name, axis, _format_indices(bad.tolist())))
+    return Series(time, data)
+
+
+def decode_json(payload):
+    """Decode a JSON fit request.  Returns (series_list, options).
+
+    {"series": [{"x": [...], "y": [...]}, ...],    (or a single series as top-level "x" and "y"; a series may be
+                                                    {"dataset": token} of a stored upload, see `ski_stats.datastore`)
+     "params": {"h": 700, "b": 200, "v": 0, "p": 24},
+     "bounds": {"h": ["-inf", "inf"], ...},
+     "max_nfev": 10000,
+     "auto_period": true,                          (seed the period from a periodogram; see `lsq.seed_period`)
+     "method": "auto"}                             (the solver method; see `ski_stats.solver`)
+    """
+    if not isinstance(payload, dict):
+        raise BadRequest("Request body must be a JSON object.")
+    raw_series = payload.get("series")
+    if raw_series is None:
+        raw_series = [payload]
+    if not isinstance(raw_series, list) or not raw_series:
+        raise BadRequest("\"series\" must be a non-empty list.")
+
+    series = []
+    for i, item in enumerate(raw_series):
+        name = "series[{0}]".format(i)
+        if isinstance(item, dict) and "dataset" in item:
+            time, data = datastore.require(item["dataset"])
+        elif not isinstance(item, dict) or "x" not in item or "y" not in item:
+            raise BadRequest("\"{0}\" must have \"x\" and \"y\" lists.".format(name))
+        else:
+            time = to_float_array(item["x"], name + ".x")
+            data = to_float_array(item["y"], name + ".y")
+        series.append(validate_series(name, time, data))
+    return series, decode_options(payload.get("params"), payload.get("bounds"), payload.get("max_nfev"),
+                                  payload.get("auto_period"), payload.get("method"))
+
+
+def decode_binary(body, args):
+    """Decode a binary fit request: little-endian floats, each series as its x values followed by its y values.
+
+    Query args: `lengths` (comma-separated point counts per series; default: one series), `dtype` (float64 or float32),
+    the params as `h`, `b`, `v`, `p`, the bounds as `h_lower`, `h_upper`, etc., `max_nfev`, `auto_period` and `method`.
+    With `dataset` (the token of a stored upload, see `ski_stats.datastore`), that is the one series, and the body is
+    ignored.
+    """
+    if "dataset" in args:
+        time, data = datastore.require(args["dataset"])
+        return [validate_series("dataset", time, data)], decode_query_options(args)
+
+    dtype = binary_dtype(args.get("dtype", "float64"))
+    itemsize = np.dtype(dtype).itemsize
+    if len(body) % itemsize:
+        raise BadRequest("Body length is not a multiple of {0} bytes.".format(itemsize))
+    values = np.frombuffer(body, dtype=dtype).astype(float)
+
+    if "lengths" in args:
+        try:
+            lengths = [int(length) for length in args["lengths"].split(",")]
+        except ValueError:
+            raise BadRequest("\"lengths\" must be a comma-separated list of integers.")
+    else:
+        lengths = [values.size // 2]
+    if any(length < 0 for length in lengths) or 2 * sum(lengths) != values.size:
+        raise BadRequest("\"lengths\" account for {0} values but the body holds {1}.".format(
+            2 * sum(lengths), values.size))
+
+    series = []
+    offset = 0
+    for i, length in enumerate(lengths):
+        time = values[offset:offset + length]
+        data = values[offset + length:offset + 2 * length]
+        offset += 2 * length
+        series.append(validate_series("series[{0}]".format(i), time, data))
+    return series, decode_query_options(args)
+
+
+def decode_query_options(args):
+    """The fit options of a binary fit request's query args; see `decode_binary`."""
+    params = {name: args[name] for name in PARAM_NAMES if name in args} or None
+    bounds = {name: [args.get(name + "_lower", "-inf"), args.get(name + "_upper", "inf")] for name in PARAM_NAMES
+              if name + "_lower" in args or name + "_upper" in args} or None
+    return decode_options(params, bounds, args.get("max_nfev"), args.get("auto_period"), args.get("method"))
+
+
+def binary_dtype(name):
+    """The little-endian NumPy dtype for a `dtype` query arg."""
+    dtype = BINARY_DTYPES.get(name)
+    if dtype is None:
+        raise BadRequest("\"dtype\" must be one of: " + ", ".join(sorted(BINARY_DTYPES)))
+    return dtype
+
+
+def encode_binary(columns, dtype="<f8"):
+    """The inverse of `decode_binary` for a single series: the columns' values, one column after another."""
+    return b"".join(np.ascontiguousarray(column, dtype=dtype).tobytes() for column in columns)
+
+
+def decode_options(params, bounds, max_nfev, auto_period=None, method=None):
+    """Returns the fit options, filling in the script defaults."""
+    params_guess = list(lsq.DEFAULT_INITIAL_PARAMS_GUESS)
+    if params is not None:
+        if not isinstance(params, dict):
+            raise BadRequest("\"params\" must map param names to initial values.")
+        for i, name in enumerate(PARAM_NAMES):
+            if name in params:
+                params_guess[i] = _to_float(params[name], "params." + name)
+
+    lower, upper = [list(bound) for bound in lsq.DEFAULT_BOUNDS]
+    if bounds is not None:
+        if not isinstance(bounds, dict):
+            raise BadRequest("\"bounds\" must map param names to [lower, upper] pairs.")
+        for i, name in enumerate(PARAM_NAMES):
+            if name in bounds:
+                pair = bounds[name]
+                if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+                    raise BadRequest("\"bounds.{0}\" must be a [lower, upper] pair.".format(name))
+                lower[i] = _to_float(pair[0], "bounds.{0}[0]".format(name))
+                upper[i] = _to_float(pair[1], "bounds.{0}[1]".format(name))
+                if not lower[i] < upper[i]:
+                    raise BadRequest("\"bounds.{0}\": lower bound must be less than upper bound.".format(name))
+
+    if max_nfev is None:
+        max_nfev = lsq.DEFAULT_MAX_NFEV
+    else:
+        max_nfev = _to_float(max_nfev, "max_nfev")
+        if max_nfev != int(max_nfev) or not 1 <= max_nfev <= lsq.DEFAULT_MAX_NFEV:
+            raise BadRequest("\"max_nfev\" must be an integer from 1 to {0}.".format(lsq.DEFAULT_MAX_NFEV))
+        max_nfev = int(max_nfev)
+
+    if isinstance(auto_period, (bool, basestring)) and auto_period in AUTO_PERIOD_VALUES:
+        auto_period = AUTO_PERIOD_VALUES[auto_period]
+    elif auto_period is not None:
+        raise BadRequest("\"auto_period\" must be true or false.")
+
+    if method is None:
+        method = solver.AUTO
+    elif method not in solver.METHODS:
+        raise BadRequest("\"method\" must be one of: " + ", ".join(solver.METHODS))
+    elif method == "lm" and (auto_period or not solver.is_unbounded((lower, upper))):
+        raise BadRequest("The \"lm\" method doesn't support bounds (which \"auto_period\" sets on the period).")
+
+    # the solver rejects guesses outside the bounds, and the model can't be evaluated at a period of 0
+    for i, name in enumerate(PARAM_NAMES):
+        if name == "p" and auto_period:
+            # replaced by the periodogram's, within the bounds
+            continue
+        if not np.isfinite(params_guess[i]):
+            raise BadRequest("\"params.{0}\" must be a finite number.".format(name))
+        if name == "p" and params_guess[i] == 0:
+            raise BadRequest("\"params.p\" must not be 0.")
+        if not lower[i] <= params_guess[i] <= upper[i]:
+            raise BadRequest("\"params.{0}\" ({1:g}) is outside its bounds [{2:g}, {3:g}].".format(
+                name, params_guess[i], lower[i], upper[i]))
+    return {"params_guess": params_guess, "bounds": (lower, upper), "max_nfev": max_nfev,
+            "auto_period": bool(auto_period), "method": method}
+
+
+def fit_batch(series, params_guess, bounds, max_nfev, auto_period=False, method=solver.AUTO):
+    """Fit every series, in parallel across the compute pool if enabled.  Returns a result dict per series, with
+    values that aren't finite (e.g. the r of a constant series) as None, since JSON has no NaN or infinity."""
+    results = compute.run_many(lsq.fit_series, [(item.time, item.data, params_guess, bounds, max_nfev, auto_period,
+                                                 method) for item in series])
+    return [{key: _finite_or_none(value) for key, value in result.items()} for result in results]
+
+
+def export_batch(series, params_guess, bounds, max_nfev, auto_period=False, method=solver.AUTO):
+    """As `fit_batch`, but each result is written to an .xlsx workbook as it arrives (see `ski_stats.export`).  Returns
+    the workbook as an open temporary file."""
+    named_series = (("series[{0}]".format(i), item.time, item.data) for i, item in enumerate(series))
+    return export.export_to_tempfile(named_series, _fit_row, (params_guess, bounds, max_nfev, auto_period, method))
+
+
+def _fit_row(time, data, *args):
+    # runs in the compute pool
+    return export.row_from_fit(lsq.fit_series(time, data, *args))
+
+
+def _to_float(value, name):
+    """A JSON number, or one of the strings "inf", "+inf", "-inf" or a numeral."""
+    try:
+        number = float(value)
+    except (ValueError, TypeError):
+        raise BadRequest("Invalid value for \"{0}\" ({1}).  Expected: -inf, inf, or a numerical value.".format(
+            name, value))
+    if np.isnan(number):
+        raise BadRequest("Invalid value for \"{0}\" (nan).".format(name))
+    return number
+
+
+def _finite_or_none(value):
+    if isinstance(value, list):
+        return [_finite_or_none(item) for item in value]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def _is_number(value):
+    try:
+        float(value)
+        return not isinstance(value, bool)
+    except (ValueError, TypeError):
+        return False
+
+
+def _format_indices(indices):
+    shown = ", ".join(str(i) for i in indices[:MAX_REPORTED_INDICES])
+    if len(indices) > MAX_REPORTED_INDICES:
+        shown += ", ... ({0} total)".format(len(indices))
+    return "[{0}]".format(shown)
@@ -0,0 +1,199 @@
+import errno
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import random
+import time
+from flask import request, Response
+from ski_stats import app, admission, metrics, progress
+from ski_stats.common import ensure_dir, sweep, atomic_write
+
+# Coalescing of identical analysis requests.  A burst of identical submissions (say, a room full of people trying the
+# example spreadsheet at once) costs one computation: the request's inputs are hashed, and the first request with a
+# given digest runs the view while holding an `flock`ed `<digest>.lock` in `COALESCE_DIR`, shared by every worker on the
+# host.  Requests with the same digest that arrive while it runs wait for the lock, for up to `COALESCE_MAX_WAIT`
+# seconds, and are then answered with the response it left in `<digest>.response`.  Only responses finished after a
+# request arrived are shared, so nothing is cached beyond the burst.  If the first request failed without a response
+# (or its worker died), the next waiting request runs the view itself, and so on.  Disabled when `COALESCE_MAX_WAIT` is
+# 0, and for fits followed as Server-Sent Events, whose progress belongs to one client.
+#
+# Waiting holds a worker (or a thread of one) all the same, so with admission control enabled a waiting request takes
+# one of its queue slots, and waits no longer than `ADMISSION_MAX_WAIT` (see `ski_stats.admission`).  A request that
+# finds the queue full, or runs out of time, runs the view itself, under admission control as usual.
+
+POLL_SECONDS = 0.05
+# how often each process removes lock and response files left from earlier bursts, and how old they must be
+SWEEP_SECONDS = 60
+STALE_SECONDS = 60
+FORM_MIMETYPES = {"multipart/form-data", "application/x-www-form-urlencoded"}
+READ_CHUNK_BYTES = 1024 * 1024
+
+_last_sweep = [0.0]
+
+
+def is_enabled():
+    return app.config["COALESCE_MAX_WAIT"] > 0
+
+
+def request_digest():
+    """Hash of everything that determines the current request's response: the endpoint, query args, `Accept` header,
+    and the form fields and uploads or the raw body."""
+    digest = hashlib.sha256()
+    _update(digest, request.endpoint, request.method, request.headers.get("Accept", ""))
+    for name, value in sorted(request.args.items(multi=True)):
+        _update(digest, name, value)
+    if request.mimetype in FORM_MIMETYPES:
+        for name, value in sorted(request.form.items(multi=True)):
+            _update(digest, name, value)
+        for name, upload in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            _update(digest, name, upload.filename or "")
+            _update_from_stream(digest, upload.stream)
+    else:
+        _update(digest, request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def coalesced(view):
+    """View decorator.  Shares the response of the view among identical concurrent requests."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_enabled() or _is_followed():
+            return view(*args, **kwargs)
+
+        arrived = time.time()
+        paths = _paths(request_digest())
+        lock = _try_lock(paths[0])
+        if lock is None:
+            # an identical request is running; wait for it to finish
+            lock = _wait(paths[0], arrived)
+            if lock is None:
+                return view(*args, **kwargs)
+            response = _load(paths[1], arrived)
+            if response is not None:
+                lock.close()
+                metrics.COALESCED_REQUESTS.labels(role="follower").inc()
+                return response
+
+        # run the view, still holding the lock, so that identical requests wait for its response
+        try:
+            metrics.COALESCED_REQUESTS.labels(role="leader").inc()
+            response = app.make_response(view(*args, **kwargs))
+            _store(paths[1], response)
+            return response
+        finally:
+            # closing the file drops the lock
+            lock.close()
+            _maybe_sweep()
+    return wrapper
+
+
+def _wait(path, arrived):
+    # the lock at `path`, once the request holding it lets go; None if there's no queue slot to wait in, or the wait
+    # runs out
+    with admission.queued() as waiting:
+        if not waiting:
+            metrics.COALESCED_REQUESTS.labels(role="busy").inc()
+            return None
+        deadline = arrived + min(app.config["COALESCE_MAX_WAIT"], admission.max_wait() or float("inf"))
+        lock = None
+        while lock is None and time.time() < deadline:
+            # jitter the polls so that waiting requests don't wake in lockstep
+            time.sleep(POLL_SECONDS * random.uniform(0.5, 1.5))
+            lock = _try_lock(path)
+    metrics.COALESCE_WAIT_SECONDS.observe(time.time() - arrived)
+    if lock is None:
+        metrics.COALESCED_REQUESTS.labels(role="timeout").inc()
+    return lock
+
+
+def _is_followed():
+    # see `views.stream_fit`
+    return any(value == progress.EVENT_STREAM_MIMETYPE for value, quality in request.accept_mimetypes)
+
+
+def _update(digest, *values):
+    # length-prefixed, so that adjacent values can't run into each other
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        digest.update("{0:d}:".format(len(value)))
+        digest.update(value)
+
+
+def _update_from_stream(digest, stream):
+    size = 0
+    while True:
+        chunk = stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+    digest.update(":{0:d}".format(size))
+    # rewound for the view
+    stream.seek(0)
+
+
+def _paths(digest):
+    base = os.path.join(ensure_dir(app.config["COALESCE_DIR"]), digest)
+    return base + ".lock", base + ".response"
+
+
+def _try_lock(path):
+    """Lock the file at `path`; returns the open file, or None if another request holds it."""
+    f = open(path, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as err:
+        f.close()
+        if err.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return None
+    # marks the lock file as in use for `_sweep`
+    os.utime(path, None)
+    return f
+
+
+def _store(path, response):
+    """Write the response's status, headers and body, after a header line with the time it finished."""
+    response.direct_passthrough = False
+    body = response.get_data()
+    header = {"finished": time.time(), "status": response.status_code, "headers": response.headers.to_wsgi_list()}
+    with atomic_write(path) as f:
+        f.write(json.dumps(header) + "\n")
+        f.write(body)
+
+
+def _load(path, arrived):
+    """The response stored at `path`, or None if there's none that finished after `arrived`."""
+    try:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header["finished"] < arrived:
+                return None
+            body = f.read()
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+    return Response(body, status=header["status"], headers=[tuple(item) for item in header["headers"]])
+
+
+def _maybe_sweep():
+    now = time.time()
+    if now - _last_sweep[0] >= SWEEP_SECONDS:
+        _last_sweep[0] = now
+        sweep(app.config["COALESCE_DIR"], now - STALE_SECONDS, _remove_unlocked)
+
+
+def _remove_unlocked(path):
+    # a lock file is only removed while no request holds it (a request that opened it just before can still miss the
+    # others, which costs an extra computation, never a wrong response)
+    if path.endswith(".lock"):
+        lock = _try_lock(path)
+        if lock is not None:
+            os.remove(path)
+            lock.close()
+    else:
+        os.remove(path)
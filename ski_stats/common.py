@@ -1,4 +1,9 @@
+import errno
+import os
+import uuid
+from contextlib import contextmanager
 import numpy as np
+from ski_stats import formats, metrics
 
 
 class CalcResults:
@@ -15,7 +20,11 @@ class CurveFitException(Exception):
 
 def parse_workbook(workbook, use_arrays=True):
     # parse spreadsheet with time (Column A) and data (Column B)
-    sheet = workbook.sheet_by_index(0)
+    return parse_sheet(workbook.sheet_by_index(0), use_arrays=use_arrays)
+
+
+def parse_sheet(sheet, use_arrays=True):
+    # parse a worksheet with time (Column A) and data (Column B)
 
     # create blank lists to store excel columns
     time = []
@@ -35,6 +44,90 @@ def parse_workbook(workbook, use_arrays=True):
     return np.array(time), np.array(data)
 
 
+@metrics.PARSE_SECONDS.time()
+def parse_spreadsheet(file_contents, use_arrays=True, filename=None):
+    # open and parse an uploaded spreadsheet, or a file in one of the column formats (see `ski_stats.formats`)
+    file_contents, filename = formats.decompress(file_contents, filename)
+    file_format = formats.sniff(file_contents, filename)
+    if file_format == formats.EXCEL:
+        from xlrd import open_workbook
+        # only the first worksheet is loaded
+        workbook = open_workbook(file_contents=file_contents, on_demand=True)
+        try:
+            return parse_workbook(workbook, use_arrays=use_arrays)
+        finally:
+            workbook.release_resources()
+    time, data = formats.parse(file_contents, file_format)
+    if not use_arrays:
+        return time.tolist(), data.tolist()
+    return time, data
+
+
+def parse_file(path):
+    # parse a spreadsheet, or a file in one of the column formats, from disk
+    with open(path, "rb") as f:
+        return parse_spreadsheet(formats.map_file(f), filename=path)
+
+
+def ensure_dir(directory):
+    # create a directory shared with other processes, which may be creating it at the same time
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    return directory
+
+
+def remove_quietly(path):
+    # remove a file, unless another process already has
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def sweep(directory, older_than, remove=remove_quietly):
+    # remove the files in a shared directory last modified before the time `older_than`, with `remove(path)`, and
+    # return a (path, stat) pair for each of the others.  The directory is created if it doesn't exist yet; files that
+    # another process removes meanwhile are skipped
+    try:
+        names = os.listdir(directory)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        ensure_dir(directory)
+        return []
+    kept = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime < older_than:
+                remove(path)
+            else:
+                kept.append((path, stat))
+        except OSError:
+            pass
+    return kept
+
+
+@contextmanager
+def atomic_write(path, mode="wb"):
+    # open a file to write in place of `path`.  It is written under a temporary name ending in ".part" and renamed once
+    # the body finishes, so that readers never see half of it; if the body raises, it is removed instead
+    partial_path = "{0}.{1}.part".format(path, uuid.uuid4().hex)
+    try:
+        with open(partial_path, mode) as f:
+            yield f
+        os.rename(partial_path, path)
+    except BaseException:
+        remove_quietly(partial_path)
+        raise
+
+
 def midpoint_peak_auc(time, data):
     # midpoint auc calculation
     total_sum = 0
@@ -0,0 +1,243 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, process as futures_process
+from werkzeug.exceptions import ServiceUnavailable
+from ski_stats import app, metrics, progress, scratch
+
+# Optional pool of processes for the CPU-bound work (fitting and rendering), so that HTTP handling can run on threaded
+# workers without competing with the math.  Each gunicorn worker owns a pool of `COMPUTE_PROCESSES` processes; with the
+# default of 0 the work runs inline in the worker, as before.  See the `compute_pool` setting in `config/gunicorn.py`.
+# Tasks run as the submitting thread's fit job, if any, so that their solvers report progress (see `ski_stats.progress`).
+# Large array arguments are handed to the pool through a scratch file rather than pickled (see `ski_stats.scratch`), so
+# the pool's functions receive them read-only.
+#
+# The pool doesn't notice when one of its processes dies (e.g. killed for running out of memory): the dead process's
+# tasks never finish.  So callers never wait on a task for longer than `COMPUTE_TIMEOUT` seconds, and check that the
+# pool's processes are alive every `LIVENESS_SECONDS` while they wait.  A pool with a dead process is replaced; the
+# tasks it had get `ComputeUnavailable` (503), as do tasks that time out.  A task that times out after it started is
+# stopped by replacing the pool too, as its process would otherwise stay busy for as long as the solver runs.
+
+# tasks `imap` keeps in flight per process
+IMAP_TASKS_PER_PROCESS = 2
+LIVENESS_SECONDS = 1
+
+_pool = None
+_lock = threading.Lock()
+
+
+class ComputeUnavailable(ServiceUnavailable):
+    pass
+
+
+def pool_size():
+    return app.config["COMPUTE_PROCESSES"]
+
+
+def get_pool():
+    """The worker's compute pool, created on first use.  None if the pool is disabled."""
+    global _pool
+    if _pool is None and pool_size() > 0:
+        with _lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=pool_size())
+                metrics.COMPUTE_POOL_SIZE.set(pool_size())
+    return _pool
+
+
+def start():
+    """Spawn the pool's processes now, rather than on the first request.  Call from gunicorn's `post_fork` (after the
+    warm-up, so the processes inherit a warm interpreter) before the worker starts any threads."""
+    pool = get_pool()
+    if pool is not None:
+        for future in [pool.submit(os.getpid) for _ in range(pool_size())]:
+            future.result()
+
+
+def shutdown():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+
+def run(func, *args, **kwargs):
+    """Call `func(*args, **kwargs)` in the compute pool and wait for the result, or call it inline if the pool is
+    disabled.  `func` and its arguments must be picklable."""
+    pool = get_pool()
+    if pool is None:
+        return func(*args, **kwargs)
+
+    metrics.COMPUTE_QUEUE_DEPTH.inc()
+    with scratch.ScratchFile() as scratch_file:
+        try:
+            args, kwargs = scratch_file.share_args(args, kwargs)
+            _close_scratch(scratch_file)
+            future = pool.submit(_timed_call, time.time(), progress.current_job_id(), func, args, kwargs)
+            return _first_done(pool, [future], _deadline()).result()
+        finally:
+            metrics.COMPUTE_QUEUE_DEPTH.dec()
+
+
+def run_many(func, args_list):
+    """Call `func(*args)` for each tuple in `args_list`, in parallel across the compute pool if it is enabled.  Returns
+    the results in order."""
+    pool = get_pool()
+    if pool is None:
+        return [func(*args) for args in args_list]
+
+    metrics.COMPUTE_QUEUE_DEPTH.inc(len(args_list))
+    futures = []
+    # one file for all the tasks, so that arrays they have in common are written once
+    with scratch.ScratchFile() as scratch_file:
+        try:
+            tasks = [scratch_file.share_args(args, {})[0] for args in args_list]
+            _close_scratch(scratch_file)
+            job_id = progress.current_job_id()
+            futures = [pool.submit(_timed_call, time.time(), job_id, func, args, {}) for args in tasks]
+            deadline = _deadline()
+            return [_first_done(pool, [future], deadline).result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+            metrics.COMPUTE_QUEUE_DEPTH.dec(len(args_list))
+
+
+def imap(func, args_iter, ordered=True):
+    """A lazy `run_many`: yields `func(*args)` for each tuple from `args_iter`, in order, keeping only a few tasks in
+    flight, so that neither all the arguments nor all the results need to be in memory at once.  If not `ordered`,
+    results are yielded as they finish, so one slow task doesn't hold up the rest; they must then identify their
+    task themselves."""
+    pool = get_pool()
+    if pool is None:
+        for args in args_iter:
+            yield func(*args)
+        return
+
+    window = IMAP_TASKS_PER_PROCESS * pool_size()
+    job_id = progress.current_job_id()
+    pending = deque()
+    # each task's scratch file, removed once its result is taken
+    scratch_files = {}
+    try:
+        for args in args_iter:
+            metrics.COMPUTE_QUEUE_DEPTH.inc()
+            scratch_file = scratch.ScratchFile()
+            try:
+                args = scratch_file.share_args(args, {})[0]
+                _close_scratch(scratch_file)
+                future = pool.submit(_timed_call, time.time(), job_id, func, args, {})
+            except BaseException:
+                scratch_file.remove()
+                metrics.COMPUTE_QUEUE_DEPTH.dec()
+                raise
+            scratch_files[future] = scratch_file
+            pending.append(future)
+            if len(pending) >= window:
+                yield _next_result(pool, pending, ordered, scratch_files)
+        while pending:
+            yield _next_result(pool, pending, ordered, scratch_files)
+    finally:
+        for future in pending:
+            future.cancel()
+        for scratch_file in scratch_files.values():
+            scratch_file.remove()
+        metrics.COMPUTE_QUEUE_DEPTH.dec(len(pending))
+
+
+def _next_result(pool, pending, ordered=True, scratch_files=None):
+    future = _first_done(pool, [pending[0]] if ordered else pending, _deadline())
+    pending.remove(future)
+    try:
+        return future.result()
+    finally:
+        if scratch_files is not None:
+            scratch_files.pop(future).remove()
+        metrics.COMPUTE_QUEUE_DEPTH.dec()
+
+
+def _deadline():
+    return time.time() + app.config["COMPUTE_TIMEOUT"]
+
+
+def _first_done(pool, futures, deadline):
+    # the first of the futures to finish; raises ComputeUnavailable if a process of the pool dies, or at the deadline
+    while True:
+        done = wait(futures, timeout=max(0, min(LIVENESS_SECONDS, deadline - time.time())),
+                    return_when=FIRST_COMPLETED).done
+        if done:
+            return next(iter(done))
+        if not _PoolInternals(pool).is_alive():
+            _discard(pool, _process_died())
+            raise _process_died()
+        if time.time() >= deadline:
+            # a task still queued is just dropped, but one handed to the processes can only be stopped along with them
+            if not all([future.cancel() for future in futures]):
+                _discard(pool, ComputeUnavailable("The compute pool was restarted to stop a task that took too long.  "
+                                                  "Try again."))
+            raise ComputeUnavailable("The computation took longer than {0:g} seconds.".format(
+                app.config["COMPUTE_TIMEOUT"]))
+
+
+def _process_died():
+    return ComputeUnavailable("A compute process died; the pool has been restarted.  Try again.")
+
+
+def _discard(pool, error):
+    # replaced on next use; its processes are killed, and the tasks other threads wait on fail with `error`
+    global _pool
+    with _lock:
+        if _pool is not pool:
+            return
+        _pool = None
+    metrics.COMPUTE_POOL_RESTARTS.inc()
+    _PoolInternals(pool).kill(error)
+
+
+class _PoolInternals(object):
+    """What `_first_done` needs of a `ProcessPoolExecutor` beyond its API: whether its processes are alive, and a way
+    to kill them.  Written against the internals of the `futures` backport 3.2.0 (the version pinned in
+    requirements.txt); check them again when upgrading it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def is_alive(self):
+        # the pool drops its processes once shut down, e.g. by `kill` in another thread
+        processes = self.pool._processes
+        return processes is not None and all(process.is_alive() for process in list(processes))
+
+    def kill(self, error):
+        processes = self.pool._processes or set()
+        for process in list(processes):
+            if process.is_alive():
+                process.terminate()
+            process.join(LIVENESS_SECONDS)
+        # the pool's thread would wait forever for the results of the lost tasks; they're failed, and the processes
+        # forgotten (rather than sent the stop message they can't read), so that it finishes
+        for work_item in self.pool._pending_work_items.values():
+            if not work_item.future.done():
+                work_item.future.set_exception(error)
+        self.pool._pending_work_items.clear()
+        processes.clear()
+        thread = self.pool._queue_management_thread
+        self.pool.shutdown(wait=False)
+        # nor should the interpreter wait for it at exit, should it be stuck anyway
+        futures_process._threads_queues.pop(thread, None)
+
+
+def _close_scratch(scratch_file):
+    # finish writing the tasks' shared arrays, before submitting them
+    scratch_file.close()
+    if scratch_file.path is not None:
+        metrics.COMPUTE_SHARED_BYTES.inc(scratch_file.size)
+
+
+def _timed_call(submitted, job_id, func, args, kwargs):
+    # runs in the pool process; records how long the task waited for a free process
+    metrics.COMPUTE_WAIT_SECONDS.observe(max(0, time.time() - submitted))
+    args, kwargs = scratch.open_args(args, kwargs)
+    with progress.tracking(job_id):
+        return func(*args, **kwargs)
@@ -0,0 +1,153 @@
+import errno
+import hashlib
+import os
+import re
+import time
+import numpy as np
+from werkzeug.exceptions import NotFound
+from ski_stats import app, metrics
+from ski_stats.common import parse_spreadsheet, ensure_dir, remove_quietly, sweep, atomic_write
+
+# Parsed uploads, kept so that repeat fits of the same data skip both the upload and the parse.  Each dataset is
+# stored once, as a (2, n) float64 .npy file in `DATASET_DIR` shared by every worker on the host, named by its token:
+# the SHA-256 of the uploaded file's contents and extension, so that uploading the same file again finds it too.
+# `/parseSpreadsheet` and the analysis forms return the token in the `X-Dataset-Token` header, and the Desmos page,
+# the forms (as "<field>-dataset" in place of the file) and `/api/fit` accept it in place of the data.
+#
+# A dataset expires `DATASET_TTL` seconds after it was last used, and the least recently used ones are removed once
+# the files exceed `DATASET_MAX_BYTES` together.  Clients that get 404 for a token send the data again.  Disabled when
+# `DATASET_TTL` is 0.
+
+TOKEN_HEADER = "X-Dataset-Token"
+TOKEN_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# the name of a form's token field is that of its file field with this suffix
+FIELD_SUFFIX = "-dataset"
+# partial files older than this belong to a process that died while writing
+STALE_SECONDS = 60
+
+
+class DatasetNotFound(NotFound):
+    description = "The dataset was not found; it may have expired.  Upload the file again."
+
+
+def is_enabled():
+    return app.config["DATASET_TTL"] > 0
+
+
+def token_for(file_contents, filename=None):
+    """The token of an upload; the extension is included, as it can decide the format (see `formats.sniff`)."""
+    digest = hashlib.sha256(file_contents)
+    digest.update(b"\0" + os.path.splitext(filename or "")[1].lower())
+    return digest.hexdigest()
+
+
+def load(token):
+    """(time, data) of a stored dataset, or None if there's none by that token."""
+    path = _path(token)
+    if path is None:
+        return None
+    try:
+        if time.time() - os.path.getmtime(path) > app.config["DATASET_TTL"]:
+            metrics.DATASET_LOOKUPS.labels(result="miss").inc()
+            return None
+        columns = np.load(path, allow_pickle=False)
+        # marks it as recently used, for expiry and eviction
+        os.utime(path, None)
+    except (IOError, OSError) as err:
+        if err.errno != errno.ENOENT:
+            raise
+        metrics.DATASET_LOOKUPS.labels(result="miss").inc()
+        return None
+    metrics.DATASET_LOOKUPS.labels(result="hit").inc()
+    return columns[0], columns[1]
+
+
+def require(token):
+    """(time, data) of a stored dataset.  Raises DatasetNotFound if there's none by that token."""
+    columns = load(token)
+    if columns is None:
+        raise DatasetNotFound()
+    return columns
+
+
+def points(token):
+    """The point count of a stored dataset, or None if there's none by that token."""
+    path = _path(token)
+    if path is None:
+        return None
+    try:
+        return np.load(path, mmap_mode="r", allow_pickle=False).shape[1]
+    except (IOError, OSError) as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def save(token, time, data):
+    """Store a parsed dataset.  Returns False if it wasn't stored: datasets of anything but numbers, or larger than
+    `DATASET_MAX_BYTES`, are not."""
+    path = _path(token)
+    if path is None:
+        return False
+    time, data = np.asarray(time), np.asarray(data)
+    if (time.dtype.kind not in "iuf" or data.dtype.kind not in "iuf" or time.ndim != 1 or time.shape != data.shape
+            or 2 * time.size * 8 > app.config["DATASET_MAX_BYTES"]):
+        # e.g. a worksheet with a header row; the fit will report it
+        return False
+    # the columns are written one after the other, rather than stacked in memory first
+    with atomic_write(path) as f:
+        np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+                                                 "fortran_order": False, "shape": (2, time.size)})
+        for column in (time, data):
+            np.ascontiguousarray(column, dtype=np.float64).tofile(f)
+    _sweep()
+    return True
+
+
+def parse_upload(file_contents, filename=None, token=None):
+    """(token, time, data) for an uploaded file: the stored dataset, or the file parsed and stored.  `token` is that of
+    the file, if already known.  The token returned is None if the dataset isn't stored."""
+    if token is None and is_enabled():
+        token = token_for(file_contents, filename)
+    columns = load(token) if token is not None else None
+    if columns is not None:
+        return (token,) + columns
+    time, data = parse_spreadsheet(file_contents, filename=filename)
+    if token is not None and not save(token, time, data):
+        token = None
+    return token, time, data
+
+
+def _path(token):
+    # None for malformed tokens, which are never stored
+    if not is_enabled() or not isinstance(token, basestring) or not TOKEN_PATTERN.match(token):
+        return None
+    return os.path.join(ensure_dir(app.config["DATASET_DIR"]), token + ".npy")
+
+
+def _sweep():
+    # remove expired datasets, then the least recently used until the rest fit in `DATASET_MAX_BYTES`
+    now = time.time()
+    datasets = []
+    for path, stat in sweep(app.config["DATASET_DIR"], now - app.config["DATASET_TTL"], _expire):
+        if not path.endswith(".part"):
+            datasets.append((stat.st_mtime, stat.st_size, path))
+        elif now - stat.st_mtime > STALE_SECONDS:
+            remove_quietly(path)
+
+    total = sum(size for mtime, size, path in datasets)
+    for mtime, size, path in sorted(datasets):
+        if total <= app.config["DATASET_MAX_BYTES"]:
+            break
+        try:
+            os.remove(path)
+            metrics.DATASET_EVICTIONS.labels(reason="size").inc()
+        except OSError:
+            pass
+        total -= size
+
+
+def _expire(path):
+    os.remove(path)
+    if not path.endswith(".part"):
+        metrics.DATASET_EVICTIONS.labels(reason="expired").inc()
@@ -0,0 +1,227 @@
+import os
+import tempfile
+from collections import namedtuple, deque
+from ski_stats import compute, formats
+from ski_stats.common import parse_sheet
+
+# Export of fit results to .xlsx, for collecting numbers without reading them off the plots.  Workbooks are written
+# with XlsxWriter in `constant_memory` mode, which flushes each row to a temporary file as soon as the next one is
+# started, and series are fitted lazily across the compute pool (`compute.imap`), so a run over many series or
+# worksheets holds only a few of them, and their results, in memory at once.
+#
+# Sheets of the exported workbook:
+#   Results          one row per series: params, goodness of fit, acrophase, mesor and counts, or the error
+#   Mesor crossings  one row per crossing: the times the data cross the mesor
+#   Acrophases       one row per fitted peak within the data: its time
+#   Peaks            one row per onset-offset peak: its times and AUCs
+#
+# The sheets of times are long rather than wide, as a row can't hold more than Excel's 16384 columns, and XlsxWriter
+# drops the cells past them without an error.
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+RESULTS_COLUMNS = (u"Series", u"h", u"b", u"v", u"p", u"r", u"r\u00b2", u"SS", u"Acrophase", u"Peak value", u"Mesor",
+                   u"Mesor crossings", u"Peaks", u"Status", u"Function evaluations", u"Error")
+PEAKS_COLUMNS = (u"Series", u"Peak", u"Onset", u"Offset", u"AUC", u"Midpoint AUC")
+CROSSINGS_COLUMNS = (u"Series", u"Crossing", u"Time")
+ACROPHASES_COLUMNS = (u"Series", u"Acrophase", u"Time")
+SERIES_COLUMN_WIDTH = 24
+# the series name of a file with a single series
+COLUMNS_SERIES_NAME = u"data"
+
+
+class Row(namedtuple("Row", "params r r2 ss acrophase peak_value mesor crossings acrophases peaks status nfev error")):
+    """The exported results of one series.  `peaks` is a list of (onset, offset, auc, midpoint_auc); fields that
+    weren't calculated are None."""
+    __slots__ = ()
+
+
+Row.__new__.__defaults__ = (None,) * len(Row._fields)
+
+
+def row_from_results(results):
+    """The row for `do_calculations` results."""
+    peaks = [(results.all_time[start], results.all_time[stop - 1], auc, mp_auc) for (start, stop), auc, mp_auc
+             in zip(results.peak_bounds, results.peak_auc_list, results.peak_mp_auc_list)]
+    return Row(params=list(results.lsq_params), r=results.lsq_r, r2=results.lsq_r2, ss=results.ss_lsq,
+               acrophase=results.lsq_acro, peak_value=results.lsq_peak_value, mesor=results.lsq_mesor,
+               crossings=list(results.crossing_points), acrophases=list(results.lsq_acro_list_x), peaks=peaks)
+
+
+def row_from_fit(result):
+    """The row for a `fit_series` result dict."""
+    return Row(params=result.get("params"), r=result.get("r"), r2=result.get("r2"), ss=result.get("ss"),
+               status=result.get("status"), nfev=result.get("nfev"), error=result.get("error"))
+
+
+def row_from_error(err):
+    return Row(error="[{0}] {1}".format(type(err).__name__, err))
+
+
+class ResultsWriter(object):
+    """Writes rows to an .xlsx workbook as they arrive.  `output` is a filename or a file object; the workbook is
+    complete once the writer is closed."""
+    def __init__(self, output, tmpdir=None):
+        import xlsxwriter
+        self.workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "tmpdir": tmpdir,
+                                                     "nan_inf_to_errors": True})
+        self._header = self.workbook.add_format({"bold": True})
+        self._results = self._add_sheet("Results", RESULTS_COLUMNS)
+        self._crossings = self._add_sheet("Mesor crossings", CROSSINGS_COLUMNS)
+        self._acrophases = self._add_sheet("Acrophases", ACROPHASES_COLUMNS)
+        self._peaks = self._add_sheet("Peaks", PEAKS_COLUMNS)
+        # the next row of each sheet; constant_memory mode requires rows to be written in order
+        self._next_rows = {sheet: 1 for sheet in (self._results, self._crossings, self._acrophases, self._peaks)}
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, series, row):
+        """Append the row for the series named `series`."""
+        params = row.params if row.params is not None else [None] * 4
+        self._append(self._results, [series] + list(params) + [
+            row.r, row.r2, row.ss, row.acrophase, row.peak_value, row.mesor, _count(row.crossings), _count(row.peaks),
+            row.status, row.nfev, row.error])
+        for number, time in enumerate(row.crossings or (), 1):
+            self._append(self._crossings, [series, number, time])
+        for number, time in enumerate(row.acrophases or (), 1):
+            self._append(self._acrophases, [series, number, time])
+        for number, peak in enumerate(row.peaks or (), 1):
+            self._append(self._peaks, [series, number] + list(peak))
+        self.count += 1
+
+    def close(self):
+        self.workbook.close()
+
+    def _add_sheet(self, name, columns):
+        sheet = self.workbook.add_worksheet(name)
+        sheet.set_column(0, 0, SERIES_COLUMN_WIDTH)
+        sheet.write_row(0, 0, columns, self._header)
+        return sheet
+
+    def _append(self, sheet, values):
+        row = self._next_rows[sheet]
+        for col, value in enumerate(values):
+            if value is not None:
+                sheet.write(row, col, _cell(value))
+        self._next_rows[sheet] = row + 1
+
+
+def export_series(output, series, calculate, args=(), tmpdir=None):
+    """Fit each (name, time, data) from the iterable `series` with `calculate(time, data, *args)`, which must return a
+    `Row`, across the compute pool, and write the rows to an .xlsx workbook.  Returns the number of series."""
+    names = deque()
+
+    def tasks():
+        for name, time, data in series:
+            names.append(name)
+            yield (time, data) + tuple(args)
+
+    with ResultsWriter(output, tmpdir) as writer:
+        for row in compute.imap(calculate, tasks()):
+            writer.write(names.popleft(), row)
+    return writer.count
+
+
+def export_to_tempfile(series, calculate, args=()):
+    """`export_series` into a temporary file, which is returned open and rewound, and deleted once closed."""
+    output = tempfile.TemporaryFile()
+    try:
+        export_series(output, series, calculate, args)
+    except Exception:
+        output.close()
+        raise
+    output.seek(0)
+    return output
+
+
+def iter_workbook(filename=None, file_contents=None, prefix=""):
+    """Yields (name, time, data) for each non-empty worksheet of a spreadsheet, loading one worksheet at a time."""
+    from xlrd import open_workbook
+    workbook = open_workbook(filename, file_contents=file_contents, on_demand=True)
+    try:
+        for index, sheet_name in enumerate(workbook.sheet_names()):
+            sheet = workbook.sheet_by_index(index)
+            if sheet.nrows:
+                time, data = parse_sheet(sheet)
+                yield prefix + sheet_name, time, data
+            workbook.unload_sheet(index)
+    finally:
+        workbook.release_resources()
+
+
+def iter_spreadsheet(filename=None, file_contents=None, prefix="", upload_name=None):
+    """Yields (name, time, data) for each series of a spreadsheet: every non-empty worksheet of a workbook, or the one
+    series (named "data") of a file in a column format (see `ski_stats.formats`).  `upload_name` is the filename of
+    `file_contents`, if known, for telling the formats apart."""
+    if file_contents is None:
+        with open(filename, "rb") as f:
+            file_contents = formats.map_file(f)
+    file_contents, name = formats.decompress(file_contents, upload_name or filename)
+    file_format = formats.sniff(file_contents, name)
+    if file_format == formats.EXCEL:
+        for series in iter_workbook(file_contents=file_contents, prefix=prefix):
+            yield series
+    else:
+        time, data = formats.parse(file_contents, file_format)
+        yield prefix + COLUMNS_SERIES_NAME, time, data
+
+
+def export_filename(upload_name):
+    """The download name for the results of an uploaded spreadsheet."""
+    base = os.path.splitext(os.path.basename(upload_name or ""))[0] or "results"
+    return base + "_results.xlsx"
+
+
+def main():
+    """Commandline runner: fits every worksheet of the given spreadsheets across all cores, and writes one results
+    workbook."""
+    import argparse
+    import multiprocessing
+    import sys
+    from ski_stats import app, solver
+    from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+
+    parser = argparse.ArgumentParser(description="Fit every worksheet of the given spreadsheets and export the results.")
+    parser.add_argument("spreadsheets", nargs="+")
+    parser.add_argument("-o", "--output", default="results.xlsx")
+    parser.add_argument("--max-nfev", type=int, default=lsq.DEFAULT_MAX_NFEV)
+    parser.add_argument("--auto-period", action="store_true", help="seed the period from the periodogram")
+    parser.add_argument("--method", choices=solver.METHODS, default=solver.AUTO,
+                        help="solver method (default: chosen per fit)")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+    if args.method == "lm" and args.auto_period:
+        parser.error("--auto-period bounds the period, which the lm solver doesn't support")
+
+    def series():
+        for filename in args.spreadsheets:
+            for name, time, data in iter_spreadsheet(filename, prefix=os.path.basename(filename) + "/"):
+                sys.stderr.write("{0}\n".format(name))
+                yield name, time, data
+
+    app.config["COMPUTE_PROCESSES"] = args.processes
+    try:
+        count = export_series(args.output, series(), lsq.calculate_row, (
+            lsq.DEFAULT_INITIAL_PARAMS_GUESS, lsq.DEFAULT_BOUNDS, args.max_nfev, args.auto_period, args.method))
+    finally:
+        compute.shutdown()
+    print "Exported {0:d} series to {1}".format(count, args.output)
+
+
+def _count(values):
+    return len(values) if values is not None else None
+
+
+def _cell(value):
+    # NumPy scalars to the Python numbers XlsxWriter expects
+    return value.item() if hasattr(value, "item") else value
+
+
+# if script is being run directly from commandline
+if __name__ == "__main__":
+    main()
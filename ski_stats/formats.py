@@ -0,0 +1,289 @@
+import mmap
+import os
+import tempfile
+import zipfile
+import zlib
+from cStringIO import StringIO
+import numpy as np
+
+# Upload formats other than Excel workbooks, read straight into NumPy arrays.  Loggers export CSV, and xlrd is by far
+# the slowest way to read two numeric columns: it builds a Python object for every cell.  `sniff` tells the formats
+# apart by their leading bytes, falling back on the filename's extension only where the bytes are ambiguous:
+#
+#   excel  .xls/.xlsx workbooks; parsed by `common.parse_workbook` as before
+#   text   CSV, TSV or whitespace-separated columns, after any header lines; time in the first column, data in the
+#          second, further columns ignored.  The body is read in chunks of whole lines; the delimiters of each are
+#          turned into spaces and it is parsed by `np.fromstring` in one call.  A chunk that doesn't come out as a
+#          whole table (blank fields, quotes, ragged rows) is parsed again line by line, to report the first bad line.
+#   npy    a NumPy array of shape (n, 2) or more columns, or (2, n), or a structured array of at least two fields; read
+#          where it lies in the contents
+#   npz    a NumPy archive with "time" and "data" (or "x" and "y") arrays, or a single array as for npy
+#
+# Any of them may be gzip-compressed (e.g. "recording.csv.gz").  Contents may be bytes or a read-only mmap (see
+# `map_file`), which is read in place: sliced a chunk at a time, or wrapped in a cStringIO, which doesn't copy it.
+
+EXCEL = "excel"
+TEXT = "text"
+NPY = "npy"
+NPZ = "npz"
+
+EXTENSIONS = ("xlsx", "xls", "csv", "tsv", "txt", "gz", "npy", "npz")
+
+ZIP_MAGIC = b"PK\x03\x04"
+OLE2_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+GZIP_MAGIC = b"\x1f\x8b"
+NPY_MAGIC = b"\x93NUMPY"
+UTF8_BOM = b"\xef\xbb\xbf"
+
+# in the order they're tried on a text file's first data line
+DELIMITERS = (b"\t", b",", b";")
+# lines before the first data line (column names, logger metadata) are skipped, up to this many
+MAX_HEADER_LINES = 100
+# guards against gzip bombs
+MAX_DECOMPRESSED_BYTES = 1024 ** 3
+# the size of the pieces text is parsed in, and compressed files are decompressed in
+TEXT_CHUNK_BYTES = 16 * 1024 ** 2
+DECOMPRESS_CHUNK_BYTES = 1024 ** 2
+
+
+class FormatError(ValueError):
+    # raised for uploads that can't be read as (time, data) columns
+    pass
+
+
+def sniff(file_contents, filename=None):
+    """The format of the (decompressed) file contents: one of EXCEL, TEXT, NPY or NPZ."""
+    if _starts_with(file_contents, OLE2_MAGIC):
+        return EXCEL
+    if _starts_with(file_contents, NPY_MAGIC):
+        return NPY
+    if _starts_with(file_contents, ZIP_MAGIC):
+        # .xlsx workbooks and .npz archives are both zip files
+        extension = _extension(filename)
+        if extension in ("xlsx", "npz"):
+            return EXCEL if extension == "xlsx" else NPZ
+        try:
+            names = zipfile.ZipFile(StringIO(file_contents)).namelist()
+        except zipfile.BadZipfile:
+            raise FormatError("The file is a damaged zip archive.")
+        return NPZ if names and all(name.endswith(".npy") for name in names) else EXCEL
+    return TEXT
+
+
+def decompress(file_contents, filename=None):
+    """Returns the contents and filename with any gzip compression removed.  Compressed contents are decompressed a
+    chunk at a time into a temporary file, and returned mapped."""
+    if not _starts_with(file_contents, GZIP_MAGIC):
+        return file_contents, filename
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    size = 0
+    with tempfile.TemporaryFile() as output:
+        try:
+            for offset in xrange(0, len(file_contents), DECOMPRESS_CHUNK_BYTES):
+                chunk = file_contents[offset:offset + DECOMPRESS_CHUNK_BYTES]
+                while chunk:
+                    # bounded, so that a small chunk of a gzip bomb can't expand all at once
+                    data = decompressor.decompress(chunk, DECOMPRESS_CHUNK_BYTES)
+                    size += len(data)
+                    if size > MAX_DECOMPRESSED_BYTES:
+                        raise FormatError("The file decompresses to more than {0:d} MB.".format(
+                            MAX_DECOMPRESSED_BYTES // 1024 ** 2))
+                    output.write(data)
+                    chunk = decompressor.unconsumed_tail
+            output.write(decompressor.flush())
+        except zlib.error as err:
+            raise FormatError("The file is not valid gzip data ({0}).".format(err))
+        file_contents = map_file(output)
+    if filename is not None and filename.lower().endswith(".gz"):
+        filename = filename[:-3]
+    return file_contents, filename
+
+
+def map_file(f):
+    """The contents of an open file, mapped read-only where it is a file on disk (the mapping outlives the file), or
+    otherwise read."""
+    f.flush()
+    try:
+        fileno = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        # e.g. a BytesIO
+        f.seek(0)
+        return f.read()
+    if not os.fstat(fileno).st_size:
+        # empty files can't be mapped
+        return b""
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+
+def parse(file_contents, fmt):
+    """(time, data) as float arrays from decompressed contents of the given format, other than EXCEL."""
+    if fmt == TEXT:
+        return parse_text(file_contents)
+    if fmt == NPY:
+        return _columns(_load_npy(file_contents))
+    if fmt == NPZ:
+        return parse_npz(file_contents)
+    raise ValueError("Not a column format: " + fmt)
+
+
+def parse_text(text):
+    """(time, data) from delimited text; see the module comment."""
+    start = len(UTF8_BOM) if _starts_with(text, UTF8_BOM) else 0
+    start, line_number, fields, delimiter = _find_data(text, start)
+    num_columns = len(fields)
+    # one row per line at most; the two columns are filled in as each chunk is parsed
+    columns = np.empty((2, _count_lines(text, start)))
+    num_rows = 0
+    while start < len(text):
+        # chunks end after a newline, so that no line is split
+        end = text.find(b"\n", start + TEXT_CHUNK_BYTES)
+        end = len(text) if end < 0 else end + 1
+        chunk = text[start:end]
+        table = _parse_table(chunk, line_number, delimiter, num_columns)
+        columns[:, num_rows:num_rows + len(table)] = table[:, :2].T
+        num_rows += len(table)
+        line_number += chunk.count(b"\n")
+        start = end
+    # rows of a C-ordered array, so contiguous
+    return columns[0, :num_rows], columns[1, :num_rows]
+
+
+def parse_npz(file_contents):
+    """(time, data) from a NumPy archive; see the module comment."""
+    archive = _load(file_contents)
+    try:
+        for time_name, data_name in (("time", "data"), ("x", "y")):
+            if time_name in archive.files and data_name in archive.files:
+                return _column(archive[time_name], time_name), _column(archive[data_name], data_name)
+        if len(archive.files) == 1:
+            return _columns(archive[archive.files[0]])
+        raise FormatError("The archive must hold \"time\" and \"data\" arrays, or a single (n, 2) array; found: " +
+                          ", ".join(archive.files))
+    finally:
+        archive.close()
+
+
+def _extension(filename):
+    return os.path.splitext(filename or "")[1][1:].lower()
+
+
+def _starts_with(file_contents, prefix):
+    # mmaps have no `startswith`
+    return file_contents[:len(prefix)] == prefix
+
+
+def _find_data(text, start):
+    # the offset, line number, fields and delimiter (None for whitespace) of the first line of at least two numbers
+    for line_number in range(1, MAX_HEADER_LINES + 2):
+        end = text.find(b"\n", start)
+        line = text[start:] if end < 0 else text[start:end]
+        delimiter = next((delimiter for delimiter in DELIMITERS if delimiter in line), None)
+        fields = _numbers(_fields(line, delimiter))
+        if fields is not None and len(fields) >= 2:
+            return start, line_number, fields, delimiter
+        if end < 0:
+            break
+        start = end + 1
+    raise FormatError("No rows of time and data values found in the first {0:d} lines.".format(MAX_HEADER_LINES + 1))
+
+
+def _fields(line, delimiter):
+    fields = [field.strip().strip(b"\"'") for field in line.split(delimiter)]
+    # some exporters end every row with a delimiter
+    while fields and not fields[-1]:
+        fields.pop()
+    return fields
+
+
+def _numbers(fields):
+    try:
+        return [float(field) for field in fields]
+    except ValueError:
+        return None
+
+
+def _count_lines(text, start):
+    lines = 1
+    for offset in xrange(start, len(text), TEXT_CHUNK_BYTES):
+        lines += text[offset:offset + TEXT_CHUNK_BYTES].count(b"\n")
+    return lines
+
+
+def _parse_table(text, first_line_number, delimiter, num_columns):
+    # the rows of whole lines of text, as an array of shape (n, num_columns)
+    body = text.rstrip()
+    if not body:
+        return np.empty((0, num_columns))
+    if delimiter is not None:
+        # counted too, so that a blank field can't shift the values of a row into the next
+        delimiter_count = body.count(delimiter)
+        body = body.replace(delimiter, b" ")
+    values = np.fromstring(body, dtype=np.float64, sep=" ")
+    num_rows = body.count(b"\n") + 1
+    if values.size != num_rows * num_columns or (delimiter is not None and
+                                                 delimiter_count != num_rows * (num_columns - 1)):
+        # something the bulk parse can't read; find what, line by line
+        values = _parse_lines(text, first_line_number, delimiter, num_columns)
+        num_rows = values.size // num_columns
+    return values.reshape(num_rows, num_columns)
+
+
+def _parse_lines(text, first_line_number, delimiter, num_columns):
+    values = []
+    for line_number, line in enumerate(text.splitlines(), first_line_number):
+        if not line.strip():
+            continue
+        numbers = _numbers(_fields(line, delimiter))
+        if numbers is None or len(numbers) != num_columns:
+            raise FormatError("Line {0:d} is not a row of {1:d} numbers: {2!r}".format(
+                line_number, num_columns, line[:80]))
+        values.extend(numbers)
+    return np.array(values, dtype=np.float64)
+
+
+def _load(file_contents):
+    try:
+        return np.load(StringIO(file_contents), allow_pickle=False)
+    except (IOError, ValueError) as err:
+        raise FormatError("The file is not a readable NumPy file ({0}).".format(err))
+
+
+def _load_npy(file_contents):
+    # a read-only view of the array in the contents, rather than a copy of it
+    header = StringIO(file_contents)
+    try:
+        version = np.lib.format.read_magic(header)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+        else:
+            return _load(file_contents)
+        if dtype.hasobject:
+            raise ValueError("Object arrays are not supported.")
+        array = np.frombuffer(file_contents, dtype, int(np.prod(shape)), header.tell())
+    except ValueError as err:
+        raise FormatError("The file is not a readable NumPy file ({0}).".format(err))
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def _columns(array):
+    # the first two columns (or fields) of a table
+    if array.dtype.names is not None and len(array.dtype.names) >= 2:
+        names = array.dtype.names
+        return _column(array[names[0]], names[0]), _column(array[names[1]], names[1])
+    if array.ndim == 2 and array.shape[0] == 2 and array.shape[1] > 2:
+        # stacked as rows, e.g. `np.array([time, data])`
+        array = array.T
+    if array.ndim == 2 and array.shape[1] >= 2:
+        return _column(array[:, 0], "time"), _column(array[:, 1], "data")
+    raise FormatError("Expected an array of (time, data) rows, of shape (n, 2); found shape {0}.".format(array.shape))
+
+
+def _column(array, name):
+    if array.ndim != 1:
+        raise FormatError("Expected a 1-D \"{0}\" array; found shape {1}.".format(name, array.shape))
+    try:
+        return np.ascontiguousarray(array, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise FormatError("The \"{0}\" values are not numbers.".format(name))
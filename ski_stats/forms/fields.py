@@ -1,13 +1,14 @@
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileAllowed, FileRequired
-from wtforms import Field, DecimalField, StringField, SubmitField, FormField
+from flask_wtf.file import FileField, FileAllowed
+from werkzeug.datastructures import FileStorage
+from wtforms import Field, BooleanField, DecimalField, StringField, SubmitField, FormField
+from wtforms.utils import unset_value
 from wtforms.validators import NumberRange
 from wtforms.widgets import HTMLString
 from ski_stats.forms import widgets
-from ski_stats.forms.validators import NumpyValidator, CorrectDataRequired
-from ski_stats.common import parse_workbook
+from ski_stats.forms.validators import NumpyValidator, CorrectDataRequired, UploadRequired
+from ski_stats import datastore, formats, uploads
 from cgi import escape
-from xlrd import open_workbook
 from fastnumbers import fast_real
 import numpy as np
 
@@ -24,19 +25,54 @@ class Title(Field):
 
 
 class BrowseSpreadsheetInput(FileField):
-    """Browse button for spreadsheet files."""
+    """Browse button for spreadsheet files.  The token of a stored dataset (see `ski_stats.datastore`) may be submitted
+    as "<name>-dataset" in place of the file."""
     widget = widgets.TopLevelWrapper(widgets.BrowseButtonWidget())
 
     def __init__(self, label="Select file", **kwargs):
         validators = [
-            FileRequired(),
-            FileAllowed(["xls", "xlsx"], "File must be an Excel spreadsheet.")
+            UploadRequired(),
+            FileAllowed(formats.EXTENSIONS, "File must be a spreadsheet, CSV/TSV (optionally gzipped) or NumPy file.")
         ]
         super(BrowseSpreadsheetInput, self).__init__(label=label, validators=validators, **kwargs)
+        self.token = None
+        self._contents = None
+        self._file_token = None
+
+    def process(self, formdata, data=unset_value):
+        super(BrowseSpreadsheetInput, self).process(formdata, data)
+        if formdata:
+            self.token = formdata.get(self.name + datastore.FIELD_SUFFIX) or None
+
+    def has_file(self):
+        return isinstance(self.data, FileStorage) and bool(self.data)
+
+    def read(self):
+        """The uploaded file's contents; see `ski_stats.uploads.contents`."""
+        if self._contents is None:
+            self._contents = uploads.contents(self.data)
+        return self._contents
+
+    def dataset_token(self):
+        """The token of the dataset: that of the uploaded file if it is stored (or can be), otherwise the one
+        submitted in its place."""
+        if not self.has_file():
+            return self.token
+        if self._file_token is None and datastore.is_enabled():
+            self._file_token = datastore.token_for(self.read(), self.data.filename)
+        return self._file_token
+
+    def stored_points(self):
+        """The point count of the stored dataset, or None if it isn't stored (yet)."""
+        token = self.dataset_token()
+        return datastore.points(token) if token is not None else None
 
     def parse(self):
-        """Returns (time, data) as NumPy arrays."""
-        return parse_workbook(open_workbook(file_contents=self.data.read()))
+        """Returns (time, data) as NumPy arrays, from the stored dataset if there is one."""
+        if not self.has_file():
+            return datastore.require(self.token)
+        token, time, data = datastore.parse_upload(self.read(), self.data.filename, self.dataset_token())
+        return time, data
 
 
 class NumberInput(DecimalField):
@@ -44,7 +80,7 @@ class NumberInput(DecimalField):
     widget = widgets.TopLevelWrapper(widgets.NumberInputWidget())
 
     def __init__(self, label="Enter a number", validators=None, required=True, default=None, size=None, is_subfield=False, min=None, max=None, step="any", **kwargs):
-        validators = validators or []
+        validators = list(validators or [])
         if required:
             validators.append(CorrectDataRequired())
         if min is not None or max is not None:
@@ -82,7 +118,7 @@ class TextInput(StringField):
     widget = widgets.TopLevelWrapper(widgets.TextInputWidget())
 
     def __init__(self, label=None, validators=None, required=True, size=None, default=None, is_subfield=False, **kwargs):
-        validators = validators or []
+        validators = list(validators or [])
         if required:
             validators.append(CorrectDataRequired())
 
@@ -102,7 +138,7 @@ class TextInput(StringField):
 class NumpyInput(TextInput):
     """Text input for NumPy values."""
     def __init__(self, label=None, validators=None, required=True, size=None, default=None, is_subfield=False, **kwargs):
-        validators = validators or []
+        validators = list(validators or [])
         validators.append(NumpyValidator())
         super(NumpyInput, self).__init__(label=label, validators=validators, required=required, size=size, default=default, is_subfield=is_subfield, **kwargs)
 
@@ -117,6 +153,14 @@ class NumpyInput(TextInput):
             return fast_real(self.data)
 
 
+class CheckboxInput(BooleanField):
+    """Checkbox input."""
+    widget = widgets.TopLevelWrapper(widgets.CheckboxWidget())
+
+    def __init__(self, label=None, default=False, **kwargs):
+        super(CheckboxInput, self).__init__(label=label, default=default, **kwargs)
+
+
 class MathEquation(Field):
     """A LaTeX-rendered field."""
     widget = widgets.TopLevelWrapper(widgets.MathEquationWidget())
@@ -132,7 +176,7 @@ class RunButton(SubmitField):
     widget = widgets.TopLevelWrapper(widgets.RunButtonWidget())
 
     def __init__(self, label=None, validators=None, button_text=None, **kwargs):
-        validators = validators or []
+        validators = list(validators or [])
         if button_text is not None:
             render_kw = kwargs.setdefault("render_kw", {})
             render_kw["button_text"] = button_text
@@ -142,42 +186,37 @@ class RunButton(SubmitField):
 class ParamInput(NumberInput):
     """Numeric input, where the param letter is also the label."""
     def __init__(self, param, validators=None, required=True, size=None, default=None, is_subfield=True, **kwargs):
-        validators = validators or []
+        validators = list(validators or [])
         self.param = param
         super(ParamInput, self).__init__(label=param, validators=validators, required=required, size=size, default=default, is_subfield=is_subfield, **kwargs)
 
 
 class ParamBoundsInput(FormField):
     """Bounds input for a param."""
-    def __init__(self, param, size=5, default_min=None, default_max=None, required=True, **kwargs):
+    def __new__(cls, param, size=5, default_min=None, default_max=None, required=True, form_class=None, **kwargs):
+        # fields declared on a form class are only bound later, once per form instance; build the inner form class
+        # here, once per declaration, rather than on every binding
+        if form_class is None:
+            form_class = _get_bounds_form(size, default_min, default_max)
+        return super(ParamBoundsInput, cls).__new__(cls, param=param, required=required, form_class=form_class,
+                                                    **kwargs)
+
+    def __init__(self, param, form_class, required=True, **kwargs):
         self.param = param
-
-        # inner class will encapsulate the actual fields
-        class F(FlaskForm):
-            min = NumpyInput(label="", size=size, default=default_min, is_subfield=True)
-            max = NumpyInput(label="", size=size, default=default_max, is_subfield=True)
-
-            def validate(self):
-                if not super(F, self).validate():
-                    return False
-                self._errors = []
-                min_val = self.min.numpy_val
-                max_val = self.max.numpy_val
-                if not min_val <= max_val:
-                    self._errors.append("Lower bound must be less-than-or-equal-to upper bound.")
-                    return False
-                return True
-
         render_kw = kwargs.setdefault("render_kw", {})
         render_kw["required"] = required
-        super(ParamBoundsInput, self).__init__(F, widget=widgets.InequalityWidget(param_name=param), **kwargs)
+        super(ParamBoundsInput, self).__init__(form_class, widget=widgets.InequalityWidget(param_name=param), **kwargs)
 
 
 class ParamGroup(FormField):
     """Arranges a list of ParamInputs in a row."""
-    def __init__(self, label, fields, **kwargs):
-        field_dict = {field.kwargs["param"]: field for field in fields}
-        form_class = _get_dynamic_form(field_dict)
+    def __new__(cls, label, fields=None, form_class=None, **kwargs):
+        # built once per declaration; see ParamBoundsInput
+        if form_class is None:
+            form_class = _get_dynamic_form({field.kwargs["param"]: field for field in fields})
+        return super(ParamGroup, cls).__new__(cls, label=label, form_class=form_class, **kwargs)
+
+    def __init__(self, label, form_class, **kwargs):
         super(ParamGroup, self).__init__(form_class, label=label, widget=widgets.TopLevelWrapper(widgets.AdjacentInlineWidget(use_latex_labels=True)), **kwargs)
 
     def as_list(self, *params):
@@ -187,9 +226,13 @@ class ParamGroup(FormField):
 
 class ParamBoundsGroup(FormField):
     """Arranges a list of ParamBoundsInputs into a column."""
-    def __init__(self, label, fields, **kwargs):
-        field_dict = {field.kwargs["param"]: field for field in fields}
-        form_class = _get_dynamic_form(field_dict)
+    def __new__(cls, label, fields=None, form_class=None, **kwargs):
+        # built once per declaration; see ParamBoundsInput
+        if form_class is None:
+            form_class = _get_dynamic_form({field.kwargs["param"]: field for field in fields})
+        return super(ParamBoundsGroup, cls).__new__(cls, label=label, form_class=form_class, **kwargs)
+
+    def __init__(self, label, form_class, **kwargs):
         super(ParamBoundsGroup, self).__init__(form_class, label=label, widget=widgets.TopLevelWrapper(widgets.AdjacentRowsWidget(num_columns=1, use_latex_labels=True, show_labels=False)), **kwargs)
 
     def as_minmax_pair(self, *params):
@@ -205,3 +248,21 @@ def _get_dynamic_form(fields):
         setattr(F, field_name, field)
     return F
 
+
+def _get_bounds_form(size, default_min, default_max):
+    # inner class will encapsulate the actual fields
+    class F(FlaskForm):
+        min = NumpyInput(label="", size=size, default=default_min, is_subfield=True)
+        max = NumpyInput(label="", size=size, default=default_max, is_subfield=True)
+
+        def validate(self):
+            if not super(F, self).validate():
+                return False
+            self._errors = []
+            min_val = self.min.numpy_val
+            max_val = self.max.numpy_val
+            if not min_val <= max_val:
+                self._errors.append("Lower bound must be less-than-or-equal-to upper bound.")
+                return False
+            return True
+    return F
@@ -24,3 +24,12 @@ class NumpyValidator(object):
             if not isinstance(num, (int, long, float)):
                 raise ValidationError("Invalid value \"{0}\".  Expected: -inf, inf, or a numerical value.".format(field.data))
 
+
+class UploadRequired(object):
+    """Requires a file, or the token of a stored dataset in its place (see `BrowseSpreadsheetInput`)."""
+    field_flags = ("required",)
+
+    def __call__(self, form, field):
+        if not field.has_file() and field.token is None:
+            field.errors[:] = []
+            raise StopValidation(field.gettext('This field is required.'))
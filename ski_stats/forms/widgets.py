@@ -36,6 +36,16 @@ class TextInputWidget(object):
         return _input(field, **kwargs)
 
 
+class CheckboxWidget(object):
+    """Renders a checkbox."""
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault("type", "checkbox")
+        kwargs.setdefault("value", "y")
+        if field.data:
+            kwargs["checked"] = True
+        return _input(field, **kwargs)
+
+
 class MathEquationWidget(object):
     """Renders an empty div which will be populated by JavaScript on document load."""
     def __call__(self, field, **kwargs):
@@ -76,6 +86,10 @@ class RunButtonWidget(object):
                 <span class="{icon_class}"></span> {button_text}
             </button>
             <img class="spinner" src="{spinner_url}" style="display: none;"/>
+            <button class="cancel-button ui-button ui-widget ui-corner-all" type="button" style="display: none;">
+                <span class="ui-icon ui-icon-cancel"></span> Cancel
+            </button>
+            <span class="fit-progress"></span>
         </div>
         """.format(button_text=button_text, icon_class=icon_class, attributes=html_params(**kwargs), spinner_url=url_for("static", filename="spinner.gif")))
 
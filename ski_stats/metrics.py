@@ -0,0 +1,89 @@
+import os
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, \
+    CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+# Prometheus metrics for each stage of the analysis pipeline.
+# Under gunicorn, `config/gunicorn.py` sets `prometheus_multiproc_dir` before the app is imported, so that every
+# worker writes its samples to a shared directory and `/metrics` reports the aggregate across workers.
+
+MULTIPROC_DIR_ENV = "prometheus_multiproc_dir"
+
+STAGE_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 240)
+NFEV_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000, 100000, 1000000, 10000000)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+PARSE_SECONDS = Histogram("ski_stats_parse_seconds", "Time spent parsing uploaded spreadsheets.",
+                          buckets=STAGE_BUCKETS)
+FIT_SECONDS = Histogram("ski_stats_fit_seconds", "Time spent in least_squares, by termination status.",
+                        ["status"], buckets=STAGE_BUCKETS)
+FIT_NFEV = Histogram("ski_stats_fit_nfev", "Function evaluations per least_squares fit.", buckets=NFEV_BUCKETS)
+POSTFIT_SECONDS = Histogram("ski_stats_postfit_seconds", "Time spent on calculations after the fit.",
+                            buckets=STAGE_BUCKETS)
+RENDER_SECONDS = Histogram("ski_stats_render_seconds", "Time spent rendering plot images.", buckets=STAGE_BUCKETS)
+PERIODOGRAM_SECONDS = Histogram("ski_stats_periodogram_seconds", "Time spent computing periodograms.",
+                                buckets=STAGE_BUCKETS)
+
+REQUEST_SECONDS = Histogram("ski_stats_request_seconds", "Request latency, by endpoint.",
+                            ["endpoint", "method", "code"], buckets=STAGE_BUCKETS)
+RESPONSE_BYTES = Histogram("ski_stats_response_bytes", "Response body size, by endpoint.",
+                           ["endpoint"], buckets=SIZE_BUCKETS)
+REQUESTS_IN_PROGRESS = Gauge("ski_stats_requests_in_progress", "Requests currently being handled, by endpoint.",
+                             ["endpoint"], multiprocess_mode="livesum")
+
+COMPUTE_POOL_SIZE = Gauge("ski_stats_compute_pool_size", "Compute pool processes.", multiprocess_mode="livesum")
+COMPUTE_QUEUE_DEPTH = Gauge("ski_stats_compute_queue_depth",
+                            "Tasks submitted to the compute pool and not yet finished.", multiprocess_mode="livesum")
+COMPUTE_WAIT_SECONDS = Histogram("ski_stats_compute_wait_seconds", "Time tasks waited for a free compute process.",
+                                 buckets=STAGE_BUCKETS)
+COMPUTE_SHARED_BYTES = Counter("ski_stats_compute_shared_bytes_total",
+                               "Bytes of task arguments handed to the compute pool through scratch files.")
+COMPUTE_POOL_RESTARTS = Counter("ski_stats_compute_pool_restarts_total",
+                                "Compute pools replaced because one of their processes died.")
+
+HEAVY_IN_PROGRESS = Gauge("ski_stats_heavy_requests_in_progress", "Admitted expensive requests currently running.",
+                          multiprocess_mode="livesum")
+ADMISSION_WAIT_SECONDS = Histogram("ski_stats_admission_wait_seconds",
+                                   "Time admitted expensive requests waited for a run slot.", buckets=STAGE_BUCKETS)
+ADMISSION_REJECTED = Counter("ski_stats_admission_rejected_total", "Expensive requests turned away, by reason.",
+                             ["reason"])
+
+COALESCED_REQUESTS = Counter("ski_stats_coalesced_requests_total",
+                             "Analysis requests, by whether they ran (leader), shared the response of an identical "
+                             "request (follower), gave up waiting for one (timeout), or found no admission queue slot "
+                             "to wait in (busy).", ["role"])
+COALESCE_WAIT_SECONDS = Histogram("ski_stats_coalesce_wait_seconds",
+                                  "Time requests waited for an identical request to finish.", buckets=STAGE_BUCKETS)
+
+DATASET_LOOKUPS = Counter("ski_stats_dataset_lookups_total",
+                          "Lookups of stored datasets, by whether the dataset was found (hit) or not (miss).",
+                          ["result"])
+DATASET_EVICTIONS = Counter("ski_stats_dataset_evictions_total",
+                            "Stored datasets removed, by whether they expired or made room for others (size).",
+                            ["reason"])
+
+
+def observe_fit(result, seconds):
+    """Record an `optimize.least_squares` result.  `status` is SciPy's termination code (-1 through 4)."""
+    FIT_SECONDS.labels(status=str(result.status)).observe(seconds)
+    FIT_NFEV.observe(result.nfev)
+
+
+def is_multiprocess():
+    return MULTIPROC_DIR_ENV in os.environ
+
+
+def latest():
+    """Returns (body, content_type) of the current metrics, aggregated across workers in multiprocess mode."""
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Call from gunicorn's `child_exit` hook so that a dead worker's live gauges are discarded."""
+    if is_multiprocess():
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,355 @@
+import __future__
+import ast
+import keyword
+import threading
+from collections import namedtuple
+import numpy as np
+
+# Curve models declared once as an expression, e.g. `Model("h * cos(2 * pi * (x + v) / p) + b", ("h", "b", "v", "p"))`.
+# The expression is restricted to numbers, the params, the independent variable, a few constants and the functions
+# below.  On first use it is compiled with SymPy into vectorized NumPy functions for the curve and for its Jacobian,
+# with common subexpressions computed once, so that `least_squares` gets an exact Jacobian instead of finite differences.
+# For fitting, `Model.workspace()` also compiles kernels that evaluate into preallocated buffers through ufunc `out=`
+# arguments, with the subexpressions that don't depend on `x` (e.g. `2*pi/p`) computed once per call as scalars.
+# SymPy is imported at compile time only; see `ski_stats.warmup` for preloading.
+
+FUNCTIONS = {
+    "cos": "cos", "sin": "sin", "tan": "tan", "acos": "acos", "asin": "asin", "atan": "atan",
+    "cosh": "cosh", "sinh": "sinh", "tanh": "tanh", "exp": "exp", "log": "log", "sqrt": "sqrt", "abs": "Abs",
+}
+CONSTANTS = {"pi": "pi", "e": "E"}
+# SymPy function -> NumPy ufunc, for the in-place kernels; anything else is evaluated with temporaries
+UFUNCS = {
+    "cos": "cos", "sin": "sin", "tan": "tan", "acos": "arccos", "asin": "arcsin", "atan": "arctan",
+    "cosh": "cosh", "sinh": "sinh", "tanh": "tanh", "exp": "exp", "log": "log", "Abs": "absolute", "sign": "sign",
+}
+
+
+class Compiled(namedtuple("Compiled", ["expr", "curve", "jacobian", "residuals_into", "jacobian_into",
+                                       "num_buffers"])):
+    """A compiled model.  `curve` and `jacobian` return new arrays; `residuals_into` and `jacobian_into` write into
+    the arrays they are passed, using `num_buffers` scratch arrays the size of `x`.  See `Workspace`."""
+    __slots__ = ()
+
+
+class ModelError(ValueError):
+    """The model expression is not allowed or not valid."""
+    pass
+
+
+class Model(object):
+    """A curve `y = f(x; params)`.  `params` is the order in which param values are passed, as in SciPy."""
+    def __init__(self, expression, params, variable="x"):
+        self.expression = expression
+        self.params = tuple(params)
+        self.variable = variable
+        for name in self.params + (variable,):
+            # "numpy" is the namespace of the generated code
+            if not _is_identifier(name) or name in FUNCTIONS or name in CONSTANTS or name == "numpy":
+                raise ModelError("Invalid name: \"{0}\"".format(name))
+        if len(set(self.params + (variable,))) != len(self.params) + 1:
+            raise ModelError("Param and variable names must be unique.")
+        self._tree = _parse(expression, set(self.params + (variable,)))
+        self._compiled = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the compiled functions and the lock don't pickle; a copy sent to a compute process recompiles on first use
+        return {"expression": self.expression, "params": self.params, "variable": self.variable}
+
+    def __setstate__(self, state):
+        self.__init__(state["expression"], state["params"], state["variable"])
+
+    def __repr__(self):
+        return "Model({0!r}, {1!r})".format(self.expression, self.params)
+
+    @property
+    def compiled(self):
+        """The `Compiled` functions, compiled on first access."""
+        if self._compiled is None:
+            with self._lock:
+                if self._compiled is None:
+                    self._compiled = self._compile()
+        return self._compiled
+
+    @property
+    def latex(self):
+        import sympy
+        return sympy.latex(self.compiled.expr)
+
+    def evaluate(self, params, x):
+        """The curve at `x`."""
+        return self.compiled.curve(x, *params)[0]
+
+    def residuals(self, params, x, y):
+        """Residuals, with the arguments arranged as SciPy requires."""
+        return self.evaluate(params, x) - y
+
+    def jacobian(self, params, x, y):
+        """The Jacobian of the residuals with respect to the params, with the arguments arranged as SciPy requires."""
+        x = np.asarray(x)
+        jac = np.empty((x.size, len(self.params)))
+        for i, column in enumerate(self.compiled.jacobian(x, *params)):
+            # constant derivatives come back as scalars
+            jac[:, i] = column
+        return jac
+
+    def workspace(self, x, y):
+        """A `Workspace` for fitting the model to (x, y)."""
+        return Workspace(self, x, y)
+
+    def _compile(self):
+        import sympy
+        # real, so that e.g. the derivative of abs() is sign() rather than complex parts
+        symbols = {name: sympy.Symbol(name, real=True) for name in self.params + (self.variable,)}
+        expr = _to_sympy(self._tree.body, symbols, sympy)
+        derivatives = [sympy.diff(expr, symbols[name]) for name in self.params]
+        args = (self.variable,) + self.params
+        residuals_into, residuals_buffers = _InPlaceWriter(symbols[self.variable]).residuals(args, expr)
+        jacobian_into, jacobian_buffers = _InPlaceWriter(symbols[self.variable]).jacobian(args, derivatives)
+        return Compiled(expr, _lambdify("curve", args, [expr]), _lambdify("jacobian", args, derivatives),
+                        residuals_into, jacobian_into, max(residuals_buffers, jacobian_buffers))
+
+
+class Workspace(object):
+    """Preallocated arrays for evaluating a model's residuals and Jacobian on one dataset, many times over, as a fit
+    does.  Pass `residuals` and `jacobian` to `least_squares` in place of the model's (without `args`).
+
+    `residuals` returns a new array each call, since the solver holds on to the last accepted residuals while it tries
+    the next step, but computes it without temporaries.  `jacobian` overwrites and returns the same array each call.
+    """
+    def __init__(self, model, x, y):
+        compiled = model.compiled
+        self.x = np.ascontiguousarray(x, dtype=float)
+        self.y = np.ascontiguousarray(y, dtype=float)
+        self.jac = np.empty((self.x.size, len(model.params)), order="F")
+        # Fortran order, so that each column is contiguous
+        self._columns = [self.jac[:, i] for i in range(len(model.params))]
+        self._buffers = [np.empty(self.x.size) for _ in range(compiled.num_buffers)]
+        self._residuals_into = compiled.residuals_into
+        self._jacobian_into = compiled.jacobian_into
+
+    def residuals(self, params, *args):
+        return self._residuals_into(self.x, self.y, np.empty(self.x.size), self._buffers, *params)
+
+    def jacobian(self, params, *args):
+        self._jacobian_into(self.x, self._columns, self._buffers, *params)
+        return self.jac
+
+
+class _InPlaceWriter(object):
+    """Writes the source of a NumPy function that evaluates SymPy expressions of one vector variable into given
+    arrays: each operation is a ufunc call with `out=`, into the target array or a scratch buffer, and subexpressions
+    not involving the variable are evaluated as scalars."""
+    def __init__(self, variable):
+        from sympy.printing.pycode import NumPyPrinter
+        self.printer = NumPyPrinter()
+        self.vectors = {variable}
+        self.lines = []
+        self.num_buffers = 0
+        self._free = []
+
+    def residuals(self, args, expr):
+        """`residuals_into(x, y, out, buffers, *params)`, which returns `out`."""
+        replacements, (reduced,) = self._cse([expr])
+        for symbol, value in replacements:
+            self._assign(symbol, value)
+        self._store(reduced, "out")
+        self.lines.append("numpy.subtract(out, y, out=out)")
+        self.lines.append("return out")
+        return self._function("residuals_into", [args[0], "y", "out", "_buffers"] + list(args[1:]))
+
+    def jacobian(self, args, derivatives):
+        """`jacobian_into(x, columns, buffers, *params)`."""
+        replacements, reduced = self._cse(derivatives)
+        columns = ["_column{0}".format(i) for i in range(len(derivatives))]
+        self.lines.append("{0}, = _columns".format(", ".join(columns)))
+        for symbol, value in replacements:
+            self._assign(symbol, value)
+        for column, derivative in zip(columns, reduced):
+            self._store(derivative, column)
+        return self._function("jacobian_into", [args[0], "_columns", "_buffers"] + list(args[1:]))
+
+    def _cse(self, exprs):
+        import sympy
+        return sympy.cse(exprs, symbols=sympy.numbered_symbols("_cse"))
+
+    def _function(self, name, args):
+        if self.num_buffers:
+            self.lines.insert(0, "{0}, = _buffers[:{1}]".format(
+                ", ".join("_buffer{0}".format(i) for i in range(self.num_buffers)), self.num_buffers))
+        source = "def {0}({1}):\n".format(name, ", ".join(args)) + "".join("    " + line + "\n" for line in self.lines)
+        return _exec(name, source), self.num_buffers
+
+    def _acquire(self):
+        if self._free:
+            return self._free.pop()
+        self.num_buffers += 1
+        return "_buffer{0}".format(self.num_buffers - 1)
+
+    def _release(self, name):
+        self._free.append(name)
+
+    def _is_vector(self, expr):
+        return bool(expr.free_symbols & self.vectors)
+
+    def _scalar(self, expr):
+        return self.printer.doprint(expr)
+
+    def _assign(self, symbol, value):
+        # a common subexpression: a scalar local, or a buffer that is kept for the rest of the call
+        if self._is_vector(value):
+            target = self._acquire()
+            self.lines.append("{0} = {1}".format(symbol, self._emit(value, target)))
+            self.vectors.add(symbol)
+        else:
+            self.lines.append("{0} = {1}".format(symbol, self._scalar(value)))
+
+    def _store(self, expr, target):
+        if not self._is_vector(expr):
+            self.lines.append("{0}.fill({1})".format(target, self._scalar(expr)))
+            return
+        result = self._emit(expr, target)
+        if result != target:
+            self.lines.append("numpy.copyto({0}, {1})".format(target, result))
+
+    def _emit(self, expr, target):
+        """Write the lines that evaluate vector `expr`; returns the name of the array holding it, which is `target`
+        unless `expr` is already held by another array."""
+        import sympy
+        if expr in self.vectors:
+            return str(expr)
+
+        if isinstance(expr, (sympy.Add, sympy.Mul)):
+            is_mul = isinstance(expr, sympy.Mul)
+            ufunc = "numpy.multiply" if is_mul else "numpy.add"
+            scalars = [arg for arg in expr.args if not self._is_vector(arg)]
+            vectors = [arg for arg in expr.args if self._is_vector(arg)]
+            divisors = []
+            if is_mul:
+                # divide rather than multiply by reciprocals
+                divisors = [arg.args[0] for arg in vectors if arg.is_Pow and arg.args[1] == -1]
+                vectors = [arg for arg in vectors if not (arg.is_Pow and arg.args[1] == -1)] or [sympy.S.One]
+            result = self._emit(vectors[0], target) if self._is_vector(vectors[0]) else None
+            if result is None:
+                # only divisors are vectors
+                self.lines.append("{0}.fill({1})".format(target, self._scalar(vectors[0])))
+                result = target
+            for arg, op in [(arg, ufunc) for arg in vectors[1:]] + [(arg, "numpy.divide") for arg in divisors]:
+                buffer = self._acquire()
+                self.lines.append("{0}({1}, {2}, out={3})".format(op, result, self._emit(arg, buffer), target))
+                self._release(buffer)
+                result = target
+            if scalars:
+                self.lines.append("{0}({1}, {2}, out={3})".format(ufunc, result, self._scalar(expr.func(*scalars)),
+                                                                   target))
+                result = target
+            return result
+
+        if expr.is_Pow:
+            base, exponent = expr.args
+            if self._is_vector(exponent):
+                buffer = self._acquire()
+                base = self._emit(base, buffer) if self._is_vector(base) else self._scalar(base)
+                self.lines.append("numpy.power({0}, {1}, out={2})".format(base, self._emit(exponent, target), target))
+                self._release(buffer)
+                return target
+            result = self._emit(base, target)
+            if exponent == 2:
+                self.lines.append("numpy.square({0}, out={1})".format(result, target))
+            elif exponent == sympy.S.Half:
+                self.lines.append("numpy.sqrt({0}, out={1})".format(result, target))
+            elif exponent == -1:
+                self.lines.append("numpy.reciprocal({0}, out={1})".format(result, target))
+            else:
+                self.lines.append("numpy.power({0}, {1}, out={2})".format(result, self._scalar(exponent), target))
+            return target
+
+        name = type(expr).__name__
+        if name in UFUNCS and len(expr.args) == 1:
+            result = self._emit(expr.args[0], target)
+            self.lines.append("numpy.{0}({1}, out={2})".format(UFUNCS[name], result, target))
+            return target
+
+        # no in-place form; evaluated with temporaries
+        self.lines.append("{0}[...] = {1}".format(target, self._scalar(expr)))
+        return target
+
+
+def _parse(expression, names):
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as err:
+        raise ModelError("Invalid expression: {0}".format(err.msg))
+    called = set(id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call))
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Expression, ast.Num, ast.BinOp, ast.UnaryOp, ast.Load,
+                             ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)):
+            continue
+        elif isinstance(node, ast.Name):
+            if node.id in FUNCTIONS and id(node) not in called:
+                raise ModelError("\"{0}\" is a function.".format(node.id))
+            if node.id not in names and node.id not in CONSTANTS and node.id not in FUNCTIONS:
+                raise ModelError("Unknown name: \"{0}\"".format(node.id))
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+                raise ModelError("Only these functions are allowed: " + ", ".join(sorted(FUNCTIONS)))
+            if len(node.args) != 1 or node.keywords or node.starargs or node.kwargs:
+                raise ModelError("\"{0}\" takes a single argument.".format(node.func.id))
+        else:
+            raise ModelError("Not allowed in a model expression: {0}".format(type(node).__name__))
+    return tree
+
+
+def _to_sympy(node, symbols, sympy):
+    # builds the SymPy expression from the checked syntax tree, without `eval`
+    if isinstance(node, ast.Num):
+        return sympy.Integer(node.n) if isinstance(node.n, (int, long)) else sympy.Float(repr(node.n))
+    if isinstance(node, ast.Name):
+        if node.id in symbols:
+            return symbols[node.id]
+        return getattr(sympy, CONSTANTS[node.id])
+    if isinstance(node, ast.UnaryOp):
+        operand = _to_sympy(node.operand, symbols, sympy)
+        return -operand if isinstance(node.op, ast.USub) else operand
+    if isinstance(node, ast.BinOp):
+        left = _to_sympy(node.left, symbols, sympy)
+        right = _to_sympy(node.right, symbols, sympy)
+        if isinstance(node.op, ast.Add):
+            return left + right
+        if isinstance(node.op, ast.Sub):
+            return left - right
+        if isinstance(node.op, ast.Mult):
+            return left * right
+        if isinstance(node.op, ast.Div):
+            return left / right
+        return left ** right
+    if isinstance(node, ast.Call):
+        return getattr(sympy, FUNCTIONS[node.func.id])(_to_sympy(node.args[0], symbols, sympy))
+    raise ModelError("Not allowed in a model expression: {0}".format(type(node).__name__))
+
+
+def _lambdify(name, args, exprs):
+    """Generate a NumPy function of `args` returning a tuple of `exprs`, with common subexpressions computed once."""
+    import sympy
+    from sympy.printing.pycode import NumPyPrinter
+    printer = NumPyPrinter()
+    replacements, reduced = sympy.cse(exprs, symbols=sympy.numbered_symbols("_cse"))
+    lines = ["def {0}({1}):".format(name, ", ".join(args))]
+    for symbol, expr in replacements:
+        lines.append("    {0} = {1}".format(symbol, printer.doprint(expr)))
+    lines.append("    return ({0},)".format(", ".join(printer.doprint(expr) for expr in reduced)))
+    return _exec(name, "\n".join(lines) + "\n")
+
+
+def _exec(name, source):
+    namespace = {"numpy": np}
+    # true division, since SymPy prints rationals as `1/2`
+    code = compile(source, "<model {0}>".format(name), "exec", __future__.division.compiler_flag, True)
+    exec code in namespace
+    return namespace[name]
+
+
+def _is_identifier(name):
+    return isinstance(name, basestring) and not keyword.iskeyword(name) and not name.startswith("_") \
+        and name.replace("_", "a").isalnum() and not name[0].isdigit()
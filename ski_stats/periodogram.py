@@ -0,0 +1,180 @@
+from collections import namedtuple
+import numpy as np
+
+# Lomb-Scargle periodograms of unevenly sampled series, for finding the period `p` before a fit.  The power at each
+# frequency is that of the floating-mean (generalized) Lomb-Scargle periodogram of Zechmeister & Kurster (2009),
+# normalized to [0, 1] as the fraction of the data's variance explained by a sinusoid of that frequency.  The trig sums
+# behind it are computed directly for small problems, and with the FFT-based method of Press & Rybicki (1989) for large
+# ones: the data are "extirpolated" onto a regular grid, which turns every sum into one FFT, O(n + m log m) instead of
+# O(n * m) for n points and m frequencies.
+
+DEFAULT_SAMPLES_PER_PEAK = 5
+# longer grids drop the shortest periods (see `Spectrum.truncated`)
+MAX_FREQUENCIES = 2 ** 17
+# problems up to this many point-frequency terms use the direct sums, which are exact
+DIRECT_MAX_TERMS = 2 ** 18
+# rows of the direct sums' trig matrices computed at once, to bound memory
+DIRECT_BLOCK_TERMS = 2 ** 20
+# FFT grid points per frequency, and grid points each data point is spread over
+FFT_OVERSAMPLING = 5
+EXTIRPOLATION_ORDER = 4
+MIN_POINTS = 3
+
+Peak = namedtuple("Peak", "period power lower upper")
+
+
+class Spectrum(namedtuple("Spectrum", "frequency power baseline truncated")):
+    """A periodogram: the power at each frequency (cycles per unit of time), the time span of the data, and whether
+    the shortest periods asked for were dropped to keep the grid within `MAX_FREQUENCIES`."""
+    __slots__ = ()
+
+    @property
+    def period(self):
+        return 1 / self.frequency
+
+    def peaks(self, count=3):
+        """The `count` highest local maxima, highest first.  Each peak's `lower` and `upper` bound the periods within
+        its main lobe, which is 1 / baseline wide either side in frequency."""
+        power = self.power
+        is_peak = np.r_[power[0] > power[1], (power[1:-1] > power[:-2]) & (power[1:-1] >= power[2:]),
+                        power[-1] > power[-2]]
+        indices = np.flatnonzero(is_peak)
+        indices = indices[np.argsort(power[indices], kind="mergesort")[::-1][:count]]
+
+        half_width = 1 / self.baseline
+        peaks = []
+        for i in indices:
+            frequency = self.frequency[i]
+            upper = 1 / (frequency - half_width) if frequency > half_width else np.inf
+            peaks.append(Peak(1 / frequency, power[i], 1 / (frequency + half_width), upper))
+        return peaks
+
+
+def frequency_grid(time, min_period=None, max_period=None, samples_per_peak=DEFAULT_SAMPLES_PER_PEAK):
+    """A regular frequency grid (f0, df, count) covering periods from `min_period` (default: twice the median sampling
+    interval) to `max_period` (default: the time span of the data), with `samples_per_peak` frequencies across each
+    peak's main lobe."""
+    f0, df, count = _full_grid(time, min_period, max_period, samples_per_peak)
+    return f0, df, max(2, min(count, MAX_FREQUENCIES))
+
+
+def check(time, data, min_period=None, max_period=None):
+    """Raises ValueError if no periodogram can be computed from the series over the given periods, e.g. for a period
+    range that is empty for the data's sampling."""
+    _check_series(time, data)
+    _full_grid(time, min_period, max_period)
+
+
+def _check_series(time, data):
+    if time.size != data.size or time.size < MIN_POINTS:
+        raise ValueError("A periodogram needs matching time and data arrays of at least {0} points.".format(MIN_POINTS))
+    if data.min() == data.max():
+        raise ValueError("The data are constant.")
+
+
+def _full_grid(time, min_period, max_period, samples_per_peak=DEFAULT_SAMPLES_PER_PEAK):
+    # `frequency_grid`, before the count is capped
+    baseline = time.max() - time.min()
+    if baseline <= 0:
+        raise ValueError("The time values must span a non-zero interval.")
+    if min_period is None:
+        min_period = 2 * np.median(np.diff(np.sort(time)))
+    if max_period is None:
+        max_period = baseline
+    if not 0 < min_period < max_period:
+        raise ValueError("The period range must be positive and non-empty ({0:g} to {1:g}).".format(
+            min_period, max_period))
+
+    f0 = 1.0 / max_period
+    df = 1.0 / (samples_per_peak * baseline)
+    return f0, df, int(np.ceil((1.0 / min_period - f0) / df)) + 1
+
+
+def lomb_scargle(time, data, min_period=None, max_period=None, samples_per_peak=DEFAULT_SAMPLES_PER_PEAK,
+                 use_fft=None):
+    """The periodogram of `data` sampled at `time`, over the periods of `frequency_grid`.  `use_fft` picks the method;
+    by default the FFT method is used for large problems."""
+    time = np.asarray(time, dtype=float)
+    data = np.asarray(data, dtype=float)
+    _check_series(time, data)
+    f0, df, full_count = _full_grid(time, min_period, max_period, samples_per_peak)
+    count = max(2, min(full_count, MAX_FREQUENCIES))
+    if use_fft is None:
+        use_fft = time.size * count > DIRECT_MAX_TERMS
+
+    # the power follows from trig sums of the weights and weighted data at f and 2f (Press & Rybicki's trick for the
+    # time offset tau, with the floating-mean corrections)
+    weights = np.full(time.size, 1.0 / time.size)
+    centered = data - data.mean()
+    sums = _trig_sums_fft if use_fft else _trig_sums_direct
+    s_h, c_h = sums(time, weights * centered, f0, df, count)
+    s_2, c_2 = sums(time, weights, 2 * f0, 2 * df, count)
+    s_1, c_1 = sums(time, weights, f0, df, count)
+
+    tan_2wt = (s_2 - 2 * s_1 * c_1) / (c_2 - (c_1 * c_1 - s_1 * s_1))
+    sec_2wt = np.sqrt(1 + tan_2wt * tan_2wt)
+    sin_2wt = tan_2wt / sec_2wt
+    cos_2wt = 1 / sec_2wt
+    cos_wt = np.sqrt(0.5 * (1 + cos_2wt))
+    sin_wt = np.sign(sin_2wt) * np.sqrt(0.5 * (1 - cos_2wt))
+
+    yc = c_h * cos_wt + s_h * sin_wt
+    ys = s_h * cos_wt - c_h * sin_wt
+    cc = 0.5 * (1 + c_2 * cos_2wt + s_2 * sin_2wt) - (c_1 * cos_wt + s_1 * sin_wt) ** 2
+    ss = 0.5 * (1 - c_2 * cos_2wt - s_2 * sin_2wt) - (s_1 * cos_wt - c_1 * sin_wt) ** 2
+    yy = np.dot(weights, centered * centered)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        power = (yc * yc / cc + ys * ys / ss) / yy
+    # the sine terms vanish at the Nyquist frequency of evenly sampled data
+    power[~np.isfinite(power)] = 0
+
+    frequency = f0 + df * np.arange(count)
+    return Spectrum(frequency, power, time.max() - time.min(), count < full_count)
+
+
+def _trig_sums_direct(time, h, f0, df, count):
+    """sum(h * sin(2 pi f t)) and sum(h * cos(2 pi f t)) for f = f0 + df * k, k < count."""
+    sin_sums = np.empty(count)
+    cos_sums = np.empty(count)
+    block = max(1, DIRECT_BLOCK_TERMS // time.size)
+    for start in range(0, count, block):
+        frequency = f0 + df * np.arange(start, min(start + block, count))
+        phase = (2 * np.pi) * np.outer(frequency, time)
+        sin_sums[start:start + block] = np.dot(np.sin(phase), h)
+        cos_sums[start:start + block] = np.dot(np.cos(phase), h)
+    return sin_sums, cos_sums
+
+
+def _trig_sums_fft(time, h, f0, df, count):
+    """As `_trig_sums_direct`, by extirpolation onto a regular grid and an inverse FFT."""
+    size = 1 << int(np.ceil(np.log2(count * FFT_OVERSAMPLING)))
+    t0 = time.min()
+    # shift the grid's first frequency to f0
+    h = h * np.exp(2j * np.pi * f0 * (time - t0))
+    grid_position = ((time - t0) * size * df) % size
+    grid = _extirpolate(grid_position, h.real, size) + 1j * _extirpolate(grid_position, h.imag, size)
+    sums = size * np.fft.ifft(grid)[:count]
+    if t0 != 0:
+        sums *= np.exp(2j * np.pi * t0 * (f0 + df * np.arange(count)))
+    return sums.imag, sums.real
+
+
+def _extirpolate(x, y, size, order=EXTIRPOLATION_ORDER):
+    """Spread each value y at position x over the `order` nearest points of a regular grid of `size` points, with
+    Lagrange weights, so that sums of y times any smooth function of x are preserved."""
+    result = np.zeros(size)
+    exact = x % 1 == 0
+    result += np.bincount(x[exact].astype(int), y[exact], minlength=size)
+    x = x[~exact]
+    y = y[~exact]
+
+    # the `order` grid points around each x, kept within the grid
+    low = np.clip((x - order // 2).astype(int), 0, size - order)
+    numerator = y * np.prod(x - low - np.arange(order)[:, np.newaxis], axis=0)
+    denominator = float(np.prod(np.arange(1, order)))
+    for j in range(order):
+        if j > 0:
+            denominator *= j / float(j - order)
+        index = low + (order - 1 - j)
+        result += np.bincount(index, numerator / (denominator * (x - index)), minlength=size)
+    return result
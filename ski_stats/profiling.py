@@ -0,0 +1,59 @@
+import cProfile
+import functools
+import hmac
+import os
+import random
+import re
+import time
+import uuid
+from flask import request, current_app
+from ski_stats.common import ensure_dir
+
+# Opt-in per-request profiling.  A request is profiled if it carries the admin token configured as `PROFILE_TOKEN`,
+# in the `X-Profile` header (never a query arg, which would leave the token in access logs and browser history), or if
+# it is picked by `PROFILE_SAMPLE_RATE`.  Profiles are written in pstats format to `PROFILE_DIR`, and their id is
+# returned in the `X-Profile-Id` response header.
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_ID_PATTERN = re.compile(r"^[\w.-]+\.prof$")
+
+
+def is_admin():
+    """True if the request carries the configured profiling token."""
+    token = current_app.config.get("PROFILE_TOKEN")
+    if not token:
+        return False
+    supplied = request.headers.get(PROFILE_HEADER)
+    return supplied is not None and hmac.compare_digest(str(supplied), str(token))
+
+
+def should_profile():
+    rate = current_app.config.get("PROFILE_SAMPLE_RATE")
+    return (rate and random.random() < rate) or is_admin()
+
+
+def profiled(view):
+    """View decorator.  Profiles the view when requested; otherwise calls it directly."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not should_profile():
+            return view(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        try:
+            response = profiler.runcall(view, *args, **kwargs)
+        finally:
+            profile_id = save_profile(profiler, view.__name__)
+        response = current_app.make_response(response)
+        response.headers[PROFILE_ID_HEADER] = profile_id
+        return response
+    return wrapper
+
+
+def save_profile(profiler, name):
+    """Dump the profile to `PROFILE_DIR`.  Returns the profile id (its filename)."""
+    profile_dir = ensure_dir(current_app.config["PROFILE_DIR"])
+    profile_id = "{0}-{1}-{2}-{3}.prof".format(time.strftime("%Y%m%d-%H%M%S"), name, os.getpid(), uuid.uuid4().hex[:8])
+    profiler.dump_stats(os.path.join(profile_dir, profile_id))
+    return profile_id
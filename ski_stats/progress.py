@@ -0,0 +1,177 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import Future, wait
+import numpy as np
+from ski_stats import app
+from ski_stats.common import remove_quietly, sweep, atomic_write
+
+# Progress reporting and cancellation of fits.  A fit that a client wants to follow runs as a job, with a random id,
+# whose state is shared through files in `FIT_JOBS_DIR`, so that every gunicorn worker and compute pool process sees
+# it: `<id>.json` holds the latest progress snapshot, and `<id>.cancel` asks the solver to stop.  The solver checks in
+# from its residuals callback (see `lsq.solve`), at most every `REPORT_SECONDS`: it writes a snapshot, and raises
+# `FitCancelled` if the job was cancelled, which unwinds `least_squares` and frees the process for other work.  The
+# current thread's job is passed on to the compute pool by `ski_stats.compute`.
+
+EVENT_STREAM_MIMETYPE = "text/event-stream"
+REPORT_SECONDS = 0.25
+# files left behind by jobs whose worker died are removed after this long
+STALE_SECONDS = 3600
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+_local = threading.local()
+
+
+class FitCancelled(Exception):
+    # raised inside the solver when its job is cancelled
+    pass
+
+
+class FitJob(object):
+    """The shared state of one followed fit."""
+    def __init__(self, id):
+        self.id = id
+        directory = app.config["FIT_JOBS_DIR"]
+        self._progress_path = os.path.join(directory, id + ".json")
+        self._cancel_path = os.path.join(directory, id + ".cancel")
+
+    @classmethod
+    def create(cls):
+        # also creates the directory on first use
+        sweep(app.config["FIT_JOBS_DIR"], time.time() - STALE_SECONDS)
+        job = cls(uuid.uuid4().hex)
+        job.write_progress({})
+        return job
+
+    def exists(self):
+        return os.path.exists(self._progress_path)
+
+    def progress(self):
+        """The latest snapshot, or None if the job has gone."""
+        try:
+            with open(self._progress_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write_progress(self, snapshot):
+        with atomic_write(self._progress_path, "w") as f:
+            json.dump(snapshot, f)
+
+    def cancel(self):
+        """Ask the solver to stop.  Returns False if the job has already finished."""
+        if not self.exists():
+            return False
+        open(self._cancel_path, "a").close()
+        return True
+
+    def is_cancelled(self):
+        return os.path.exists(self._cancel_path)
+
+    def remove(self):
+        for path in (self._progress_path, self._cancel_path):
+            remove_quietly(path)
+
+
+class Reporter(object):
+    """Checks in for a job from inside one run of the solver."""
+    def __init__(self, job):
+        self.job = job
+        self.nfev = 0
+        self.njev = 0
+        self._next_report = 0
+
+    def residuals(self, func):
+        """Wrap the solver's residuals callback."""
+        def residuals(params, *args):
+            fun = func(params, *args)
+            self.nfev += 1
+            self.check_in(params, fun)
+            return fun
+        return residuals
+
+    def jacobian(self, func):
+        """Wrap the solver's Jacobian callback, to count iterations."""
+        def jacobian(params, *args):
+            self.njev += 1
+            return func(params, *args)
+        return jacobian
+
+    def check_in(self, params, fun):
+        now = time.time()
+        if now < self._next_report:
+            return
+        self._next_report = now + REPORT_SECONDS
+        if self.job.is_cancelled():
+            raise FitCancelled("The fit was cancelled.")
+        self.job.write_progress({"iteration": self.njev, "nfev": self.nfev, "cost": 0.5 * float(np.dot(fun, fun)),
+                                 "params": [float(param) for param in params]})
+
+
+@contextmanager
+def tracking(job_id):
+    """Run the body, and any solver it calls in this thread, as the job `job_id` (or untracked if None)."""
+    previous = current_job_id()
+    _local.job_id = job_id
+    try:
+        yield
+    finally:
+        _local.job_id = previous
+
+
+def current_job_id():
+    return getattr(_local, "job_id", None)
+
+
+def reporter():
+    """A `Reporter` for a run of the solver in the current thread's job, or None if the thread isn't tracked."""
+    job_id = current_job_id()
+    return Reporter(FitJob(job_id)) if job_id is not None else None
+
+
+def get_job(job_id):
+    """The job with the given id, or None if there is no such job in progress."""
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    job = FitJob(job_id)
+    return job if job.exists() else None
+
+
+def start(job, func):
+    """Call `func()` as the job in a new thread.  Returns a Future of its result."""
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        with tracking(job.id):
+            try:
+                result = func()
+            except Exception as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    thread = threading.Thread(target=run, name="fit-" + job.id[:8])
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def follow(job, future):
+    """Yields the job's latest snapshot every `REPORT_SECONDS` until `future` is done."""
+    while True:
+        wait([future], timeout=REPORT_SECONDS)
+        if future.done():
+            return
+        yield job.progress() or {}
+
+
+def event(name, data):
+    """A Server-Sent Event carrying `data` as JSON."""
+    return "event: {0}\ndata: {1}\n\n".format(name, json.dumps(data))
+
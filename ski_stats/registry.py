@@ -0,0 +1,91 @@
+import importlib
+import pkgutil
+import threading
+
+
+class Analysis(object):
+    """A discovered analysis script.  The module is imported on first access."""
+    def __init__(self, id, name, package_name):
+        self.id = id
+        self.name = name
+        self.module_name = "{0}.{1}".format(package_name, name)
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def module(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    print "[{0}] Loading analysis module \"{1}\"".format(self.id, self.name)
+                    self._module = importlib.import_module(self.module_name)
+        return self._module
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    @property
+    def is_valid(self):
+        """True if the script defines `get_html_form()` and `html_form_submitted(form)`.  Imports the module."""
+        module = self.module
+        return hasattr(module, "get_html_form") and hasattr(module.get_html_form, "__call__") \
+            and hasattr(module, "html_form_submitted") and hasattr(module.html_form_submitted, "__call__")
+
+
+class AnalysisRegistry(object):
+    """Analysis scripts of a package, indexed by id and name.
+
+    Discovery only lists the package directory; nothing is imported until an analysis is looked up.  Call `refresh()`
+    to pick up scripts added since the last scan, without a restart.  Ids are stable for the life of the process.
+    """
+    def __init__(self, package):
+        self.package = package
+        self._by_id = {}
+        self._by_name = {}
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Scan the package for new scripts.  Returns the newly discovered analyses."""
+        added = []
+        with self._lock:
+            for importer, modname, ispkg in pkgutil.iter_modules(self.package.__path__):
+                if ispkg or modname in self._by_name:
+                    continue
+                analysis = Analysis(len(self._by_name), modname, self.package.__name__)
+                print "[{0}] Found analysis module \"{1}\"".format(analysis.id, modname)
+                self._by_id[analysis.id] = analysis
+                self._by_name[modname] = analysis
+                added.append(analysis)
+        return added
+
+    def get(self, key):
+        """Look up a valid analysis by id (int or numeric string) or name.  Returns None if not found.
+
+        Unknown keys trigger a rescan, so that hot-added scripts are found.
+        """
+        analysis = self._lookup(key)
+        if analysis is None and self.refresh():
+            analysis = self._lookup(key)
+        if analysis is None or not analysis.is_valid:
+            return None
+        return analysis
+
+    def _lookup(self, key):
+        if isinstance(key, basestring) and not key.isdigit():
+            return self._by_name.get(key)
+        try:
+            return self._by_id.get(int(key))
+        except (TypeError, ValueError):
+            return None
+
+    def __iter__(self):
+        """Iterate the valid analyses in id order.  Imports any modules not yet loaded."""
+        for id in sorted(self._by_id):
+            analysis = self._by_id[id]
+            if analysis.is_valid:
+                yield analysis
+
+    def __len__(self):
+        return len(self._by_id)
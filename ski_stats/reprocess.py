@@ -0,0 +1,235 @@
+import csv
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import sys
+import timeit
+from ski_stats import compute, export
+from ski_stats.common import parse_file, ensure_dir, atomic_write
+
+# Headless reprocessing of many spreadsheets, e.g. nightly, without the web server:
+#
+#   python -m ski_stats.reprocess recordings/ "archive/2019-*/*.xlsx" -o reprocessed/ --bound p=20,28
+#
+# The first worksheet of each spreadsheet (or the columns of each CSV/TSV or NumPy file, see `ski_stats.formats`) is
+# fitted like the "Least Squares Curve Fit" form does, across a process pool, and its plot written under the output
+# directory (mirroring the spreadsheets' directories).  Each result is appended to a combined CSV table as soon as it is
+# done, so an interrupted run loses nothing; rerunning skips the spreadsheets already fitted successfully, unless they
+# have changed since or were fitted with other options (the table keeps a digest of them).  The exit status is non-zero
+# if any spreadsheet failed.
+
+SPREADSHEET_PATTERNS = ("*.xlsx", "*.xls", "*.csv", "*.tsv", "*.csv.gz", "*.tsv.gz", "*.npy", "*.npz")
+RESULTS_FILENAME = "results.csv"
+RESULTS_COLUMNS = ("file", "modified", "options", "status", "h", "b", "v", "p", "r", "r2", "ss", "acrophase", "peak_value",
+                   "mesor", "crossings", "peaks", "seconds", "error")
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+EXIT_FAILURES = 1
+
+
+def find_spreadsheets(patterns):
+    """The spreadsheets matching any of the glob patterns or directories (searched recursively), sorted, as absolute
+    paths."""
+    found = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for dir_path, _, file_names in os.walk(pattern):
+                for file_pattern in SPREADSHEET_PATTERNS:
+                    found.update(os.path.join(dir_path, name) for name in file_names
+                                 if fnmatch.fnmatch(name, file_pattern))
+        else:
+            found.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+    # skip the lock files Excel leaves next to open workbooks
+    return sorted(os.path.abspath(path) for path in found if not os.path.basename(path).startswith("~$"))
+
+
+def image_paths(spreadsheets, output_dir):
+    """The plot image path of each spreadsheet: its path relative to the spreadsheets' common directory, under
+    `output_dir`."""
+    common_dir = os.sep.join(os.path.commonprefix([os.path.dirname(path).split(os.sep) for path in spreadsheets]))
+    return [os.path.join(output_dir, os.path.splitext(os.path.relpath(path, common_dir or os.sep))[0] + ".png")
+            for path in spreadsheets]
+
+
+def read_finished(results_path):
+    """The rows of a previous run's results table that finished successfully, by file."""
+    if not os.path.exists(results_path):
+        return {}
+    with open(results_path, "rb") as f:
+        return {row["file"]: row for row in csv.DictReader(f) if row.get("status") == STATUS_OK}
+
+
+def is_finished(row, spreadsheet, image_path, digest):
+    """Whether a previous run's result for the spreadsheet still stands: the spreadsheet is unchanged, it was fitted
+    with the options of `digest` (see `options_digest`), and its plot (if plotting) is still there."""
+    return (row is not None and row["modified"] == _modified(spreadsheet) and row.get("options") == digest and
+            (image_path is None or os.path.exists(image_path)))
+
+
+def options_digest(options):
+    """A short digest of the fit options (as `batch.decode_options` returns them), stored with each result."""
+    return hashlib.sha1(json.dumps(options, sort_keys=True)).hexdigest()[:16]
+
+
+def process_spreadsheet(spreadsheet, image_path, params_guess, bounds, max_nfev, auto_period, method):
+    """Fit and plot one spreadsheet.  Returns its row of the results table; failures are reported in the row rather
+    than raised.  Dispatched to the compute pool."""
+    from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+
+    start = timeit.default_timer()
+    modified = _modified(spreadsheet)
+    try:
+        time, data = parse_file(spreadsheet)
+        results = lsq.do_calculations(time, data, params_guess, bounds, max_nfev, auto_period, method)
+        if image_path is not None:
+            _write_image(image_path, lsq.generate_plot_image(time, data, results))
+        row, status = export.row_from_results(results), STATUS_OK
+    except Exception as err:
+        row, status = export.row_from_error(err), STATUS_FAILED
+    return _table_row(spreadsheet, modified, status, row, timeit.default_timer() - start)
+
+
+def reprocess(spreadsheets, output_dir, options, plot=True, resume=True, progress=None):
+    """Process the spreadsheets across the compute pool, appending each one's row to the results table in
+    `output_dir`.  With `resume`, spreadsheets a previous run finished are skipped and keep their rows.  Calls
+    `progress(done, total, row)` as each finishes.  Returns the counts of (succeeded, failed, skipped) spreadsheets."""
+    results_path = os.path.join(output_dir, RESULTS_FILENAME)
+    images = image_paths(spreadsheets, output_dir) if plot else [None] * len(spreadsheets)
+    finished = read_finished(results_path) if resume else {}
+    digest = options_digest(options)
+
+    kept = []
+    tasks = []
+    for spreadsheet, image_path in zip(spreadsheets, images):
+        row = finished.get(spreadsheet)
+        if is_finished(row, spreadsheet, image_path, digest):
+            kept.append(row)
+        else:
+            tasks.append((spreadsheet, image_path, options["params_guess"], options["bounds"], options["max_nfev"],
+                          options["auto_period"], options["method"]))
+
+    # rewrite the table with the kept rows, then append to it as results arrive
+    partial_path = results_path + ".part"
+    counts = {STATUS_OK: 0, STATUS_FAILED: 0}
+    with open(partial_path, "wb") as f:
+        writer = csv.DictWriter(f, RESULTS_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(kept)
+        f.flush()
+        os.rename(partial_path, results_path)
+
+        for done, row in enumerate(compute.imap(process_spreadsheet, iter(tasks), ordered=False), 1):
+            row["options"] = digest
+            writer.writerow(row)
+            f.flush()
+            counts[row["status"]] += 1
+            if progress is not None:
+                progress(done, len(tasks), row)
+    return counts[STATUS_OK], counts[STATUS_FAILED], len(kept)
+
+
+def main():
+    """Commandline runner; see the module comment."""
+    import argparse
+    import multiprocessing
+    from werkzeug.exceptions import BadRequest
+    from ski_stats import app, batch, solver
+
+    parser = argparse.ArgumentParser(description="Fit and plot every spreadsheet in the given directories or globs.")
+    parser.add_argument("inputs", nargs="+", metavar="DIR_OR_GLOB")
+    parser.add_argument("-o", "--output-dir", default="reprocessed")
+    parser.add_argument("--guess", action="append", default=[], metavar="NAME=VALUE",
+                        help="initial guess of a param, e.g. p=12 (default: the form's defaults)")
+    parser.add_argument("--bound", action="append", default=[], metavar="NAME=MIN,MAX",
+                        help="bounds of a param, e.g. p=20,28 or h=0,inf")
+    parser.add_argument("--max-nfev", type=int)
+    parser.add_argument("--auto-period", action="store_true", help="seed the period from the periodogram")
+    parser.add_argument("--method", choices=solver.METHODS, default=solver.AUTO,
+                        help="solver method (default: chosen per fit)")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--no-plots", action="store_true", help="only write the results table")
+    parser.add_argument("--no-resume", action="store_true", help="reprocess spreadsheets a previous run finished")
+    args = parser.parse_args()
+
+    try:
+        options = batch.decode_options(_parse_assignments(args.guess, parser),
+                                       {name: value.split(",") for name, value
+                                        in _parse_assignments(args.bound, parser).items()},
+                                       args.max_nfev, args.auto_period, args.method)
+    except BadRequest as err:
+        parser.error(err.description)
+    spreadsheets = find_spreadsheets(args.inputs)
+    if not spreadsheets:
+        parser.error("no spreadsheets found in " + ", ".join(args.inputs))
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    def progress(done, total, row):
+        line = "[{0}/{1}] {2} {3} ({4:.1f}s)".format(done, total, row["status"], row["file"], float(row["seconds"]))
+        if row["error"]:
+            line += ": " + row["error"]
+        sys.stderr.write(line + "\n")
+
+    app.config["COMPUTE_PROCESSES"] = args.processes
+    start = timeit.default_timer()
+    try:
+        succeeded, failed, skipped = reprocess(spreadsheets, args.output_dir, options, plot=not args.no_plots,
+                                               resume=not args.no_resume, progress=progress)
+    finally:
+        compute.shutdown()
+    print "{0} succeeded, {1} failed, {2} already done, in {3:.1f}s; results in {4}".format(
+        succeeded, failed, skipped, timeit.default_timer() - start, os.path.join(args.output_dir, RESULTS_FILENAME))
+    if failed:
+        sys.exit(EXIT_FAILURES)
+
+
+def _parse_assignments(assignments, parser):
+    # NAME=VALUE arguments to a dict
+    parsed = {}
+    for assignment in assignments:
+        name, sep, value = assignment.partition("=")
+        if not sep:
+            parser.error("expected NAME=VALUE, got " + assignment)
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+def _modified(path):
+    # compared as text, since that's how the results table stores it
+    return repr(os.path.getmtime(path))
+
+
+def _write_image(image_path, buf):
+    # see `common.atomic_write`: a plot is never left half-written for a resumed run to trust
+    try:
+        ensure_dir(os.path.dirname(image_path))
+        with atomic_write(image_path) as f:
+            f.write(buf.getvalue())
+    finally:
+        buf.close()
+
+
+def _table_row(spreadsheet, modified, status, row, seconds):
+    params = row.params if row.params is not None else [None] * 4
+    values = dict(zip(("h", "b", "v", "p"), params))
+    values.update(file=spreadsheet, modified=modified, status=status, r=row.r, r2=row.r2, ss=row.ss,
+                  acrophase=row.acrophase, peak_value=row.peak_value, mesor=row.mesor,
+                  crossings=len(row.crossings) if row.crossings is not None else None,
+                  peaks=len(row.peaks) if row.peaks is not None else None, seconds="{0:.3f}".format(seconds),
+                  error=row.error.encode("utf-8") if isinstance(row.error, unicode) else row.error)
+    return {name: _csv_value(value) for name, value in values.items()}
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if hasattr(value, "item"):
+        value = value.item()
+    return repr(value) if isinstance(value, float) else value
+
+
+# if script is being run directly from commandline
+if __name__ == "__main__":
+    main()
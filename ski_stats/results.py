@@ -0,0 +1,122 @@
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
+import numpy as np
+
+# The results of a cosine fit and its post-fit calculations (see `lsq.do_calculations`) as a fixed schema of contiguous
+# arrays, so that they can be moved between processes, cached or stored cheaply.  Peaks are stored as [start, stop)
+# offsets into one timeline (the data points and the mesor crossings, in time order) rather than as lists of points.
+# `save` writes a versioned .npz archive, and `to_json` a JSON-serializable view.  Values that repeat stored ones
+# (`y_int`, `peak_time_list`, ...) are derived on access, under the names the results have always had.
+
+SCHEMA_VERSION = 1
+
+# name: (dtype, number of dimensions); 0 dimensions is a float scalar
+FIELDS = OrderedDict([
+    # the solved [h, b, v, p] and goodness of fit
+    ("lsq_params", (np.float64, 1)),
+    ("lsq_residuals", (np.float64, 1)),
+    ("ss_lsq", (np.float64, 0)),
+    ("lsq_r", (np.float64, 0)),
+    ("lsq_r2", (np.float64, 0)),
+    # the fitted curve's first peak, every peak within the data, and its mesor
+    ("lsq_acro", (np.float64, 0)),
+    ("lsq_peak_value", (np.float64, 0)),
+    ("lsq_acro_list_x", (np.float64, 1)),
+    ("lsq_mesor", (np.float64, 0)),
+    # mesor crossings of the data: the index and time of the point before each, and its interpolated time
+    ("idx", (np.int64, 1)),
+    ("x_int", (np.float64, 1)),
+    ("crossing_points", (np.float64, 1)),
+    # the timeline, and offsets into it of the crossings bounding peaks, onsets and offsets
+    ("all_time", (np.float64, 1)),
+    ("all_data", (np.float64, 1)),
+    ("index_coords", (np.int64, 1)),
+    ("onset_coords", (np.int64, 1)),
+    ("offset_coords", (np.int64, 1)),
+    # positions in `index_coords` of the onsets and offsets
+    ("onset_index_coords", (np.int64, 1)),
+    ("offset_index_coords", (np.int64, 1)),
+    # each onset-offset peak as [start, stop) offsets into the timeline, and its AUCs
+    ("peak_bounds", (np.int64, 2)),
+    ("peak_auc_list", (np.float64, 1)),
+    ("peak_mp_auc_list", (np.float64, 1)),
+])
+
+
+class FitResults(object):
+    """The results of `lsq.do_calculations`; see the module comment.  Construct with every field of `FIELDS`."""
+    def __init__(self, **fields):
+        missing = [name for name in FIELDS if name not in fields]
+        if missing:
+            raise ValueError("Missing result fields: " + ", ".join(missing))
+        for name, (dtype, ndim) in FIELDS.items():
+            value = fields[name]
+            if ndim == 0:
+                value = float(value)
+            else:
+                value = np.ascontiguousarray(value, dtype=dtype)
+                if value.size == 0:
+                    value = value.reshape((0,) * ndim if ndim == 1 else (0, 2))
+                if value.ndim != ndim:
+                    raise ValueError("Result field \"{0}\" must have {1} dimensions, not {2}.".format(
+                        name, ndim, value.ndim))
+            setattr(self, name, value)
+
+    @property
+    def y_int(self):
+        return np.full(self.crossing_points.size, self.lsq_mesor)
+
+    @property
+    def lsq_acro_list_y(self):
+        return np.full(self.lsq_acro_list_x.size, self.lsq_peak_value)
+
+    @property
+    def peak_time_list(self):
+        return [self.all_time[start:stop] for start, stop in self.peak_bounds]
+
+    @property
+    def peak_data_list(self):
+        return [self.all_data[start:stop] for start, stop in self.peak_bounds]
+
+    def save(self, file):
+        """Write the results to a filename or file object as an (uncompressed) .npz archive."""
+        # as `np.savez` does, but without staging each array in a temporary file on disk
+        with zipfile.ZipFile(file, "w", zipfile.ZIP_STORED) as archive:
+            for name, value in [("version", SCHEMA_VERSION)] + [(name, getattr(self, name)) for name in FIELDS]:
+                buf = BytesIO()
+                np.lib.format.write_array(buf, np.asarray(value), allow_pickle=False)
+                archive.writestr(name + ".npy", buf.getvalue())
+
+    @classmethod
+    def load(cls, file):
+        """Read results written by `save`.  Raises ValueError if they aren't of this schema version."""
+        with np.load(file, allow_pickle=False) as archive:
+            version = int(archive["version"]) if "version" in archive.files else None
+            if version != SCHEMA_VERSION:
+                raise ValueError("Unsupported results version: {0} (expected {1}).".format(version, SCHEMA_VERSION))
+            return cls(**{name: archive[name] for name in FIELDS if name in archive.files})
+
+    def to_bytes(self):
+        buf = BytesIO()
+        self.save(buf)
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.load(BytesIO(data))
+
+    def to_json(self):
+        """The results as numbers and lists, with non-finite numbers as None."""
+        view = OrderedDict([("version", SCHEMA_VERSION)])
+        for name in FIELDS:
+            view[name] = _json_value(getattr(self, name))
+        return view
+
+
+def _json_value(value):
+    if isinstance(value, float):
+        return value if np.isfinite(value) else None
+    if value.dtype.kind == "f" and not np.isfinite(value).all():
+        return np.where(np.isfinite(value), value, None).tolist()
+    return value.tolist()
@@ -0,0 +1,134 @@
+import errno
+import mmap
+import os
+import time
+import uuid
+import numpy as np
+from ski_stats import app
+from ski_stats.common import remove_quietly, sweep
+
+# Zero-copy hand-off of large arrays to the compute pool.  Pickling a task's arguments copies each array three times
+# (into the pickle, through the pipe, out of the pickle) and holds two extra copies in memory while it does.  Instead,
+# `ski_stats.compute` writes arrays of at least `SHARE_MIN_BYTES` once to a scratch file in `COMPUTE_SCRATCH_DIR`
+# (shared memory under /dev/shm by default) and sends a small `SharedArray` handle, which the pool process maps
+# read-only.  The submitting process removes the file once the task is done; files of processes that died first are
+# removed by the next `ScratchFile` created on the host.
+
+# smaller arrays are cheaper to pickle than to write to a file
+SHARE_MIN_BYTES = 256 * 1024
+# each array starts at a multiple of this, to keep them aligned for SIMD loads
+ALIGNMENT = 64
+# files older than this are removed even if their process seems alive (its pid may have been reused)
+STALE_SECONDS = 24 * 3600
+
+
+class SharedArray(object):
+    """A picklable handle to a read-only array in a scratch file."""
+    __slots__ = ("path", "offset", "dtype", "shape")
+
+    def __init__(self, path, offset, dtype, shape):
+        self.path = path
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+
+    def __getstate__(self):
+        return self.path, self.offset, self.dtype, self.shape
+
+    def __setstate__(self, state):
+        self.path, self.offset, self.dtype, self.shape = state
+
+    def open(self, maps=None):
+        """Map the array.  `maps` caches the mapping of each file, for handles that share one."""
+        buf = maps.get(self.path) if maps is not None else None
+        if buf is None:
+            with open(self.path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if maps is not None:
+                maps[self.path] = buf
+        dtype = np.dtype(self.dtype)
+        return np.frombuffer(buf, dtype, int(np.prod(self.shape)), self.offset).reshape(self.shape)
+
+
+class ScratchFile(object):
+    """Writes the large arrays of some tasks' arguments to one scratch file, replacing them with `SharedArray`s.  An
+    array passed to several of the tasks is written once.  `remove` (or closing the context) deletes the file."""
+    def __init__(self):
+        self.directory = app.config["COMPUTE_SCRATCH_DIR"]
+        self.path = None
+        self.size = 0
+        self._file = None
+        self._handles = {}
+        # the shared arrays, so that their ids aren't reused while the file is written
+        self._arrays = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.remove()
+
+    def share_args(self, args, kwargs):
+        """`args` and `kwargs` with their large arrays shared."""
+        return (tuple(self.share(value) for value in args),
+                {name: self.share(value) for name, value in kwargs.items()})
+
+    def share(self, value):
+        """A `SharedArray` for `value` if it is a large enough array of numbers, otherwise `value`."""
+        if (type(value) is not np.ndarray or value.nbytes < SHARE_MIN_BYTES or value.dtype.hasobject or
+                value.dtype.fields is not None):
+            return value
+        handle = self._handles.get(id(value))
+        if handle is None:
+            handle = self._handles[id(value)] = self._write(value)
+            self._arrays.append(value)
+        return handle
+
+    def close(self):
+        """Finish writing; call before the tasks are submitted."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._arrays = []
+
+    def remove(self):
+        self.close()
+        if self.path is not None:
+            remove_quietly(self.path)
+            self.path = None
+
+    def _write(self, array):
+        if self._file is None:
+            _sweep(self.directory)
+            self.path = os.path.join(self.directory, "{0}-{1}.bin".format(os.getpid(), uuid.uuid4().hex))
+            self._file = open(self.path, "wb")
+        offset = (self.size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        self._file.write(b"\0" * (offset - self.size))
+        np.ascontiguousarray(array).tofile(self._file)
+        self.size = offset + array.nbytes
+        return SharedArray(self.path, offset, array.dtype.str, array.shape)
+
+
+def open_args(args, kwargs):
+    """`args` and `kwargs` with each `SharedArray` mapped; the inverse of `ScratchFile.share_args`."""
+    maps = {}
+    args = tuple(value.open(maps) if isinstance(value, SharedArray) else value for value in args)
+    kwargs = {name: value.open(maps) if isinstance(value, SharedArray) else value for name, value in kwargs.items()}
+    return args, kwargs
+
+
+def _sweep(directory):
+    # remove the files of processes that have exited without removing them, creating the directory on first use
+    for path, stat in sweep(directory, time.time() - STALE_SECONDS):
+        pid = os.path.basename(path).partition("-")[0]
+        if pid.isdigit() and not _is_alive(int(pid)):
+            remove_quietly(path)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
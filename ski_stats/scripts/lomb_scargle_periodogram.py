@@ -0,0 +1,148 @@
+import numpy as np
+from io import BytesIO
+from werkzeug.exceptions import BadRequest
+from wtforms.validators import Optional, ValidationError
+from ski_stats import metrics, compute, periodogram
+from ski_stats.common import parse_file
+from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+from flask_wtf import FlaskForm
+from ski_stats.forms.fields import Title, BrowseSpreadsheetInput, RunButton, NumberInput
+
+# The Lomb-Scargle periodogram of a recording (see `ski_stats.periodogram`): which periods the data repeat at, and how
+# strongly.  No curve is fitted, so this is quick even for long recordings, and its highest peak is a good value for the
+# period p of the cosine fits.
+
+DEFAULT_PEAKS = 3
+MAX_PEAKS = 10
+
+
+def compute_spectrum(time, data, min_period=None, max_period=None):
+    """The periodogram of the recording, over periods from `min_period` to `max_period` (defaults: see
+    `periodogram.frequency_grid`)."""
+    with metrics.PERIODOGRAM_SECONDS.time():
+        return periodogram.lomb_scargle(time, data, min_period, max_period)
+
+
+@metrics.RENDER_SECONDS.time()
+def generate_plot_image(spectrum, peaks):
+    """The power against period, with the highest peaks marked."""
+    plt = lsq._pyplot()
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.plot(spectrum.period, spectrum.power, "k-", linewidth=0.8)
+    for rank, peak in enumerate(peaks):
+        ax.axvline(peak.period, color="r" if rank == 0 else "y", linestyle="--", linewidth=1)
+        ax.annotate("{0:.4g} h ({1:.2f})".format(peak.period, peak.power), xy=(peak.period, peak.power),
+                    xytext=(4, 4), textcoords="offset points")
+    ax.set_xscale("log")
+    ax.set_xlim(spectrum.period.min(), spectrum.period.max())
+    ax.set_ylim(0, max(1e-3, spectrum.power.max()) * 1.1)
+    title = "Lomb-Scargle Periodogram"
+    if spectrum.truncated:
+        title += "\n(periods under {0:.4g} h not computed: limited to {1:d} frequencies)".format(
+            spectrum.period.min(), len(spectrum.frequency))
+    ax.set_title(title)
+    ax.set_xlabel("Period (hours)")
+    ax.set_ylabel("Power (fraction of variance)")
+
+    fig.tight_layout()
+    buf = BytesIO()
+    fig.savefig(buf, format="png")
+    plt.close(fig)
+    buf.seek(0)
+    return buf
+
+
+def spectrum_and_render(time, data, min_period, max_period, num_peaks):
+    """Compute the periodogram and return the PNG image bytes.  Dispatched to the compute pool."""
+    spectrum = compute_spectrum(time, data, min_period, max_period)
+    buf = generate_plot_image(spectrum, spectrum.peaks(num_peaks))
+    try:
+        return buf.getvalue()
+    finally:
+        buf.close()
+
+
+def spectrum_csv(spectrum):
+    """The periodogram as CSV text, longest period first."""
+    lines = ["frequency,period,power"]
+    lines.extend("{0:.10g},{1:.10g},{2:.10g}".format(f, 1 / f, power)
+                 for f, power in zip(spectrum.frequency, spectrum.power))
+    return "\n".join(lines) + "\n"
+
+
+class HtmlForm(FlaskForm):
+    """The web form fields."""
+    title = Title("Lomb-Scargle Periodogram")
+    spreadsheet = BrowseSpreadsheetInput(label="Select measurement data")
+    min_period = NumberInput(label="Shortest period (hours; default: twice the sampling interval)", required=False,
+                             validators=[Optional()], min=0)
+    max_period = NumberInput(label="Longest period (hours; default: the length of the recording)", required=False,
+                             validators=[Optional()], min=0)
+    num_peaks = NumberInput(label="Peaks to mark", default=DEFAULT_PEAKS, min=1, max=MAX_PEAKS, step=1)
+    do_periodogram = RunButton(label="", button_text="Compute periodogram")
+
+    def validate_min_period(self, field):
+        if field.data is not None and field.data <= 0:
+            raise ValidationError("Must be greater than 0.")
+
+    def validate_max_period(self, field):
+        if field.data is not None and self.min_period.data is not None and field.data <= self.min_period.data:
+            raise ValidationError("Must be longer than the shortest period.")
+
+
+def get_html_form():
+    """A new instance of the web form, bound to the current request."""
+    return HtmlForm()
+
+
+def html_form_submitted(form):
+    """Handler for web form submission."""
+    time, data = form.spreadsheet.parse()
+    min_period = float(form.min_period.data) if form.min_period.data is not None else None
+    max_period = float(form.max_period.data) if form.max_period.data is not None else None
+    try:
+        # e.g. a range the defaults make empty, such as a longest period under twice the sampling interval
+        periodogram.check(time, data, min_period, max_period)
+    except ValueError as err:
+        raise BadRequest(str(err))
+    return BytesIO(compute.run(spectrum_and_render, time, data, min_period, max_period, int(form.num_peaks.data)))
+
+
+def main():
+    """Commandline runner: writes the periodogram plot and a CSV of the spectrum next to the spreadsheet, and prints
+    the highest peaks."""
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description="Lomb-Scargle periodogram of a spreadsheet.")
+    parser.add_argument("spreadsheet")
+    parser.add_argument("--min-period", type=float)
+    parser.add_argument("--max-period", type=float)
+    parser.add_argument("--peaks", type=int, default=DEFAULT_PEAKS)
+    args = parser.parse_args()
+
+    time, data = parse_file(args.spreadsheet)
+    spectrum = compute_spectrum(time, data, args.min_period, args.max_period)
+    peaks = spectrum.peaks(args.peaks)
+
+    base = os.path.splitext(args.spreadsheet)[0] + "_periodogram"
+    buf = generate_plot_image(spectrum, peaks)
+    try:
+        with open(base + ".png", "wb") as f:
+            f.write(buf.getvalue())
+    finally:
+        buf.close()
+    with open(base + ".csv", "w") as f:
+        f.write(spectrum_csv(spectrum))
+
+    if spectrum.truncated:
+        print "periods under {0:.4g} not computed: limited to {1:d} frequencies".format(
+            spectrum.period.min(), len(spectrum.frequency))
+    for peak in peaks:
+        print "p = {0:.4f} (power {1:.3f}, peak from {2:.4f} to {3:.4f})".format(*peak)
+    print "wrote {0}.png and {0}.csv".format(base)
+
+
+# if script is being run directly from commandline
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import numpy as np
+from io import BytesIO
+from werkzeug.exceptions import BadRequest
+from wtforms.validators import ValidationError
+from ski_stats import metrics, compute
+from ski_stats.common import parse_file, CurveFitException
+from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+from flask_wtf import FlaskForm
+from ski_stats.forms.fields import Title, BrowseSpreadsheetInput, RunButton, NumberInput, CheckboxInput, MathEquation, ParamInput, ParamBoundsInput, ParamGroup, ParamBoundsGroup
+
+# The cosine fit of `ski_slope_least_squares_3_oct`, repeated over a window sliding along a long recording, to show how
+# amplitude, mesor and acrophase drift from day to day.  The windows are split into contiguous chunks which are fitted
+# in parallel across the compute pool (see `ski_stats.compute`); within a chunk, each window starts from the previous
+# window's solution.  The first chunk starts from the initial guess, as the single fit does; the others start from a
+# linear cosinor fit of their first window at the guessed period, since the initial guess is rarely close that far into
+# a recording.
+
+DEFAULT_WINDOW = 72
+DEFAULT_STEP = 24
+MIN_WINDOW_POINTS = len(lsq.DEFAULT_INITIAL_PARAMS_GUESS)
+# chunks per compute process, so that uneven chunks still keep every process busy
+CHUNKS_PER_PROCESS = 4
+# raw data points drawn in the summary plot; longer recordings are thinned for display
+MAX_PLOTTED_POINTS = 20000
+
+# per-window results, in column order; "error" is 1 for windows the solver raised on (e.g. non-finite residuals at the
+# guess), which are left unfitted rather than failing the whole analysis
+WINDOW_FIELDS = ("start", "end", "center", "points", "h", "b", "v", "p", "acrophase", "r2", "status", "nfev", "error")
+
+
+def window_indices(time, window, step):
+    """The [start, end) row indices of each window of length `window`, starting every `step` from the first time
+    point.  `time` must be sorted."""
+    if window <= 0 or step <= 0:
+        raise CurveFitException("Window length and step must be positive.")
+    last_start = time[-1] - window
+    if last_start < time[0]:
+        raise CurveFitException("The recording is shorter than one window ({0:g} < {1:g}).".format(
+            time[-1] - time[0], window))
+    start_times = time[0] + step * np.arange(int(np.floor((last_start - time[0]) / step)) + 1)
+    starts = np.searchsorted(time, start_times, side="left")
+    ends = np.searchsorted(time, start_times + window, side="right")
+    return start_times, starts, ends
+
+
+def fit_windows(time, data, window=DEFAULT_WINDOW, step=DEFAULT_STEP, params_guess=lsq.DEFAULT_INITIAL_PARAMS_GUESS,
+                bounds=lsq.DEFAULT_BOUNDS, max_nfev=lsq.DEFAULT_MAX_NFEV, auto_period=False):
+    """Fit every window.  Returns a dict of per-window arrays, keyed by `WINDOW_FIELDS`, and the count of windows that
+    could not be fitted as "unfitted"; those have NaN params.  With `auto_period`, the guessed period is replaced by the
+    whole recording's dominant period."""
+    order = np.argsort(time, kind="mergesort")
+    time = np.asarray(time, dtype=float)[order]
+    data = np.asarray(data, dtype=float)[order]
+    # the form's params are Decimals
+    params_guess = np.asarray(params_guess, dtype=float)
+    start_times, starts, ends = window_indices(time, window, step)
+    if auto_period:
+        # the guess only: the whole recording's peak is too narrow to bound a period that drifts
+        params_guess = lsq.seed_period(time, data, params_guess, bounds)[0]
+
+    num_chunks = min(len(starts), max(1, compute.pool_size() * CHUNKS_PER_PROCESS))
+    tasks = []
+    for i, chunk in enumerate(np.array_split(np.arange(len(starts)), num_chunks)):
+        # send each process only the rows its windows cover
+        first, last = starts[chunk[0]], ends[chunk[-1]]
+        guess = params_guess if i == 0 else linear_guess(time[first:ends[chunk[0]]], data[first:ends[chunk[0]]],
+                                                         params_guess[3], bounds)
+        tasks.append((time[first:last], data[first:last], starts[chunk] - first, ends[chunk] - first,
+                      guess, bounds, max_nfev))
+    rows = np.vstack(compute.run_many(_fit_chunk, tasks))
+
+    windows = {name: rows[:, i] for i, name in enumerate(WINDOW_FIELDS)}
+    windows["start"] = start_times
+    windows["end"] = start_times + window
+    windows["center"] = start_times + window / 2.0
+    windows["unfitted"] = int(np.isnan(windows["h"]).sum())
+    return windows
+
+
+def linear_guess(time, data, period, bounds):
+    """Params from a linear cosinor fit with the period fixed: h*cos(2*pi*(x+v)/p) + b is linear in cos(2*pi*x/p) and
+    sin(2*pi*x/p).  Clipped to `bounds`."""
+    omega = 2 * np.pi / period
+    design = np.column_stack((np.cos(omega * time), np.sin(omega * time), np.ones_like(time)))
+    (a, c, b), _, _, _ = np.linalg.lstsq(design, data, rcond=-1)
+    # a*cos(w*x) + c*sin(w*x) = h*cos(w*x - phi), with h = hypot(a, c) and phi = atan2(c, a)
+    params = (np.hypot(a, c), b, -np.arctan2(c, a) / omega, period)
+    return np.clip(params, np.asarray(bounds[0], dtype=float), np.asarray(bounds[1], dtype=float))
+
+
+def _fit_chunk(time, data, starts, ends, params_guess, bounds, max_nfev):
+    """Fit consecutive windows, each starting from the previous window's solution.  Returns a row per window."""
+    rows = np.full((len(starts), len(WINDOW_FIELDS)), np.nan)
+    rows[:, WINDOW_FIELDS.index("error")] = 0
+    guess = params_guess
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        rows[i, WINDOW_FIELDS.index("points")] = end - start
+        if end - start < MIN_WINDOW_POINTS:
+            continue
+        window_time = time[start:end]
+        window_data = data[start:end]
+        try:
+            result = lsq.solve(window_time, window_data, guess, "linear", bounds, max_nfev)
+        except (CurveFitException, ValueError):
+            # the next window starts from the last solution instead
+            rows[i, WINDOW_FIELDS.index("error")] = 1
+            continue
+        rows[i, WINDOW_FIELDS.index("status")] = result.status
+        rows[i, WINDOW_FIELDS.index("nfev")] = result.nfev
+        if not result.success:
+            continue
+        guess = result.x
+
+        h, b, v, p = _canonical_params(result.x)
+        ss_res = np.dot(result.fun, result.fun)
+        deviations = window_data - window_data.mean()
+        ss_tot = np.dot(deviations, deviations)
+        rows[i, 4:10] = h, b, v, p, np.mod(-v, p), 1 - ss_res / ss_tot if ss_tot else np.nan
+    return rows
+
+
+def _canonical_params(params):
+    # the same curve with a positive amplitude and period, so that neighbouring windows are comparable
+    h, b, v, p = params
+    if p < 0:
+        # cos is even, so negating the period alone gives the same curve
+        p = -p
+    if h < 0:
+        h, v = -h, v + p / 2.0
+    return h, b, v, p
+
+
+@metrics.RENDER_SECONDS.time()
+def generate_plot_image(time, data, windows):
+    """The recording, and the per-window amplitude, mesor, acrophase and r^2 against each window's center."""
+    plt = lsq._pyplot()
+    fig, axes = plt.subplots(5, 1, sharex=True, figsize=(10, 16))
+
+    stride = max(1, len(time) // MAX_PLOTTED_POINTS)
+    axes[0].plot(time[::stride], data[::stride], "k-", linewidth=0.5)
+    axes[0].plot(windows["center"], windows["b"], "y-", label="Mesor")
+    title = "Rolling Cosine Fit ({0:d} windows".format(len(windows["center"]))
+    if windows["unfitted"]:
+        title += ", {0:d} not fitted".format(windows["unfitted"])
+    axes[0].set_title(title + ")")
+    axes[0].set_ylabel("Measurement")
+    axes[0].legend()
+    for ax, key, label in zip(axes[1:], ("h", "b", "acrophase", "r2"), ("Amplitude", "Mesor", "Acrophase", "$r^2$")):
+        ax.plot(windows["center"], windows[key], "r.-" if len(windows["center"]) <= 200 else "r-")
+        ax.set_ylabel(label)
+    axes[-1].set_xlabel("Hour (window center)")
+
+    fig.tight_layout()
+    buf = BytesIO()
+    fig.savefig(buf, format="png")
+    plt.close(fig)
+    buf.seek(0)
+    return buf
+
+
+def render(time, data, windows):
+    """Return the summary plot's PNG bytes.  Dispatched to the compute pool."""
+    buf = generate_plot_image(time, data, windows)
+    try:
+        return buf.getvalue()
+    finally:
+        buf.close()
+
+
+def windows_csv(windows):
+    """The per-window results as CSV text."""
+    rows = np.column_stack([windows[name] for name in WINDOW_FIELDS])
+    lines = [",".join(WINDOW_FIELDS)]
+    lines.extend(",".join("{0:.10g}".format(value) for value in row) for row in rows)
+    return "\n".join(lines) + "\n"
+
+
+class HtmlForm(FlaskForm):
+    """The web form fields."""
+    title = Title("Rolling Window Cosine Fit")
+    spreadsheet = BrowseSpreadsheetInput(label="Select measurement data")
+    curve_equation = MathEquation(label="", latex=r"y_1\sim h\cdot\cos\left(\frac{2\left(x_1+v\right)\pi}{p}\right)+b")
+    window = NumberInput(label="Window length (hours)", default=DEFAULT_WINDOW, min=0)
+    step = NumberInput(label="Window step (hours)", default=DEFAULT_STEP, min=0)
+    initial_params = ParamGroup(label="Initial guess for params", fields=[
+        ParamInput(param="h", size=5, default=lsq.DEFAULT_INITIAL_PARAMS_GUESS[0]),
+        ParamInput(param="b", size=5, default=lsq.DEFAULT_INITIAL_PARAMS_GUESS[1]),
+        ParamInput(param="v", size=5, default=lsq.DEFAULT_INITIAL_PARAMS_GUESS[2]),
+        ParamInput(param="p", size=5, default=lsq.DEFAULT_INITIAL_PARAMS_GUESS[3]),
+    ])
+    param_bounds = ParamBoundsGroup(label="Param bounds", fields=[
+        ParamBoundsInput(param="h", size=5, default_min=lsq.DEFAULT_BOUNDS[0][0], default_max=lsq.DEFAULT_BOUNDS[1][0]),
+        ParamBoundsInput(param="b", size=5, default_min=lsq.DEFAULT_BOUNDS[0][1], default_max=lsq.DEFAULT_BOUNDS[1][1]),
+        ParamBoundsInput(param="v", size=5, default_min=lsq.DEFAULT_BOUNDS[0][2], default_max=lsq.DEFAULT_BOUNDS[1][2]),
+        ParamBoundsInput(param="p", size=5, default_min=lsq.DEFAULT_BOUNDS[0][3], default_max=lsq.DEFAULT_BOUNDS[1][3])
+    ])
+    auto_period = CheckboxInput(label="Detect the period p from the recording's periodogram")
+    max_nfev = NumberInput(label="Maximum number of function evaluations per window", default=lsq.DEFAULT_MAX_NFEV, min=1, max=lsq.DEFAULT_MAX_NFEV)
+    do_curve_fit = RunButton(label="", button_text="Do rolling fit")
+
+    def validate_window(self, field):
+        if field.data is not None and field.data <= 0:
+            raise ValidationError("Must be greater than 0.")
+
+    def validate_step(self, field):
+        if field.data is not None and field.data <= 0:
+            raise ValidationError("Must be greater than 0.")
+
+
+def get_html_form():
+    """A new instance of the web form, bound to the current request."""
+    return HtmlForm()
+
+
+def html_form_submitted(form):
+    """Handler for web form submission."""
+    time, data = form.spreadsheet.parse()
+    initial_params = form.initial_params.as_list("h", "b", "v", "p")
+    bounds = form.param_bounds.as_minmax_pair("h", "b", "v", "p")
+    window = float(form.window.data)
+    span = np.max(time) - np.min(time)
+    if span < window:
+        raise BadRequest("The recording is shorter than one window ({0:g} < {1:g} hours).".format(span, window))
+    windows = fit_windows(time, data, window, float(form.step.data), initial_params, bounds, form.max_nfev.data,
+                          form.auto_period.data)
+    return BytesIO(compute.run(render, time, data, windows))
+
+
+def main():
+    """Commandline runner: fits the windows of a spreadsheet across all cores, and writes the summary plot and a CSV
+    of the per-window results next to it."""
+    import argparse
+    import multiprocessing
+    import os
+    from ski_stats import app
+
+    parser = argparse.ArgumentParser(description="Rolling window cosine fit of a spreadsheet.")
+    parser.add_argument("spreadsheet")
+    parser.add_argument("--window", type=float, default=DEFAULT_WINDOW)
+    parser.add_argument("--step", type=float, default=DEFAULT_STEP)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--auto-period", action="store_true", help="seed the period from the periodogram")
+    args = parser.parse_args()
+
+    app.config["COMPUTE_PROCESSES"] = args.processes
+    try:
+        time, data = parse_file(args.spreadsheet)
+        windows = fit_windows(time, data, args.window, args.step, auto_period=args.auto_period)
+        image = render(time, data, windows)
+    finally:
+        compute.shutdown()
+
+    base = os.path.splitext(args.spreadsheet)[0] + "_rolling"
+    with open(base + ".png", "wb") as f:
+        f.write(image)
+    with open(base + ".csv", "w") as f:
+        f.write(windows_csv(windows))
+    print "Fitted {0:d} windows ({1:d} not fitted); wrote {2}.png and {2}.csv".format(
+        len(windows["center"]) - windows["unfitted"], windows["unfitted"], base)
+
+
+# if script is being run directly from commandline
+if __name__ == "__main__":
+    main()
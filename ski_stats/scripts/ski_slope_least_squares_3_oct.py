@@ -1,30 +1,30 @@
 import numpy as np
-import matplotlib as mpl
-mpl.use('Agg')  # standard rendering tool for matplotlib above
-import matplotlib.pyplot as plt
-from scipy import optimize
-from matplotlib import rcParams
+import timeit
 from io import BytesIO
-from PIL import Image
-from xlrd import open_workbook
-from ski_stats.common import pearson, peak_auc, midpoint_peak_auc, parse_workbook, CalcResults, CurveFitException
+from ski_stats import metrics, compute, periodogram, export, progress, solver
+from ski_stats.models import Model
+from ski_stats.common import pearson, peak_auc, midpoint_peak_auc, parse_workbook, CurveFitException
+from ski_stats.results import FitResults
 from flask_wtf import FlaskForm
-from ski_stats.forms.fields import Title, BrowseSpreadsheetInput, RunButton, NumberInput, MathEquation, ParamInput, ParamBoundsInput, ParamGroup, ParamBoundsGroup
+from ski_stats.forms.fields import Title, BrowseSpreadsheetInput, RunButton, NumberInput, CheckboxInput, MathEquation, ParamInput, ParamBoundsInput, ParamGroup, ParamBoundsGroup
 
 DEFAULT_INITIAL_PARAMS_GUESS = (700, 200, 0, 24)
 DEFAULT_BOUNDS = ([-np.inf, -np.inf, -np.inf, -np.inf], [np.inf, np.inf, np.inf, np.inf])
 DEFAULT_MAX_NFEV = 10000000
 
+# the fit function; compiled on first use, with an exact Jacobian for the solver
+MODEL = Model("h * cos(2 * pi * (x + v) / p) + b", params=("h", "b", "v", "p"))
+
+# matplotlib, SciPy, PIL and xlrd are imported where they are used rather than at module level, so that pages
+# which never fit or render (e.g. `/desmos`) don't pay for them.  See `ski_stats.warmup` for preloading.
+
 
 def cos_fit(params, x):
     """Fit function.  The parameters are arranged in the way required by SciPy.
     params -- [h, b, v, p]
     x      -- time array
     """
-    h, b, v, p = params
-    # NumPy's cosine function can accept an array of `x` values and return
-    # an array of data instead of a scalar; no looping required.
-    return h * (np.cos((2 * np.pi * (x + v)) / p)) + b
+    return MODEL.evaluate(params, x)
 
 
 def residuals(params, x, y):
@@ -34,10 +34,10 @@ def residuals(params, x, y):
     `x`:          time array
     `y`:          data array
     """
-    return cos_fit(params, x) - y
+    return MODEL.residuals(params, x, y)
 
 
-def least_squares(time, data, params_guess, loss, bounds, max_nfev):
+def least_squares(time, data, params_guess, loss, bounds, max_nfev, method=solver.AUTO):
     """Get the solved params and residuals.
     time -- the time array
     data -- the data array
@@ -46,21 +46,96 @@ def least_squares(time, data, params_guess, loss, bounds, max_nfev):
             (see: https://scipy-cookbook.readthedocs.io/items/robust_regression.html)
     bounds -- a pair of lists specifying the upper and lower parameter bounds
     max_nfev -- max number of function evaluations
+    method -- the solver method, or "auto" to let `solver.choose` pick it
     """
-    # fit the data using a least squares calculation
-    # (see: https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.least_squares.html)
-    result = optimize.least_squares(residuals, params_guess, loss=loss, bounds=bounds, max_nfev=max_nfev,
-                                    args=(time, data))
+    result = solve(time, data, params_guess, loss, bounds, max_nfev, method)
     if not result.success:
         raise CurveFitException("Failed to fit the function: " + result.message)
     # solved params are stored in `x`, residuals are stored in `fun`
     return result.x, result.fun
 
 
-def do_calculations(time, data, params_guess=DEFAULT_INITIAL_PARAMS_GUESS, bounds=DEFAULT_BOUNDS, max_nfev=DEFAULT_MAX_NFEV):
-    """Fit the curve and perform additional calculations."""
+def solve(time, data, params_guess, loss, bounds, max_nfev, method=solver.AUTO, strategy=None):
+    """Run the solver, with the given `solver.Strategy` or else the one chosen for `method`.  Returns SciPy's
+    `OptimizeResult`."""
+    from scipy import optimize
+
+    if strategy is None:
+        try:
+            strategy = solver.choose(bounds, params_guess, len(data), loss, method)
+        except ValueError as err:
+            raise CurveFitException(str(err))
+
+    # fit the data using a least squares calculation
+    # (see: https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.least_squares.html)
+    # the workspace's residuals and Jacobian evaluate into buffers allocated once per fit
+    start = timeit.default_timer()
+    workspace = MODEL.workspace(time, data)
+    fun, jac = workspace.residuals, workspace.jacobian
+    # followed fits report progress and stop when cancelled
+    reporter = progress.reporter()
+    if reporter is not None:
+        fun, jac = reporter.residuals(fun), reporter.jacobian(jac)
+    result = optimize.least_squares(fun, params_guess, jac=jac, loss=loss, bounds=bounds, max_nfev=max_nfev,
+                                    **strategy.kwargs())
+    metrics.observe_fit(result, timeit.default_timer() - start)
+    return result
+
+
+def seed_period(time, data, params_guess, bounds):
+    """Replace the guessed period with the dominant period of the data's Lomb-Scargle periodogram, searched within the
+    period's bounds.  An unbounded period is also bounded to the periodogram peak.  Returns (params_guess, bounds),
+    unchanged if the data have no usable periodogram."""
+    # form bounds arrive as strings, e.g. "-inf"
+    lower, upper = [[float(value) for value in bound] for bound in bounds]
+    try:
+        with metrics.PERIODOGRAM_SECONDS.time():
+            spectrum = periodogram.lomb_scargle(time, data, min_period=lower[3] if lower[3] > 0 else None,
+                                                max_period=upper[3] if np.isfinite(upper[3]) else None)
+    except ValueError:
+        return params_guess, bounds
+    peak = spectrum.peaks(1)[0]
+    if np.isinf(lower[3]) and np.isinf(upper[3]):
+        lower[3], upper[3] = peak.lower, peak.upper
+    params_guess = list(params_guess)
+    params_guess[3] = float(np.clip(peak.period, lower[3], upper[3]))
+    return params_guess, (lower, upper)
+
+
+def fit_series(time, data, params_guess=DEFAULT_INITIAL_PARAMS_GUESS, bounds=DEFAULT_BOUNDS, max_nfev=DEFAULT_MAX_NFEV, auto_period=False,
+               method=solver.AUTO):
+    """Fit the curve only, without the additional calculations.  Returns a JSON-serializable dict of the solved params
+    and goodness of fit, or of the error if the fit failed.  Used for batch fitting."""
+    if auto_period:
+        params_guess, bounds = seed_period(time, data, params_guess, bounds)
+    try:
+        result = solve(time, data, params_guess, "linear", bounds, max_nfev, method)
+    except (CurveFitException, ValueError) as err:
+        # e.g. residuals that aren't finite at the guess; the other series of the batch are still fitted
+        return {"error": str(err)}
+    if not result.success:
+        return {"error": "Failed to fit the function: " + result.message, "status": int(result.status),
+                "nfev": int(result.nfev)}
+    ss = float(np.dot(result.fun, result.fun))
+    r = float(np.corrcoef(result.fun + data, data)[0, 1])
+    return {"params": result.x.tolist(), "ss": ss, "r": r, "r2": r ** 2, "status": int(result.status),
+            "nfev": int(result.nfev)}
+
+
+def do_calculations(time, data, params_guess=DEFAULT_INITIAL_PARAMS_GUESS, bounds=DEFAULT_BOUNDS, max_nfev=DEFAULT_MAX_NFEV, auto_period=False,
+                    method=solver.AUTO):
+    """Fit the curve and perform additional calculations.  With `auto_period`, the period is seeded by `seed_period`.
+    `method` overrides the solver method `solver.choose` would pick."""
+    if auto_period:
+        params_guess, bounds = seed_period(time, data, params_guess, bounds)
+
+    lsq_params, lsq_residuals = least_squares(time, data, params_guess, "linear", bounds, max_nfev, method)
+    with metrics.POSTFIT_SECONDS.time():
+        return _post_fit_calculations(time, data, lsq_params, lsq_residuals)
 
-    lsq_params, lsq_residuals = least_squares(time, data, params_guess, "linear", bounds, max_nfev)
+
+def _post_fit_calculations(time, data, lsq_params, lsq_residuals):
+    """The calculations performed on the solved params."""
     lsq_r = pearson(cos_fit(lsq_params, time), data)
     lsq_r2 = lsq_r ** 2
 
@@ -115,23 +190,18 @@ def do_calculations(time, data, params_guess=DEFAULT_INITIAL_PARAMS_GUESS, bound
     # repeat acro coords across figure rather than displaying 1 point \
     # should plot point for every peak occurring within dataset
     lsq_acro_list_x = []
-    lsq_acro_list_y = []
 
     acro_point_total = lsq_acro
 
     while acro_point_total <= max(time):
         lsq_acro_list_x.append(acro_point_total)
-        lsq_acro_list_y.append(lsq_peak_value)
         acro_point_total += lsq_params[3]
 
     # mesor-data intersection points
 
-    # below returns data index points prior to mesor crossing, writes these index values to y_int
+    # below returns data index points prior to mesor crossing
     idx = np.argwhere(np.diff(np.sign(lsq_mesor_list - data))).flatten()
     x_int = time[idx]
-    y_int = []
-    for coords in x_int:
-        y_int.append(lsq_mesor)
 
     crossing_points = []
 
@@ -171,8 +241,7 @@ def do_calculations(time, data, params_guess=DEFAULT_INITIAL_PARAMS_GUESS, bound
     onset_index_coords = []
     offset_coords = []
     offset_index_coords = []
-    peak_data_list = []
-    peak_time_list = []
+    peak_bounds = []
 
     for pts in index_coords[0:(len(index_coords) - 1)]:
         if all_data[pts + 1] > all_data[pts]:
@@ -184,9 +253,8 @@ def do_calculations(time, data, params_guess=DEFAULT_INITIAL_PARAMS_GUESS, bound
             offset_coords.append(pts)
             offset_index_coords.append(index_coords.index(pts))
 
-    # filters all_time, and all_data arrays into arrays of lists, each sub-list beginning at onset, ending at offset
+    # finds the [start, stop) positions in all_time, and all_data of each peak, beginning at onset, ending at offset
     # all other coordinates ignored
-    # time list written to peak_time_list, data written to peak_data_list
 
     step = 0
     while step < (len(index_coords)):
@@ -194,13 +262,11 @@ def do_calculations(time, data, params_guess=DEFAULT_INITIAL_PARAMS_GUESS, bound
             print "only 1 mesor crossing; cannot compute peak duration"
             step = len(index_coords)
         elif index_coords[0] == onset_coords[0] and len(index_coords) % 2 == 0 and len(index_coords) >= 2:
-            peak_data_list.append(all_data[index_coords[step]:index_coords[step + 1] + 1])
-            peak_time_list.append(all_time[index_coords[step]:index_coords[step + 1] + 1])
+            peak_bounds.append((index_coords[step], index_coords[step + 1] + 1))
             step += 2
         elif index_coords[0] == onset_coords[0] and len(index_coords) % 2 != 0 and len(index_coords) >= 3:
             index_coords.pop()
-            peak_data_list.append(all_data[index_coords[step]:index_coords[step + 1] + 1])
-            peak_time_list.append(all_time[index_coords[step]:index_coords[step + 1] + 1])
+            peak_bounds.append((index_coords[step], index_coords[step + 1] + 1))
             step += 2
         elif index_coords[0] != onset_coords[0] and len(index_coords) % 2 == 0 and len(index_coords) >= 3:
             index_coords = index_coords[1:-1]
@@ -208,39 +274,40 @@ def do_calculations(time, data, params_guess=DEFAULT_INITIAL_PARAMS_GUESS, bound
             index_coords = index_coords[1:]
         elif index_coords[0] != onset_coords[0] and len(index_coords) % 2 == 0 and len(index_coords) <= 2:
             print "not enough coordinates to determine"
+            step = len(index_coords)
         else:
             print "on-off coordinates not found"
             step = len(index_coords)
 
-    # write all trapezoidal auc computations to list called peak_auc_list
-    peak_cycle = 0
-    peak_auc_list = []
+    # trapezoidal and midpoint auc computations of each peak
+    all_time = np.array(all_time)
+    all_data = np.array(all_data)
+    peak_auc_list = [peak_auc(all_time[start:stop], all_data[start:stop]) for start, stop in peak_bounds]
+    peak_mp_auc_list = [midpoint_peak_auc(all_time[start:stop], all_data[start:stop]) for start, stop in peak_bounds]
 
-    while peak_cycle < len(peak_time_list):
-        peak_auc_list.append(peak_auc(peak_time_list[peak_cycle], peak_data_list[peak_cycle]))
-        peak_cycle += 1
-
-    # write all peak_mp_auc calculations to a list
-    mp_cycle = 0
-    peak_mp_auc_list = []
+    # box-up and return the results
+    return FitResults(
+        ss_lsq=ss_lsq, lsq_residuals=lsq_residuals, lsq_r=lsq_r, lsq_r2=lsq_r2, lsq_acro=lsq_acro,
+        lsq_peak_value=lsq_peak_value, lsq_mesor=lsq_mesor, lsq_acro_list_x=lsq_acro_list_x, lsq_params=lsq_params,
+        idx=idx, x_int=x_int, crossing_points=crossing_points, all_time=all_time, all_data=all_data,
+        index_coords=index_coords, onset_coords=onset_coords, onset_index_coords=onset_index_coords,
+        offset_coords=offset_coords, offset_index_coords=offset_index_coords, peak_bounds=peak_bounds,
+        peak_auc_list=peak_auc_list, peak_mp_auc_list=peak_mp_auc_list)
 
-    while mp_cycle < len(peak_time_list):
-        peak_mp_auc_list.append(midpoint_peak_auc(peak_time_list[mp_cycle], peak_data_list[mp_cycle]))
-        mp_cycle += 1
 
-    # box-up and return the results
-    return CalcResults({
-        "ss_lsq": ss_lsq, "lsq_residuals": lsq_residuals, "lsq_r": lsq_r, "lsq_r2": lsq_r2, "lsq_acro": lsq_acro,
-        "lsq_peak_value": lsq_peak_value, "lsq_mesor": lsq_mesor, "y_int": y_int, "lsq_acro_list_x": lsq_acro_list_x,
-        "lsq_acro_list_y": lsq_acro_list_y, "lsq_params": lsq_params, "idx": idx, "x_int": x_int,
-        "crossing_points": crossing_points, "all_time": all_time, "all_data": all_data, "index_coords": index_coords,
-        "onset_coords": onset_coords, "onset_index_coords": onset_index_coords, "offset_coords": offset_coords,
-        "offset_index_coords": offset_index_coords, "peak_time_list": peak_time_list, "peak_data_list": peak_data_list,
-        "peak_auc_list": peak_auc_list, "peak_mp_auc_list": peak_mp_auc_list
-    })
+def _pyplot():
+    """Deferred import of pyplot, configured for headless rendering."""
+    import matplotlib as mpl
+    mpl.use('Agg')  # standard rendering tool for matplotlib above
+    import matplotlib.pyplot as plt
+    return plt
 
 
+@metrics.RENDER_SECONDS.time()
 def generate_plot_image(time, data, results, include_text=True):
+    plt = _pyplot()
+    from matplotlib import rcParams
+
     # setup the figure plot params
     rcParams["figure.figsize"] = (10, 14 if include_text else 7)
     rcParams["legend.fontsize"] = 16
@@ -284,7 +351,7 @@ def generate_plot_image(time, data, results, include_text=True):
             "h = {10:.4f}, b = {11:.4f}, v = {12:.4f}, p = {13:.4f}").format(
             results.ss_lsq, results.lsq_residuals.size - 2, results.lsq_r, results.lsq_r2, results.lsq_acro,
             results.lsq_peak_value, results.lsq_mesor, len(results.crossing_points), results.crossing_points,
-            results.peak_mp_auc_list, *results.lsq_params)
+            results.peak_mp_auc_list.tolist(), *results.lsq_params)
 
         # insert string below the plot, left-aligned
         axes2 = fig.add_subplot(212)
@@ -303,31 +370,58 @@ def generate_plot_image(time, data, results, include_text=True):
     fig.tight_layout()
     buf = BytesIO()
     fig.savefig(buf, format="png")
+    plt.close(fig)
     buf.seek(0)
     return buf
 
 
-def get_html_form():
+def fit_and_render(time, data, params_guess, bounds, max_nfev, auto_period=False):
+    """Run the calc and return the PNG image bytes.  Dispatched to the compute pool."""
+    results = do_calculations(time, data, params_guess, bounds, max_nfev, auto_period)
+    buf = generate_plot_image(time, data, results)
+    try:
+        return buf.getvalue()
+    finally:
+        buf.close()
+
+
+def calculate_row(time, data, params_guess, bounds, max_nfev, auto_period=False, method=solver.AUTO):
+    """`do_calculations` for export: the series' `export.Row`, with the error if it couldn't be fitted.  Dispatched to
+    the compute pool."""
+    try:
+        return export.row_from_results(do_calculations(time, data, params_guess, bounds, max_nfev, auto_period,
+                                                       method))
+    except progress.FitCancelled:
+        raise
+    except Exception as err:
+        return export.row_from_error(err)
+
+
+class HtmlForm(FlaskForm):
     """The web form fields."""
-    class HtmlForm(FlaskForm):
-        title = Title("Least Squares Curve Fit", show_desmos_link=True)
-        spreadsheet = BrowseSpreadsheetInput(label="Select measurement data")
-        curve_equation = MathEquation(label="", latex=r"y_1\sim h\cdot\cos\left(\frac{2\left(x_1+v\right)\pi}{p}\right)+b")
-        # curve_equation = MathEquation(label="", latex=r"y = h \cdot \cos \left({{2(x + v)\pi \over p }}\right) + b")
-        initial_params = ParamGroup(label="Initial guess for params", fields=[
-            ParamInput(param="h", size=5, default=DEFAULT_INITIAL_PARAMS_GUESS[0]),
-            ParamInput(param="b", size=5, default=DEFAULT_INITIAL_PARAMS_GUESS[1]),
-            ParamInput(param="v", size=5, default=DEFAULT_INITIAL_PARAMS_GUESS[2]),
-            ParamInput(param="p", size=5, default=DEFAULT_INITIAL_PARAMS_GUESS[3]),
-        ])
-        param_bounds = ParamBoundsGroup(label="Param bounds", fields=[
-            ParamBoundsInput(param="h", size=5, default_min=DEFAULT_BOUNDS[0][0], default_max=DEFAULT_BOUNDS[1][0]),
-            ParamBoundsInput(param="b", size=5, default_min=DEFAULT_BOUNDS[0][1], default_max=DEFAULT_BOUNDS[1][1]),
-            ParamBoundsInput(param="v", size=5, default_min=DEFAULT_BOUNDS[0][2], default_max=DEFAULT_BOUNDS[1][2]),
-            ParamBoundsInput(param="p", size=5, default_min=DEFAULT_BOUNDS[0][3], default_max=DEFAULT_BOUNDS[1][3])
-        ])
-        max_nfev = NumberInput(label="Maximum number of function evaluations", default=DEFAULT_MAX_NFEV, min=1, max=DEFAULT_MAX_NFEV)
-        do_curve_fit = RunButton(label="", button_text="Do curve fit")
+    title = Title("Least Squares Curve Fit", show_desmos_link=True)
+    spreadsheet = BrowseSpreadsheetInput(label="Select measurement data")
+    curve_equation = MathEquation(label="", latex=r"y_1\sim h\cdot\cos\left(\frac{2\left(x_1+v\right)\pi}{p}\right)+b")
+    # curve_equation = MathEquation(label="", latex=r"y = h \cdot \cos \left({{2(x + v)\pi \over p }}\right) + b")
+    initial_params = ParamGroup(label="Initial guess for params", fields=[
+        ParamInput(param="h", size=5, default=DEFAULT_INITIAL_PARAMS_GUESS[0]),
+        ParamInput(param="b", size=5, default=DEFAULT_INITIAL_PARAMS_GUESS[1]),
+        ParamInput(param="v", size=5, default=DEFAULT_INITIAL_PARAMS_GUESS[2]),
+        ParamInput(param="p", size=5, default=DEFAULT_INITIAL_PARAMS_GUESS[3]),
+    ])
+    param_bounds = ParamBoundsGroup(label="Param bounds", fields=[
+        ParamBoundsInput(param="h", size=5, default_min=DEFAULT_BOUNDS[0][0], default_max=DEFAULT_BOUNDS[1][0]),
+        ParamBoundsInput(param="b", size=5, default_min=DEFAULT_BOUNDS[0][1], default_max=DEFAULT_BOUNDS[1][1]),
+        ParamBoundsInput(param="v", size=5, default_min=DEFAULT_BOUNDS[0][2], default_max=DEFAULT_BOUNDS[1][2]),
+        ParamBoundsInput(param="p", size=5, default_min=DEFAULT_BOUNDS[0][3], default_max=DEFAULT_BOUNDS[1][3])
+    ])
+    auto_period = CheckboxInput(label="Detect the period p from the data's periodogram")
+    max_nfev = NumberInput(label="Maximum number of function evaluations", default=DEFAULT_MAX_NFEV, min=1, max=DEFAULT_MAX_NFEV)
+    do_curve_fit = RunButton(label="", button_text="Do curve fit")
+
+
+def get_html_form():
+    """A new instance of the web form, bound to the current request."""
     return HtmlForm()
 
 
@@ -338,22 +432,40 @@ def html_form_submitted(form):
     initial_params = form.initial_params.as_list("h", "b", "v", "p")
     bounds = form.param_bounds.as_minmax_pair("h", "b", "v", "p")
     max_nfev = form.max_nfev.data
+    auto_period = form.auto_period.data
 
     # run the calc and return an image
-    results = do_calculations(time, data, initial_params, bounds, max_nfev)
-    return generate_plot_image(time, data, results)
+    return BytesIO(compute.run(fit_and_render, time, data, initial_params, bounds, max_nfev, auto_period))
+
+
+def html_form_exported(form):
+    """Handler for web form export: fits every worksheet of the spreadsheet and returns the results as an .xlsx file,
+    in an open temporary file."""
+    if form.spreadsheet.has_file():
+        upload = form.spreadsheet
+        series = export.iter_spreadsheet(file_contents=upload.read(), upload_name=upload.data.filename)
+    else:
+        # a stored dataset holds only the first worksheet
+        time, data = form.spreadsheet.parse()
+        series = [(export.COLUMNS_SERIES_NAME, time, data)]
+    return export.export_to_tempfile(series, calculate_row, (
+        form.initial_params.as_list("h", "b", "v", "p"), form.param_bounds.as_minmax_pair("h", "b", "v", "p"),
+        form.max_nfev.data, form.auto_period.data))
 
 
 def main():
     """The main runner for interactive commandline invocation.  Performs calc, generates image, prints results."""
     import os
     import sys
+    from PIL import Image
+    from xlrd import open_workbook
 
     # retrieve xlsx file, user inputs name of file
     file_name = raw_input("What is the name of your excel file?")
     file_path = os.path.join(os.getcwd(), str(file_name) + ".xlsx")
     script_name_no_ext = os.path.splitext(os.path.basename(sys.argv[0]))[0]
     image_output_path = os.path.join(os.getcwd(), str(file_name) + "_" + script_name_no_ext + ".png")
+    results_output_path = os.path.join(os.getcwd(), str(file_name) + "_" + script_name_no_ext + ".xlsx")
 
     # parse spreadsheet, do calculations, generate image
     time, data = parse_workbook(open_workbook(file_path))
@@ -371,6 +483,10 @@ def main():
     finally:
         buf.close()
 
+    # export results to excel file
+    with export.ResultsWriter(results_output_path) as writer:
+        writer.write(str(file_name), export.row_from_results(results))
+
     # print results to standard-out
     print("{0}\nr = {1:.4f}\nr^2 = {2:.4f}\nSS = {3:.4f}\nh = {4:.4f}\nb = {5:.4f}\nv = {6:.4f}\np = {7:.4f}\n".format(
         "linear", results.lsq_r, results.lsq_r2, results.ss_lsq, *results.lsq_params))
@@ -398,7 +514,6 @@ def main():
     # to do restrict h to 5x max data value
     # to do restrict b to max data value
     # change auc to midpoint formula
-    # export to excel file
     # triple check all crossing point possibilities:
     # on: test8- check
     # off: test1- check
@@ -0,0 +1,64 @@
+from collections import namedtuple
+import numpy as np
+
+# Choice of the `optimize.least_squares` settings for a fit.  SciPy's defaults (the bounded "trf" method, unscaled) are
+# a poor fit for the cosine model: its params differ by orders of magnitude (h ~ 700, v ~ 1, p ~ 24), which leaves
+# the trust region badly shaped, and most fits have no bounds at all, where MINPACK's "lm" needs fewer iterations and
+# less overhead per iteration.  `choose` picks:
+#
+#   method - "lm" for unbounded fits with the linear loss and at least as many points as params (MINPACK supports
+#            neither bounds nor robust losses), otherwise "trf"
+#   x_scale - for "lm", "jac": each param scaled by the inverse norm of its Jacobian column, so that a step moves
+#             every param by a comparable amount of fit.  For "trf" and "dogbox", the magnitude of the initial guess
+#             (at least 1): their "jac" scaling is updated every iteration, and took thousands of evaluations on
+#             bounded fits whose period ends up at a bound
+#   ftol, xtol, gtol - SciPy's defaults; `python -m benchmarks.solver` showed no gain from relaxing them, since the
+#             scaled fits converge in a few iterations
+#
+# A requested method overrides the choice.  See `python -m benchmarks.solver` for the comparison with SciPy's defaults.
+
+AUTO = "auto"
+METHODS = (AUTO, "lm", "trf", "dogbox")
+DEFAULT_TOLERANCE = 1e-8
+
+
+class Strategy(namedtuple("Strategy", ["method", "x_scale", "ftol", "xtol", "gtol"])):
+    """Keyword arguments for `optimize.least_squares`."""
+    __slots__ = ()
+
+    def kwargs(self):
+        return dict(self._asdict())
+
+
+# SciPy's defaults, as before there was a choice; for comparison
+SCIPY_DEFAULT = Strategy("trf", 1.0, DEFAULT_TOLERANCE, DEFAULT_TOLERANCE, DEFAULT_TOLERANCE)
+
+
+def is_unbounded(bounds):
+    """Whether every bound is infinite."""
+    lower, upper = [np.asarray(bound, dtype=float) for bound in bounds]
+    return bool(np.all(np.isneginf(lower)) and np.all(np.isposinf(upper)))
+
+
+def supports_lm(bounds, num_points, num_params, loss="linear"):
+    return is_unbounded(bounds) and loss == "linear" and num_points >= num_params
+
+
+def guess_scale(params_guess):
+    """Scale of each param: the magnitude of its initial guess, at least 1."""
+    return np.maximum(np.abs(np.asarray(params_guess, dtype=float)), 1.0)
+
+
+def choose(bounds, params_guess, num_points, loss="linear", method=AUTO):
+    """The strategy for a fit of `num_points` points from `params_guess`.  Raises ValueError if the requested `method`
+    can't solve it."""
+    if method not in METHODS:
+        raise ValueError("Unknown solver method \"{0}\"; expected one of: {1}".format(method, ", ".join(METHODS)))
+    lm = supports_lm(bounds, num_points, len(params_guess), loss)
+    if method == AUTO:
+        method = "lm" if lm else "trf"
+    elif method == "lm" and not lm:
+        raise ValueError("The \"lm\" solver only supports unbounded fits with the linear loss, and at least as many "
+                         "points as params.")
+    x_scale = "jac" if method == "lm" else guess_scale(params_guess)
+    return Strategy(method, x_scale, DEFAULT_TOLERANCE, DEFAULT_TOLERANCE, DEFAULT_TOLERANCE)
@@ -13,6 +13,8 @@
     var DEFAULT_ERROR_MESSAGE = "An unknown exception occurred during processing.";
     var DEFAULT_SERVER_ERROR_STATUS = "SERVER ERROR";
     var DEFAULT_ERROR_STATUS = "ERROR";
+    // see ski_stats/datastore.py
+    var DATASET_TOKEN_HEADER = "X-Dataset-Token";
 
     if (typeof window.SkiStats == "undefined") {
         alert("Module was not initialized (desmos-initial-state.js).");
@@ -113,6 +115,23 @@
     // the user-selected values will be recorded into the `params` object
     var params = initializeExpressions();
 
+    // the last imported table and the token the server stored it under, posted in place of the values while the table
+    // is unchanged
+    var importedDataset = null;
+
+    // the token of the imported dataset, if the table still holds exactly its values
+    function datasetToken(x, y) {
+        if (!importedDataset || x.length != importedDataset.x.length || y.length != importedDataset.y.length) {
+            return null;
+        }
+        for (var i = 0; i < x.length; i++) {
+            if (x[i] !== importedDataset.x[i] || y[i] !== importedDataset.y[i]) {
+                return null;
+            }
+        }
+        return importedDataset.token;
+    }
+
     // remove the new-expression button at bottom of list
     $(".dcg-new-expression").remove();
 
@@ -151,32 +170,46 @@
     // button is not always present, so bind to the top-level element
     $("#calculator").on("change", "#upload_button", function() {
         var $this = $(this);
-        var inputName = $this.attr("name");
         var files = $this.get(0).files;
         if (files && files.length == 1) {
             var file = files[0];
-            var formData = new FormData();
-            formData.append(inputName, file);
 
             // submit spreadsheet to server for parsing and populate the Desmos table with results
+            // the file is posted as the raw body, which the server copies to disk faster than a multipart form
             $.ajax({
                 type: "POST",
-                url: IMPORT_BUTTON_URL,
-                data: formData,
+                url: IMPORT_BUTTON_URL + "?" + $.param({filename: file.name}),
+                data: file,
                 cache: false,
-                contentType: false,
+                contentType: "application/octet-stream",
                 processData: false,
-                dataType: "json",
+                // successful imports are returned as binary float64 columns, errors as JSON
+                headers: {Accept: "application/octet-stream"},
+                xhr: function() {
+                    var xhr = $.ajaxSettings.xhr();
+                    xhr.onreadystatechange = function() {
+                        if (xhr.readyState == 2 && xhr.status == 200) {
+                            xhr.responseType = "arraybuffer";
+                        }
+                    };
+                    return xhr;
+                },
                 success: function(response, textStatus, jqXHR) {
-                    if (!response) {
+                    var length = parseInt(jqXHR.getResponseHeader("X-Series-Length"), 10);
+                    if (!response || !response.byteLength) {
                         displayError("Import failed; server response was empty!");
                     }
-                    else if (response.hasOwnProperty("x") && response.hasOwnProperty("y")) {
-                        // add the parsed spreadsheet values as an expression table
-                        importData(response.x, response.y);
+                    else if (isNaN(length) || response.byteLength != 2 * length * Float64Array.BYTES_PER_ELEMENT) {
+                        displayError("Import failed; server response was missing data!");
                     }
                     else {
-                        displayError("Import failed; server response was missing data!");
+                        // add the parsed spreadsheet values as an expression table
+                        var x = Array.prototype.slice.call(new Float64Array(response, 0, length));
+                        var y = Array.prototype.slice.call(
+                            new Float64Array(response, length * Float64Array.BYTES_PER_ELEMENT, length));
+                        var token = jqXHR.getResponseHeader(DATASET_TOKEN_HEADER);
+                        importedDataset = token ? {token: token, x: x.slice(), y: y.slice()} : null;
+                        importData(x, y);
                     }
                 },
                 error: function(jqXHR, textStatus, errorThrown) {
@@ -226,54 +259,82 @@
     });
 
     // handle the "Run" button
-    $("#run_button").on("click", function() {
+    $("#run_button").on("click", runRegression);
+
+    function runRegression() {
         // get the table values
         if (validateParamsBeforeRun()) {
-            // construct the POST request
-            var formData = {};
-            formData.x = params.x1;
-            formData.y = params.y1;
-            formData.h = params.h;
-            formData.b = params.b;
-            formData.v = params.v;
-            formData.p = params.p;
-            formData.max_nfev = $("#max_nfev").val();
+            // the params go in the query string
+            var query = {};
+            // the table values are posted as binary float64 columns (x values followed by y values), unless the
+            // server still has them from the import
+            var token = datasetToken(params.x1, params.y1);
+            var body;
+            if (token) {
+                query.dataset = token;
+                body = new ArrayBuffer(0);
+            }
+            else {
+                var length = Math.min(params.x1.length, params.y1.length);
+                body = new Float64Array(2 * length);
+                body.set(params.x1.slice(0, length), 0);
+                body.set(params.y1.slice(0, length), length);
+                body = body.buffer;
+            }
+            var rerun = false;
+
+            query.h = params.h;
+            query.b = params.b;
+            query.v = params.v;
+            query.p = params.p;
+            query.max_nfev = $("#max_nfev").val();
 
             // check if bounds were specified
             var specifyBounds = $("#regression_options .dcg-component-checkbox").hasClass("dcg-checked");
             if (specifyBounds) {
-                formData.specify_bounds = "specify_bounds";
-                formData.h_lower = $("#h_lower").val();
-                formData.b_lower = $("#b_lower").val();
-                formData.v_lower = $("#v_lower").val();
-                formData.p_lower = $("#p_lower").val();
-
-                formData.h_upper = $("#h_upper").val();
-                formData.b_upper = $("#b_upper").val();
-                formData.v_upper = $("#v_upper").val();
-                formData.p_upper = $("#p_upper").val();
+                query.h_lower = $("#h_lower").val();
+                query.b_lower = $("#b_lower").val();
+                query.v_lower = $("#v_lower").val();
+                query.p_lower = $("#p_lower").val();
+
+                query.h_upper = $("#h_upper").val();
+                query.b_upper = $("#b_upper").val();
+                query.v_upper = $("#v_upper").val();
+                query.p_upper = $("#p_upper").val();
             }
 
-            // submit POST
-            $.ajax({
-                type: "POST",
-                url: RUN_BUTTON_URL,
-                data: formData,
-                cache: false,
-                contentType: "application/x-www-form-urlencoded; charset=UTF-8",
-                success: function(response, textStatus, jqXHR) {
-                    if (!response) {
-                        displayError("Server response was empty.");
-                    }
-                    else {
-                        displayRegressionResults(response);
+            // submit POST, following the fit's progress
+            var fit = window.SkiStats.postFit({
+                url: RUN_BUTTON_URL + "?" + $.param(query),
+                data: body,
+                contentType: "application/octet-stream",
+                progress: function(snapshot) {
+                    $("#run_progress").text(window.SkiStats.formatFitProgress(snapshot));
+                    // move the sliders along with the solver
+                    if (snapshot.hasOwnProperty("params")) {
+                        displayRegressionResults({h: snapshot.params[0], b: snapshot.params[1],
+                                                  v: snapshot.params[2], p: snapshot.params[3]});
                     }
                 },
+                result: function(payload) {
+                    displayRegressionResults(payload.data);
+                },
+                failure: function(error) {
+                    displayCaughtException(error);
+                },
+                cancelled: function() {
+                    displayError("The fit was cancelled.", "CANCELLED");
+                },
                 error: function(jqXHR, textStatus, errorThrown) {
                     console.log(jqXHR);
                     console.log(textStatus, errorThrown)
                     var responseText = jqXHR.responseText;
-                    if (jqXHR.hasOwnProperty("responseJSON")) {
+                    if (token && jqXHR.status == 404) {
+                        // the stored dataset expired; post the values instead
+                        importedDataset = null;
+                        rerun = true;
+                    }
+                    else if (jqXHR.hasOwnProperty("responseJSON")) {
                         displayCaughtException(jqXHR.responseJSON);
                     }
                     else if (typeof responseText != "undefined") {
@@ -290,13 +351,22 @@
                 },
                 beforeSend: function() {
                     $("#run_button_container > img").show();
+                    $("#cancel_button").show();
                 },
                 complete: function() {
                     $("#run_button_container > img").hide();
+                    $("#cancel_button").hide().off("click");
+                    $("#run_progress").text("");
+                    if (rerun) {
+                        runRegression();
+                    }
                 }
             });
+            $("#cancel_button").off("click").on("click", function() {
+                fit.cancel();
+            });
         }
-    });
+    }
 
     function validateParamsBeforeRun() {
         // just need to validate the imported data since param sliders start with values
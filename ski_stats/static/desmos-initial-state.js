@@ -85,7 +85,7 @@ window.SkiStats.initialGraphState = {
       {
         "type": "text",
         "id": "3",
-        "text": "Import a spreadsheet (.xls, .xlxs) with time (Column A) and data (Column B) values."
+        "text": "Import a spreadsheet (.xls, .xlsx), CSV/TSV (.csv, .tsv, optionally .gz) or NumPy (.npy, .npz) file with time (Column A) and data (Column B) values."
       }
     ]
   }
@@ -0,0 +1,132 @@
+(function($) {
+    const PARAM_NAMES = ["h", "b", "v", "p"];
+
+    // initialize module
+    window.SkiStats = (window.SkiStats || {});
+
+    // handles each complete "event: <name>\ndata: <json>\n\n" block of `text` from `offset`; returns the new offset
+    function parseEvents(text, offset, handle) {
+        let end;
+        while ((end = text.indexOf("\n\n", offset)) != -1) {
+            let name = "message";
+            let data = "";
+            text.substring(offset, end).split("\n").forEach(function(line) {
+                if (line.indexOf("event: ") == 0) {
+                    name = line.substring(7);
+                }
+                else if (line.indexOf("data: ") == 0) {
+                    data += line.substring(6);
+                }
+            });
+            handle(name, data ? JSON.parse(data) : null);
+            offset = end + 2;
+        }
+        return offset;
+    }
+
+    /**
+     * POSTs a fit, asking the server to stream its progress as Server-Sent Events (see ski_stats/progress.py).
+     * options: url, data, contentType, and the callbacks
+     *     progress(snapshot)   - {iteration, nfev, cost, params} while the fit runs
+     *     result(payload, jqXHR) - {mimetype, data}: JSON data as is, anything else base64-encoded
+     *     failure(error)       - {code, name, description} if the fit failed
+     *     cancelled()          - if the fit was cancelled
+     *     error(jqXHR, textStatus, errorThrown) - if the request was rejected, e.g. by validation
+     *     beforeSend(), complete()
+     * Returns a handle whose cancel() stops the fit.
+     */
+    window.SkiStats.postFit = function(options) {
+        let offset = 0;
+        let cancelUrl = null;
+        let finished = false;
+
+        function handle(name, data) {
+            if (name == "job") {
+                cancelUrl = data.cancel_url;
+            }
+            else if (name == "progress") {
+                options.progress(data);
+            }
+            else if (!finished) {
+                finished = true;
+                if (name == "result") {
+                    options.result(data, jqXHR);
+                }
+                else if (name == "cancelled") {
+                    options.cancelled();
+                }
+                else {
+                    options.failure(data);
+                }
+            }
+        }
+
+        const jqXHR = $.ajax({
+            type: "POST",
+            url: options.url,
+            data: options.data,
+            cache: false,
+            contentType: options.contentType,
+            processData: false,
+            dataType: "text",
+            headers: {Accept: "text/event-stream"},
+            xhr: function() {
+                const xhr = $.ajaxSettings.xhr();
+                xhr.addEventListener("progress", function() {
+                    if (xhr.status == 200) {
+                        offset = parseEvents(xhr.responseText, offset, handle);
+                    }
+                });
+                return xhr;
+            },
+            success: function(text) {
+                offset = parseEvents(text, offset, handle);
+                if (!finished) {
+                    handle("error", {description: "The server ended the fit without a result."});
+                }
+            },
+            error: function(jqXHR, textStatus, errorThrown) {
+                if (textStatus == "abort") {
+                    handle("cancelled");
+                    return;
+                }
+                // rejections are JSON, but the request asked for text
+                const contentType = jqXHR.getResponseHeader("Content-Type") || "";
+                if (!jqXHR.hasOwnProperty("responseJSON") && contentType.indexOf("application/json") == 0) {
+                    try {
+                        jqXHR.responseJSON = JSON.parse(jqXHR.responseText);
+                    }
+                    catch (e) {
+                        // shown as text
+                    }
+                }
+                finished = true;
+                options.error(jqXHR, textStatus, errorThrown);
+            },
+            beforeSend: options.beforeSend,
+            complete: options.complete
+        });
+
+        return {
+            cancel: function() {
+                // ask the server to stop the solver now, rather than when it notices the dropped connection
+                if (cancelUrl && !finished) {
+                    $.post(cancelUrl);
+                }
+                jqXHR.abort();
+            }
+        };
+    };
+
+    // a one-line summary of a progress snapshot
+    window.SkiStats.formatFitProgress = function(snapshot) {
+        if (!snapshot.hasOwnProperty("params")) {
+            return "Starting...";
+        }
+        const params = snapshot.params.map(function(value, i) {
+            return PARAM_NAMES[i] + " = " + value.toPrecision(5);
+        });
+        return "Iteration " + snapshot.iteration + " (" + snapshot.nfev + " evaluations), cost " +
+            snapshot.cost.toPrecision(4) + ": " + params.join(", ");
+    };
+})(jQuery);
@@ -2,6 +2,9 @@
     const DEFAULT_ERROR_MESSAGE = "An unknown exception occurred during processing.";
     const DEFAULT_SERVER_ERROR_STATUS = "SERVER ERROR";
     const WTFORMS_FIELD_SEPARATOR = "-";
+    // see ski_stats/datastore.py
+    const DATASET_FIELD_SUFFIX = "-dataset";
+    const DATASET_TOKEN_HEADER = "X-Dataset-Token";
 
     // returns true if string is valid HTML
     function isHtml(str) {
@@ -18,6 +21,9 @@
         this.$errorLog = this.$form.find(".error_log");
         this.$imageContainer = this.$form.find(".image_container");
         this.$resultsContainer = this.$form.find(".calc_results_container");
+        this.$fileInput = this.$form.find(".browse-button input[type='file']");
+        // the last uploaded file the server stored, and its token, sent in place of the file while it stays selected
+        this.dataset = null;
         const that = this;
 
         // clear validation errors on change
@@ -34,15 +40,101 @@
             }
         });
 
-        // async form submission
+        // async form submission, following the fit's progress
         this.$form.submit(function(e) {
             e.preventDefault();
             that.clearError();
             that.clearImage();
+            const $progress = that.$form.find(".fit-progress");
+            const $cancel = that.$form.find(".cancel-button");
+            const file = that.selectedFile();
+            const token = that.dataset && that.dataset.file === file ? that.dataset.token : null;
+            let resubmit = false;
+            const fit = window.SkiStats.postFit({
+                url: that.$form.attr("action"),
+                data: that.formData(token),
+                contentType: false,
+                progress: function(snapshot) {
+                    $progress.text(window.SkiStats.formatFitProgress(snapshot));
+                },
+                result: function(payload, jqXHR) {
+                    const storedToken = jqXHR.getResponseHeader(DATASET_TOKEN_HEADER);
+                    that.dataset = file && storedToken ? {file: file, token: storedToken} : null;
+                    // successful fits return an image
+                    that.displayImage("data:" + payload.mimetype + ";base64," + payload.data);
+                },
+                failure: function(error) {
+                    that.displayCaughtException(error);
+                },
+                cancelled: function() {
+                    that.displayError("The fit was cancelled.", "CANCELLED");
+                },
+                error: function(jqXHR, textStatus, errorThrown) {
+                    if (token && jqXHR.status == 404) {
+                        // the stored dataset expired; upload the file again
+                        that.dataset = null;
+                        resubmit = true;
+                    }
+                    else {
+                        that.processRequestError(jqXHR, textStatus, errorThrown);
+                    }
+                },
+                beforeSend: function() {
+                    that.$form.find(".spinner").show();
+                    $cancel.show();
+                },
+                complete: function() {
+                    that.$form.find(".spinner").hide();
+                    $cancel.hide().off("click");
+                    $progress.text("");
+                    if (resubmit) {
+                        that.$form.submit();
+                    }
+                }
+            });
+            $cancel.off("click").click(function() {
+                fit.cancel();
+            });
+        });
+
+        // the same form, with the results downloaded as a workbook
+        this.$form.find(".export-button button").click(function() {
+            that.clearError();
+            that.post($(this).data("url"), function(response, jqXHR) {
+                if (!response) {
+                    that.displayError("Expected a workbook, but the server response was empty.");
+                }
+                else {
+                    const disposition = jqXHR.getResponseHeader("Content-Disposition") || "";
+                    const match = /filename="?([^";]+)"?/.exec(disposition);
+                    that.download(response, match ? match[1] : "results.xlsx");
+                }
+            });
+        });
+
+        Analysis.prototype.selectedFile = function() {
+            const fileList = this.$fileInput.prop("files");
+            return fileList && fileList.length > 0 ? fileList[0] : null;
+        };
+
+        Analysis.prototype.formData = function(token) {
+            // the form's fields, with the token of the stored dataset (if any) in place of the file
+            const formData = new FormData(this.$form.get(0));
+            if (token) {
+                const name = this.$fileInput.attr("name");
+                formData.delete(name);
+                formData.append(name + DATASET_FIELD_SUFFIX, token);
+            }
+            return formData;
+        };
+
+        Analysis.prototype.post = function(url, success) {
+            // posts the form; successful requests will return a blob
+            const that = this;
             $.ajax({
                 type: "POST",
-                url: that.$form.attr("action"),
-                data: new FormData(this),
+                url: url,
+                data: new FormData(this.$form.get(0)),
                 cache: false,
                 contentType: false,
                 processData: false,
@@ -51,7 +143,6 @@
                     xhr.onreadystatechange = function() {
                         if (xhr.readyState == 2) {
                             if (xhr.status == 200) {
-                                // successful requests will return an image blob
                                 xhr.responseType = "blob";
                             }
                         }
@@ -59,39 +150,10 @@
                     return xhr;
                 },
                 success: function(response, textStatus, jqXHR) {
-                    if (!response) {
-                        that.displayError("Expected an image, but the server response was empty.");
-                    }
-                    else {
-                        // generate a local URL for the received image blob
-                        const url = window.URL || window.webkitURL;
-                        const src = url.createObjectURL(response);
-                        that.displayImage(src);
-                    }
+                    success(response, jqXHR);
                 },
                 error: function(jqXHR, textStatus, errorThrown) {
-                    console.log(jqXHR);
-                    console.log(textStatus, errorThrown)
-                    const responseText = jqXHR.responseText;
-                    if (jqXHR.hasOwnProperty("responseJSON")) {
-                        if (jqXHR.responseJSON.hasOwnProperty("errors")) {
-                            that.processValidationErrors(jqXHR.responseJSON.errors);
-                        }
-                        else {
-                            that.displayCaughtException(jqXHR.responseJSON);
-                        }
-                    }
-                    else if (typeof responseText != "undefined") {
-                        if (isHtml(responseText)) {
-                            that.displayUncaughtException(responseText, errorThrown);
-                        }
-                        else {
-                            that.displayError(responseText);
-                        }
-                    }
-                    else {
-                        that.displayError(DEFAULT_ERROR_MESSAGE);
-                    }
+                    that.processRequestError(jqXHR, textStatus, errorThrown);
                 },
                 beforeSend: function() {
                     that.$form.find(".spinner").show();
@@ -100,7 +162,44 @@
                     that.$form.find(".spinner").hide();
                 }
             });
-        });
+        };
+
+        Analysis.prototype.processRequestError = function(jqXHR, textStatus, errorThrown) {
+            console.log(jqXHR);
+            console.log(textStatus, errorThrown)
+            const responseText = jqXHR.responseText;
+            if (jqXHR.hasOwnProperty("responseJSON")) {
+                if (jqXHR.responseJSON.hasOwnProperty("errors")) {
+                    this.processValidationErrors(jqXHR.responseJSON.errors);
+                }
+                else {
+                    this.displayCaughtException(jqXHR.responseJSON);
+                }
+            }
+            else if (typeof responseText != "undefined") {
+                if (isHtml(responseText)) {
+                    this.displayUncaughtException(responseText, errorThrown);
+                }
+                else {
+                    this.displayError(responseText);
+                }
+            }
+            else {
+                this.displayError(DEFAULT_ERROR_MESSAGE);
+            }
+        };
+
+        Analysis.prototype.download = function(blob, filename) {
+            // save the blob through a temporary link
+            const url = window.URL || window.webkitURL;
+            const href = url.createObjectURL(blob);
+            const $link = $("<a/>").attr({href: href, download: filename}).appendTo("body");
+            $link.get(0).click();
+            $link.remove();
+            setTimeout(function() {
+                url.revokeObjectURL(href);
+            }, 0);
+        };
 
         Analysis.prototype.show = function() {
             this.$form.show();
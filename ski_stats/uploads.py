@@ -0,0 +1,53 @@
+import tempfile
+from io import BytesIO
+from flask import Request
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
+from ski_stats import app, formats
+
+# Uploads without the copies.  Werkzeug writes each file of a multipart body to the stream `_get_file_stream` returns:
+# here a temporary file once the request is larger than `UPLOAD_SPOOL_BYTES`, rather than memory.  The parsers are then
+# handed that file mapped read-only (`contents`) instead of a bytes copy of it; xlrd, `ski_stats.formats` and the
+# dataset hash all read the mapping in place.  Requests whose Content-Length is over `MAX_CONTENT_LENGTH` are refused
+# with 413 before any of the body is read (Werkzeug only checks form bodies, and raw bodies are read by `get_data`).
+# Werkzeug reads requests without a Content-Length as empty, so a chunked body can't get past the check.
+#
+# Werkzeug's multipart parser splits a file into lines as it copies it, which for a CSV upload of millions of rows
+# takes far longer than parsing it.  `/parseSpreadsheet` also takes the file as the raw body (`spool_body`), copied
+# in large chunks.
+
+READ_CHUNK_BYTES = 1024 * 1024
+
+
+class SpoolingRequest(Request):
+    """Flask's request, with large uploads spooled to temporary files."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is None or total_content_length > app.config["UPLOAD_SPOOL_BYTES"]:
+            return tempfile.TemporaryFile("wb+")
+        return BytesIO()
+
+
+def check_content_length(request):
+    """Refuse a request with a body larger than `MAX_CONTENT_LENGTH`, without reading it."""
+    limit = request.max_content_length
+    if limit is not None and request.content_length is not None and request.content_length > limit:
+        raise RequestEntityTooLarge("Uploads are limited to {0:g} MB.".format(limit / 1024.0 ** 2))
+
+
+def spool_body(request, filename):
+    """The raw body of a request, as an upload named `filename`: spooled as a multipart upload would be, but copied
+    from the request a chunk at a time, rather than split into lines by the multipart parser."""
+    stream = request._get_file_stream(request.content_length, request.mimetype, filename)
+    while True:
+        chunk = request.stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        stream.write(chunk)
+    stream.seek(0)
+    return FileStorage(stream, filename, content_type=request.mimetype)
+
+
+def contents(upload):
+    """The contents of an uploaded file (a FileStorage): the spooled file mapped read-only, or the bytes of a small
+    upload."""
+    return formats.map_file(upload.stream)
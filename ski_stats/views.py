@@ -1,32 +1,51 @@
-from flask import request, redirect, render_template, jsonify, send_file
-from werkzeug.exceptions import BadRequest, InternalServerError, HTTPException
-from xlrd import open_workbook
+from flask import (request, redirect, render_template, jsonify, send_file, send_from_directory, g, Response, url_for,
+                   stream_with_context)
+import os
+import sys
+import json
+import timeit
+import hashlib
+import gzip
+from base64 import b64encode
+from io import BytesIO
+from werkzeug.exceptions import BadRequest, NotFound, InternalServerError, HTTPException, UnsupportedMediaType
 import numpy as np
 from fastnumbers import fast_real
 from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
-from ski_stats import app, analyses
-from ski_stats.common import parse_workbook
+from ski_stats import app, analyses, metrics, compute, batch, admission, export, progress, formats, datastore, uploads
+from ski_stats.coalesce import coalesced
+from ski_stats.profiling import profiled, is_admin, PROFILE_ID_PATTERN
 
-EXCEL_EXTENSIONS = {'xlsx', 'xls'}
+# responses of these types are gzipped when the client accepts it; images are already compressed
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/octet-stream", "text/html", "text/plain"}
+MIN_COMPRESS_BYTES = 1024
+COMPRESS_LEVEL = 6
+# the script root the index page is cached for comes from the proxy, so the roots cached are capped all the same
+MAX_INDEX_PAGES = 8
 
 
 def is_spreadsheet(filename):
     """Spreadsheet filename validator."""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in EXCEL_EXTENSIONS
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in formats.EXTENSIONS
 
 
 def get_uploaded_spreadsheet():
-    """Get a stream for the uploaded spreadsheet file."""
-    if "spreadsheet" not in request.files:
+    """Get a stream for the uploaded spreadsheet file: the "spreadsheet" file of a form, or a raw
+    `application/octet-stream` body named by `?filename=`."""
+    if request.mimetype == "application/octet-stream":
+        if not request.args.get("filename"):
+            raise BadRequest("Must name the spreadsheet in the \"filename\" query arg.")
+        file_stream = uploads.spool_body(request, request.args["filename"])
+    elif "spreadsheet" not in request.files:
         raise BadRequest("Must select a spreadsheet containing time and data measurements.")
-
-    file_stream = request.files["spreadsheet"]
+    else:
+        file_stream = request.files["spreadsheet"]
     if file_stream is None or file_stream.filename == "":
         raise BadRequest("Spreadsheet file not found.")
 
     if not is_spreadsheet(file_stream.filename):
         raise BadRequest("File must be a spreadsheet with one of the following extensions: " +
-                         ", ".join(EXCEL_EXTENSIONS))
+                         ", ".join(formats.EXTENSIONS))
     return file_stream
 
 
@@ -50,9 +69,227 @@ def get_numpy_val(input_name, input_val):
                 "Invalid value for \"{0}\" ({1}).  Expected: -inf, inf, or a numerical value.".format(input_name, input_val))
 
 
+def send_columns(time, data):
+    """Send parsed (time, data) arrays in the encoding the client asked for:
+
+    `Accept: application/octet-stream`: the x values followed by the y values as little-endian floats (`?dtype=float32`
+    halves the size), with the point count in the `X-Series-Length` header;
+    `?encoding=base64`: the same columns as base64 strings in a JSON object;
+    otherwise: JSON lists of numbers, as before.
+    """
+    encoding = request.args.get("encoding")
+    binary = encoding is None and request.accept_mimetypes.best_match(
+        ["application/json", "application/octet-stream"]) == "application/octet-stream"
+    if not binary and encoding is None:
+        return jsonify(x=time.tolist(), y=data.tolist())
+    if encoding not in (None, "base64"):
+        raise BadRequest("\"encoding\" must be base64.")
+
+    dtype_name = request.args.get("dtype", "float64")
+    dtype = batch.binary_dtype(dtype_name)
+    time = batch.to_float_array(time, "x")
+    data = batch.to_float_array(data, "y")
+    if binary:
+        response = Response(batch.encode_binary((time, data), dtype), mimetype="application/octet-stream")
+        response.headers["X-Series-Length"] = str(time.size)
+        response.headers["X-Series-Dtype"] = dtype_name
+        return response
+    return jsonify(x=b64encode(batch.encode_binary((time,), dtype)), y=b64encode(batch.encode_binary((data,), dtype)),
+                   dtype=dtype_name, length=time.size)
+
+
+def admit_fit(points, max_nfev, post_fit=False, render=False):
+    """Admission control for a fit of `points` points; see `ski_stats.admission`."""
+    max_nfev = fast_real(max_nfev) if max_nfev is not None else lsq.DEFAULT_MAX_NFEV
+    if not isinstance(max_nfev, (int, long, float)):
+        max_nfev = lsq.DEFAULT_MAX_NFEV
+    return admission.admit(request.remote_addr, admission.estimate_seconds(points, max_nfev, post_fit, render))
+
+
+def estimate_points(form):
+    """The point count of the form's upload: exact if it is a stored dataset, otherwise estimated from the request's
+    size, as the upload hasn't been parsed yet."""
+    points = form.spreadsheet.stored_points()
+    if points is not None:
+        return points
+    if not form.spreadsheet.has_file():
+        # refused before any fit starts, so that clients following it get the 404 too
+        raise datastore.DatasetNotFound()
+    return (request.content_length or 0) // admission.XLSX_BYTES_PER_ROW
+
+
+def with_dataset_token(response, token):
+    """Tell the client the token of the dataset it uploaded (see `ski_stats.datastore`)."""
+    if token is not None:
+        response.headers[datastore.TOKEN_HEADER] = token
+    return response
+
+
+def send_params(results):
+    # for now, the Desmos-style page expects just the param solutions
+    h, b, v, p = results.lsq_params
+    return jsonify(h=h, b=b, v=v, p=p)
+
+
+def send_image(buf):
+    """Send an in-memory PNG, with its Content-Length set."""
+    response = send_file(buf, mimetype="image/png")
+    if hasattr(buf, "getvalue"):
+        response.content_length = len(buf.getvalue())
+    return response
+
+
+def send_export(f, filename):
+    """Send an exported .xlsx workbook as a download, with its Content-Length set."""
+    response = send_file(f, mimetype=export.XLSX_MIMETYPE, as_attachment=True, attachment_filename=filename,
+                         cache_timeout=0)
+    response.content_length = os.fstat(f.fileno()).st_size
+    return response
+
+
+def wants_progress_events():
+    """Whether the client asked to follow the fit as Server-Sent Events (see `stream_fit`)."""
+    return any(value == progress.EVENT_STREAM_MIMETYPE for value, quality in request.accept_mimetypes)
+
+
+def fit_response(admission_context, run, respond):
+    """Run `run()` under `admission_context`, and respond with `respond(result)`, or stream the fit to clients that
+    asked for progress events."""
+    if wants_progress_events():
+        return stream_fit(admission_context, run, respond)
+    with admission_context:
+        result = run()
+    return respond(result)
+
+
+def stream_fit(admission_context, run, respond):
+    """Run `run()` as a fit job in the background (see `ski_stats.progress`), and stream Server-Sent Events: "job"
+    with the URL to cancel it, "progress" snapshots while it runs, and then "result" (the body of `respond(result)`),
+    "error" or "cancelled".  A client that disconnects cancels the job.  The admission slot is held until the solver
+    has actually stopped."""
+    admission_context.__enter__()
+    job = progress.FitJob.create()
+    try:
+        future = progress.start(job, run)
+    except Exception:
+        job.remove()
+        admission_context.__exit__(*sys.exc_info())
+        raise
+
+    def finished(future):
+        job.remove()
+        admission_context.__exit__(None, None, None)
+    future.add_done_callback(finished)
+
+    def events():
+        yield progress.event("job", {"cancel_url": url_for("cancel_fit", job_id=job.id)})
+        for snapshot in progress.follow(job, future):
+            yield progress.event("progress", snapshot)
+        try:
+            result = future.result()
+        except progress.FitCancelled:
+            yield progress.event("cancelled", {})
+        except HTTPException as err:
+            yield progress.event("error", {"code": err.code, "name": err.name, "description": err.description})
+        except Exception as err:
+            yield progress.event("error", {"code": 500, "description": "[{0}] {1}".format(type(err).__name__, err)})
+        else:
+            yield progress.event("result", event_payload(respond(result)))
+
+    def closed():
+        # the client went away before the fit finished
+        if not future.done():
+            job.cancel()
+
+    response = Response(stream_with_context(events()), mimetype=progress.EVENT_STREAM_MIMETYPE)
+    response.cache_control.no_cache = True
+    # stop proxies such as nginx from buffering the events
+    response.headers["X-Accel-Buffering"] = "no"
+    response.call_on_close(closed)
+    return response
+
+
+def event_payload(response):
+    """A response's body as the data of a "result" event: JSON as is, anything else base64-encoded."""
+    try:
+        response.direct_passthrough = False
+        body = response.get_data()
+    finally:
+        response.close()
+    if response.mimetype == "application/json":
+        return {"mimetype": response.mimetype, "data": json.loads(body)}
+    return {"mimetype": response.mimetype, "data": b64encode(body)}
+
+
+def get_submitted_analysis():
+    """The analysis whose form was submitted, found by ID lookup."""
+    id = request.form["analysis-id"]
+    analysis = analyses.get(id)
+    if analysis is None:
+        raise BadRequest("Analysis ID not found: " + id)
+    return analysis
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = timeit.default_timer()
+    g.metrics_endpoint = request.endpoint or "none"
+    metrics.REQUESTS_IN_PROGRESS.labels(endpoint=g.metrics_endpoint).inc()
+
+
+@app.before_request
+def limit_content_length():
+    # before anything reads the body; see `ski_stats.uploads`
+    uploads.check_content_length(request)
+
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_start" in g:
+        metrics.REQUEST_SECONDS.labels(endpoint=g.metrics_endpoint, method=request.method,
+                                       code=str(response.status_code)).observe(timeit.default_timer() - g.request_start)
+        if response.content_length is not None:
+            metrics.RESPONSE_BYTES.labels(endpoint=g.metrics_endpoint).observe(response.content_length)
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    # registered after `record_request_metrics`, so it runs first and the metrics see the compressed size
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or "Content-Encoding" in response.headers
+            or "gzip" not in request.accept_encodings):
+        return response
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_BYTES:
+        return response
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=COMPRESS_LEVEL) as f:
+        f.write(body)
+    response.set_data(buf.getvalue())
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if "metrics_endpoint" in g:
+        metrics.REQUESTS_IN_PROGRESS.labels(endpoint=g.metrics_endpoint).dec()
+
+
 @app.errorhandler(HTTPException)
 def handle_httpexception(error):
-    return jsonify(code=error.code, name=error.name, description=error.description), error.code
+    response = jsonify(code=error.code, name=error.name, description=error.description)
+    if getattr(error, "retry_after", None) is not None:
+        response.headers["Retry-After"] = str(error.retry_after)
+    return response, error.code
+
+
+@app.errorhandler(formats.FormatError)
+def handle_format_error(error):
+    # an upload that isn't (time, data) columns is the client's mistake
+    return jsonify(code=400, name="Bad Request", description=str(error)), 400
 
 
 @app.errorhandler(Exception)
@@ -60,34 +297,94 @@ def handle_exception(error):
     return jsonify(code=500, description=error.message), 500
 
 
+# the index page only changes when analyses are added, so it is rendered once per set of analyses, for each of the few
+# roots the app is mounted at: script root -> (analysis ids, html, etag)
+_index_pages = {}
+
+
 @app.route("/", methods=["GET"])
 def show_analyses():
-    # cache forms so that they're only instantiated once per request
-    analyses_copy = analyses[:]
-    for analysis in analyses_copy:
-        form = analysis["module"].get_html_form()
-        analysis["form"] = form
-    ids = ", ".join("'{}'".format(analysis["id"]) for analysis in analyses_copy)
-    return render_template("analysis-forms.html", analyses=analyses_copy, ids=ids)
+    # pick up any scripts added since startup
+    analyses.refresh()
+
+    ids = tuple(analysis.id for analysis in analyses)
+    page = _index_pages.get(request.script_root)
+    if page is None or page[0] != ids:
+        # cache forms so that they're only instantiated once per render
+        analyses_copy = [{"id": analysis.id, "name": analysis.name, "form": analysis.module.get_html_form(),
+                          "exportable": hasattr(analysis.module, "html_form_exported")} for analysis in analyses]
+        html = render_template("analysis-forms.html", analyses=analyses_copy,
+                               ids=", ".join("'{}'".format(analysis_id) for analysis_id in ids))
+        if request.script_root not in _index_pages and len(_index_pages) >= MAX_INDEX_PAGES:
+            _index_pages.clear()
+        page = _index_pages[request.script_root] = (ids, html, hashlib.sha1(html.encode("utf-8")).hexdigest())
+
+    # weak, since the gzipped and plain responses share it; browsers revalidate and get 304 while it is unchanged
+    ids, html, etag = page
+    response = Response(html, mimetype="text/html")
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route("/submitAnalysis", methods=["POST"])
+@profiled
+@coalesced
 def submit_analysis():
-    # find which form was submitted by ID lookup
-    id = request.form["analysis-id"]
-    analysis = [analysis for analysis in analyses if str(analysis["id"]) == id]
-    if not analysis:
-        raise BadRequest("Analysis ID not found: " + id)
-    analysis = analysis.pop()
-    module = analysis["module"]
+    module = get_submitted_analysis().module
     form = module.get_html_form()
     if form.validate():
-        buf = module.html_form_submitted(form)
-        return send_file(buf, mimetype="image/png")
+        response = fit_response(admit_fit(estimate_points(form), request.form.get("max_nfev"), post_fit=True,
+                                          render=True),
+                                lambda: module.html_form_submitted(form), send_image)
+        return with_dataset_token(response, form.spreadsheet.dataset_token())
     else:
         return jsonify(errors=form.errors), 400
 
 
+@app.route("/exportAnalysis", methods=["POST"])
+@profiled
+@coalesced
+def export_analysis():
+    # the same form as /submitAnalysis, but the results of every worksheet are sent as an .xlsx download
+    analysis = get_submitted_analysis()
+    module = analysis.module
+    if not hasattr(module, "html_form_exported"):
+        raise BadRequest("Analysis has no export: " + analysis.name)
+    form = module.get_html_form()
+    if form.validate():
+        with admit_fit(estimate_points(form), request.form.get("max_nfev"), post_fit=True):
+            f = module.html_form_exported(form)
+        upload = request.files.get("spreadsheet")
+        return send_export(f, export.export_filename(upload.filename if upload else None))
+    else:
+        return jsonify(errors=form.errors), 400
+
+
+@app.route("/fits/<job_id>/cancel", methods=["POST"])
+def cancel_fit(job_id):
+    # stops a fit streamed by `stream_fit`; any worker can take the request
+    job = progress.get_job(job_id)
+    if job is None or not job.cancel():
+        raise NotFound("No fit in progress with id " + job_id)
+    return jsonify(cancelled=True), 202
+
+
+@app.route("/metrics", methods=["GET"])
+def show_metrics():
+    body, content_type = metrics.latest()
+    return Response(body, content_type=content_type)
+
+
+@app.route("/profiles/<profile_id>", methods=["GET"])
+def download_profile(profile_id):
+    # profiles are only visible to admins
+    if not is_admin() or not PROFILE_ID_PATTERN.match(profile_id):
+        raise NotFound()
+    return send_from_directory(app.config["PROFILE_DIR"], profile_id, as_attachment=True,
+                               mimetype="application/octet-stream")
+
+
 @app.route("/desmos")
 def desmos_graph():
     return render_template("desmos-graph.html")
@@ -95,14 +392,27 @@ def desmos_graph():
 
 @app.route("/parseSpreadsheet", methods=["POST"])
 def parse_uploaded_spreadsheet():
-    # spreadsheet submitted for parsing only
+    # spreadsheet submitted for parsing only; the dataset is kept for the fits that follow
     file_stream = get_uploaded_spreadsheet()
-    time, data = parse_workbook(open_workbook(file_contents=file_stream.read()), use_arrays=False)
-    return jsonify(x=time, y=data)
+    token, time, data = datastore.parse_upload(uploads.contents(file_stream), file_stream.filename)
+    return with_dataset_token(send_columns(time, data), token)
 
 
 @app.route("/desmosCalculateRegression", methods=["POST"])
+@profiled
+@coalesced
 def desmos_calculate_regression():
+    if request.mimetype == "application/octet-stream" or "dataset" in request.args:
+        # the page posts its table as x values followed by y values, or the token of the imported dataset while the
+        # table is unchanged; see `batch.decode_binary`
+        series, options = batch.decode_binary(request.get_data(), request.args)
+        if len(series) != 1:
+            raise BadRequest("Expected a single series.")
+        return fit_response(admit_fit(series[0].time.size, options["max_nfev"], post_fit=True),
+                            lambda: compute.run(lsq.do_calculations, time=series[0].time, data=series[0].data,
+                                                **options),
+                            send_params)
+
     try:
         # parse the form inputs
         time = [get_numpy_val("x["+str(i)+"]", listVal) for i, listVal in enumerate(request.form.getlist("x[]"))]
@@ -130,19 +440,51 @@ def desmos_calculate_regression():
             bounds = ([h_lower, b_lower, v_lower, p_lower], [h_upper, b_upper, v_upper, p_upper])
 
             # run calculation with bounds
-            results = lsq.do_calculations(time=time, data=data, params_guess=(h, b, v, p), bounds=bounds, max_nfev=max_nfev)
+            return fit_response(admit_fit(time.size, max_nfev, post_fit=True),
+                                lambda: compute.run(lsq.do_calculations, time=time, data=data,
+                                                    params_guess=(h, b, v, p), bounds=bounds, max_nfev=max_nfev),
+                                send_params)
         else:
             # run calculation without bounds
-            results = lsq.do_calculations(time=time, data=data, params_guess=(h, b, v, p), max_nfev=max_nfev)
-
-        # for now, the Desmos-style page expects just the param solutions
-        h, b, v, p = results.lsq_params
-        return jsonify(h=h, b=b, v=v, p=p)
+            return fit_response(admit_fit(time.size, max_nfev, post_fit=True),
+                                lambda: compute.run(lsq.do_calculations, time=time, data=data,
+                                                    params_guess=(h, b, v, p), max_nfev=max_nfev),
+                                send_params)
 
     except KeyError as err:
         print str(err)
         raise BadRequest("[KeyError] {0}".format("Request was missing param \"{0}\"".format(err.args[0])))
 
+    except HTTPException:
+        # bad values and admission rejections keep their status codes
+        raise
+
     except Exception as err:
         print str(err)
         raise InternalServerError("[{0}] {1}".format(type(err).__name__, str(err)))
+
+
+@app.route("/api/fit", methods=["POST"])
+@profiled
+@coalesced
+def api_fit():
+    # batch fitting for scripted clients; see `ski_stats.batch` for the request formats
+    if request.mimetype == "application/json":
+        payload = request.get_json(silent=True)
+        if payload is None:
+            raise BadRequest("Request body is not valid JSON.")
+        series, options = batch.decode_json(payload)
+    elif request.mimetype == "application/octet-stream":
+        series, options = batch.decode_binary(request.get_data(), request.args)
+    else:
+        raise UnsupportedMediaType("Expected a body of type application/json or application/octet-stream.")
+    # results as an .xlsx workbook, one row per series, for clients that ask for it
+    as_xlsx = request.accept_mimetypes.best_match(["application/json", export.XLSX_MIMETYPE]) == export.XLSX_MIMETYPE
+    with admit_fit(sum(item.time.size for item in series), options["max_nfev"]):
+        if as_xlsx:
+            f = batch.export_batch(series, **options)
+        else:
+            results = batch.fit_batch(series, **options)
+    if as_xlsx:
+        return send_export(f, "fits.xlsx")
+    return jsonify(results=results)
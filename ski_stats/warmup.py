@@ -0,0 +1,35 @@
+import importlib
+import numpy as np
+
+# modules deferred by the analysis scripts; imported up-front when preloading so forked workers share them
+HEAVY_MODULES = ["scipy.optimize", "matplotlib", "matplotlib.pyplot", "PIL.Image", "xlrd", "sympy"]
+
+
+def import_heavy_modules():
+    """Import the numerical and rendering libraries.  Call in the gunicorn master when `preload_app` is set."""
+    from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+    lsq._pyplot()
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+
+
+def synthetic_dataset(num_points=48, params=(700, 200, 0, 24), noise=0.05, seed=0):
+    """Returns (time, data) sampled hourly from a noisy cosine curve."""
+    from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+    rng = np.random.RandomState(seed)
+    time = np.arange(num_points, dtype=float)
+    data = lsq.cos_fit(params, time)
+    data += rng.normal(scale=noise * abs(params[0]), size=num_points)
+    return time, data
+
+
+def warm_up():
+    """Run one synthetic fit and render, so that SciPy's first-call overhead and matplotlib's font cache are
+    paid before the worker accepts traffic."""
+    from ski_stats.scripts import ski_slope_least_squares_3_oct as lsq
+    import_heavy_modules()
+    time, data = synthetic_dataset()
+    results = lsq.do_calculations(time, data, max_nfev=10000)
+    buf = lsq.generate_plot_image(time, data, results)
+    buf.close()
+    lsq._pyplot().close("all")